@@ -2,15 +2,35 @@
 """
 Storage Migration: Batch Transfer Script
 
-Version: 4.0
-Date: March 25, 2025
+Version: 5.0
+Date: October 18, 2026
 Author: Greg Bilke
 
 This script performs safe batch transfers from Dropbox to Synology NAS with:
 - Command preview before execution
-- Clean progress display (4-line status area)
-- Full verification after transfer
-- Comprehensive logging and error handling
+- Clean progress display (4-line status area) rendered from rclone's JSON stats
+- Rolling transfer metrics as a Prometheus textfile or local HTTP/JSON endpoint
+- Per-file verification report after transfer (incremental, full on demand or on a schedule,
+  or a stratified sample compared byte for byte, with a stated confidence)
+- Comprehensive logging and error handling (buffered background writer, plain + JSONL logs)
+- Streaming rclone output: bounded memory however many files a folder holds (under rcd,
+  folders above --stream-above files are listed and checked by a streamed rclone process)
+- Concurrent multi-folder scheduling under one shared rate budget
+- One cached listing per side, reused by size, dry run, copy and verification
+- Per-file SQLite transfer journal for crash-safe --resume
+- Optional adaptive (AIMD) tpslimit/transfers/bwlimit control from rate-limit feedback
+- Optional size-band sharding of folders into separately tuned copy jobs
+- Optional content-hash dedup: repeated files are downloaded once and copied on the NAS
+- Failure isolation: a failed listing or copy is retried subdirectory by subdirectory,
+  and only the smallest failing subtrees are quarantined (reported in a JSON file)
+- 'verify-sizes' subcommand: original vs staged count/bytes for every subfolder
+- Per-folder stage timings kept in a run history; 'plan' subcommand predicts durations,
+  folder order and --parallel-folders from it
+- 'verify-local' subcommand: parallel, cached Dropbox content_hash check of the NAS copies
+- Persistent 'rclone rcd' backend (operations as rc jobs), one process per command as fallback
+- Optional second hop: the files verified on DS423 are uploaded to an S3-compatible bucket
+  (Wasabi/AWS) with multipart tuning, then checked by size and ETag
+- RCLONE_BIN environment override, used by benchmark-transfer-settings.py
 
 SAFETY FEATURES:
 - Only uses 'copy' command (never sync, move, or delete)
@@ -30,11 +50,32 @@ import sys
 import shutil  # For getting terminal size
 import socket  # For hostname
 import re      # For parsing output
+import threading
+import contextlib
+import concurrent.futures  # For running several folders at once
+import sqlite3             # For the transfer journal
+import urllib.request      # For the rclone remote-control API
+import urllib.error
+import collections
+import http.server         # For the local metrics endpoint
+import atexit              # For stopping the rclone rcd daemon
+import queue               # For the background log writer
+import selectors           # For reading rclone stdout and stderr together
+import statistics          # For the planner's time model
+import hashlib             # For local Dropbox content hashes
+import math
+import random              # For reproducible verification samples
+import mmap
+import secrets             # For run ids and rc credentials
+import base64
 
 # SAFETY: Configuration - NEVER modify these paths
 SOURCE_BASE = "dropbox-wasabi-migration:/WASABI-MIGRATION"
 DEST_BASE = "DS423:/Backups/WASABI-MIGRATION"
 
+# rclone executable; benchmarks point this at scripts/fake-rclone.py
+RCLONE = os.environ.get("RCLONE_BIN", "rclone")
+
 # Terminal Colors
 class Colors:
     HEADER = '\033[95m'
@@ -49,17 +90,80 @@ class Colors:
 # Setup argument parser
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Safely transfer files from Dropbox to Synology NAS')
-    parser.add_argument('folders', nargs='+', help='Folder(s) to transfer (must be in WASABI-MIGRATION)')
+    parser.add_argument('folders', nargs='*', help='Folder(s) to transfer (must be in WASABI-MIGRATION)')
     parser.add_argument('--subpath', default='', help='Subpath within WASABI-MIGRATION (e.g., "Media Files Online Backup 8-31-2020")')
     parser.add_argument('--transfers', type=int, default=4, help='Number of concurrent transfers (default: 4)')
     parser.add_argument('--checkers', type=int, default=8, help='Number of checkers (default: 8)')
-    parser.add_argument('--tpslimit', type=int, default=2, help='Transactions per second limit (default: 2)')
-    parser.add_argument('--bwlimit', default='10M', help='Bandwidth limit (default: 10M)')
+    parser.add_argument('--tpslimit', type=float, default=2, help='Transactions per second limit, shared by all concurrent rclone processes (default: 2)')
+    parser.add_argument('--bwlimit', default='10M', help='Bandwidth limit, shared by all concurrent rclone processes (default: 10M)')
+    parser.add_argument('--parallel-folders', type=int, default=1, help='Number of folders processed at the same time (default: 1)')
+    parser.add_argument('--max-listings', type=int, default=1, help='Max folders in the size/dry-run stage at once (default: 1)')
+    parser.add_argument('--max-copies', type=int, default=1, help='Max folders in the copy stage at once (default: 1)')
+    parser.add_argument('--max-verifies', type=int, default=1, help='Max folders in the verification stage at once (default: 1)')
     parser.add_argument('--no-verify', action='store_true', help='Skip verification step')
+    parser.add_argument('--verify-mode', choices=['incremental', 'full', 'sample'], default='incremental',
+                        help='incremental: compare the content of the files copied in this run (rclone check --download); full: names and sizes of the whole folder, then the content of every file (rclone check --download); '
+                             'sample: names and sizes of the whole folder plus a byte-for-byte comparison (rclone check --download) of a stratified random sample, '
+                             'escalating to full when a sampled file fails (default: incremental)')
+    parser.add_argument('--sample-confidence', type=float, default=0.95, help='Confidence a clean --verify-mode sample must reach (default: 0.95)')
+    parser.add_argument('--sample-error-rate', type=float, default=0.01, help='Fraction of bad files a clean sample rules out (default: 0.01)')
+    parser.add_argument('--sample-seed', default='', help='Seed for the verification sample; the same seed picks the same files (default: none)')
+    parser.add_argument('--full-check-every', type=float, default=0, metavar='DAYS',
+                        help='Run a full check when the last one of a folder is older than DAYS (default: 0, only on demand)')
     parser.add_argument('--yes', action='store_true', help='Skip confirmation prompts')
     parser.add_argument('--dry-run-only', action='store_true', help='Only perform dry run, no actual transfer')
+    parser.add_argument('--manifest-ttl', type=float, default=12, help='Hours a cached source/destination listing stays valid, 0 disables the cache (default: 12)')
+    parser.add_argument('--refresh-manifests', action='store_true', help='Ignore cached listings and list both sides again')
+    parser.add_argument('--adaptive', action='store_true', help='Adjust bwlimit during the copy, and transfers/tpslimit for the next copy job, from rate-limit feedback (uses rclone --rc)')
+    parser.add_argument('--adapt-interval', type=float, default=30, help='Seconds between adaptive adjustments (default: 30)')
+    parser.add_argument('--adapt-tps-min', type=float, default=0.5, help='Adaptive floor for tpslimit (default: 0.5)')
+    parser.add_argument('--adapt-tps-max', type=float, default=8, help='Adaptive ceiling for tpslimit (default: 8)')
+    parser.add_argument('--adapt-tps-step', type=float, default=0.5, help='Adaptive additive tpslimit increase (default: 0.5)')
+    parser.add_argument('--adapt-transfers-min', type=int, default=1, help='Adaptive floor for transfers (default: 1)')
+    parser.add_argument('--adapt-transfers-max', type=int, default=16, help='Adaptive ceiling for transfers (default: 16)')
+    parser.add_argument('--adapt-bw-max', default=None, help='Adaptive ceiling for bwlimit (default: --bwlimit)')
+    parser.add_argument('--shard', action='store_true', help='Split each folder into size-band shards copied with their own settings')
+    parser.add_argument('--shard-band', action='append', metavar='NAME:MIN-MAX[:key=value,...]',
+                        help='Size band for --shard, repeatable (default: small:0-16M:transfers=8,checkers=16 and '
+                             'large:16M-:transfers=2,checkers=4,multi-thread-streams=4,multi-thread-cutoff=64M)')
+    parser.add_argument('--stats-interval', type=float, default=10, help='Seconds between rclone stats snapshots (default: 10)')
+    parser.add_argument('--stall-after', type=float, default=300, help='Flag a transfer as stalled after this many seconds without progress (default: 300)')
+    parser.add_argument('--metrics-file', help='Write Prometheus textfile metrics to this path')
+    parser.add_argument('--metrics-port', type=int, help='Serve /metrics (Prometheus) and /status (JSON) on 127.0.0.1:PORT')
+    parser.add_argument('--backend', choices=['rcd', 'subprocess'], default='rcd',
+                        help='rcd: one rclone rcd daemon per run, operations as rc jobs; subprocess: one rclone process per command (default: rcd, falls back to subprocess). rcd holds each listing and check result in memory as one rc response, so folders above --stream-above files are listed and checked by a streamed rclone process instead; subprocess always streams. The rc API (rcd, and --adaptive under subprocess) listens on 127.0.0.1 on a random port with a random user and password for each run')
+    parser.add_argument('--stream-above', type=int, default=100000, metavar='FILES',
+                        help='Under rcd, list and check a folder with a streamed rclone process (bounded memory) instead of one rc response '
+                             'when it held more than FILES files in its last recorded run, or has no recorded run yet (default: 100000)')
+    parser.add_argument('--dedup', action='store_true', help='Download each distinct file content (Dropbox content_hash) once across all folders; copy the duplicates on the destination')
+    parser.add_argument('--no-isolate', action='store_true', help='Do not split a failed listing or copy into subdirectories to quarantine the failing ones')
+    parser.add_argument('--isolate-retries', type=int, default=3, help='Attempts per subdirectory when isolating a failed listing or copy (default: 3)')
+    parser.add_argument('--isolate-backoff', type=float, default=5, help='Seconds before the first retry of a subdirectory, doubling each time (default: 5)')
+    parser.add_argument('--s3-remote', metavar='REMOTE:BUCKET/PATH',
+                        help='Second hop: upload the files of each folder verified on DS423 (in this run, or by an earlier run for files already there) to this S3-compatible rclone path, '
+                             'e.g. "wasabi:bucket/WASABI-MIGRATION" (copy only; default: off)')
+    parser.add_argument('--s3-chunk-size', default='64M', help='Multipart part size for the S3 upload (default: 64M)')
+    parser.add_argument('--s3-upload-concurrency', type=int, default=4, help='Parts of one file uploaded at once (default: 4)')
+    parser.add_argument('--s3-upload-cutoff', default='200M', help='Files above this size are uploaded in parts (default: 200M)')
+    parser.add_argument('--s3-transfers', type=int, default=4, help='Files uploaded at once (default: 4)')
+    parser.add_argument('--s3-bwlimit', default=None, help='Upload bandwidth limit for the S3 hop (default: none)')
+    parser.add_argument('--max-uploads', type=int, default=1, help='Folders uploaded to S3 at the same time (default: 1)')
+    parser.add_argument('--resume', metavar='RUN_ID', help='Resume an earlier run from the transfer journal, copying and verifying only unverified files')
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.folders and not args.resume:
+        parser.error("at least one folder is required (or --resume RUN_ID)")
+    if args.parallel_folders < 1:
+        parser.error("--parallel-folders must be at least 1")
+    if args.isolate_retries < 1:
+        parser.error("--isolate-retries must be at least 1")
+    if not 0 < args.sample_confidence < 1 or not 0 < args.sample_error_rate < 1:
+        parser.error("--sample-confidence and --sample-error-rate must be between 0 and 1")
+    # SAFETY: the second hop only ever writes into a WASABI-MIGRATION path of an rclone remote
+    if args.s3_remote and (":" not in args.s3_remote or "WASABI-MIGRATION" not in args.s3_remote
+                           or ".." in args.s3_remote):
+        parser.error("--s3-remote must be an rclone path inside a WASABI-MIGRATION folder (REMOTE:BUCKET/.../WASABI-MIGRATION)")
+    return args
 
 # Setup logging
 def setup_logging():
@@ -75,31 +179,168 @@ def setup_logging():
     
     return log_dir, main_log, timestamp, hostname
 
+# Folder workers run in threads; keep their log lines from interleaving
+_log_lock = threading.Lock()
+
+# One background writer for every log file of the run
+# Callers queue lines and return immediately; the writer thread keeps each file open,
+# writes in batches and flushes every `flush_every` seconds. The queue is bounded, so a
+# fast producer (a 55k-file copy log) waits for the disk instead of growing memory.
+class LogWriter:
+    def __init__(self, flush_every=0.5, batch=1000, max_queued=10000):
+        self.flush_every = flush_every
+        self.batch = batch
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._files = {}
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.close)
+
+    # Plain sink: append text (including its newline) to path
+    def write(self, path, text):
+        self._ensure_started()
+        self._queue.put((path, text))
+
+    # JSONL sink: append one JSON record to path
+    def write_json(self, path, record):
+        self.write(path, json.dumps(record, default=str) + "\n")
+
+    # Block until everything queued so far is on disk
+    def flush(self):
+        if self._thread is None:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            try:
+                items = [self._queue.get(timeout=self.flush_every)]
+            except queue.Empty:
+                continue
+            while len(items) < self.batch:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            waiters = []
+            for item in items:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    path, text = item
+                    handle = self._files.get(path)
+                    if handle is None:
+                        handle = self._files[path] = open(path, "a", encoding="utf-8", buffering=1024 * 1024)
+                    handle.write(text)
+            for handle in self._files.values():
+                handle.flush()
+            for waiter in waiters:
+                waiter.set()
+        for handle in self._files.values():
+            handle.close()
+        self._files.clear()
+
+log_writer = LogWriter()
+
+# JSONL companion of a plain log file ("x.log" -> "x.jsonl")
+def jsonl_path(log_path):
+    return os.path.splitext(log_path)[0] + ".jsonl"
+
+# Run a command and read its stdout and stderr together, without blocking on either,
+# as one stream of (stream name, line) pairs. Nothing is accumulated except the last
+# `keep` lines of each stream (for error messages), so memory stays flat however much
+# the command prints.
+class StreamingRun:
+    MAX_LINE = 1024 * 1024
+
+    def __init__(self, cmd, keep=20, env=None):
+        self.command = cmd
+        self.env = env
+        self.tail = {"stdout": collections.deque(maxlen=keep), "stderr": collections.deque(maxlen=keep)}
+        self.process = None
+        self.returncode = None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.env)
+        return self
+
+    def _line(self, name, raw):
+        line = raw.decode("utf-8", errors="replace").rstrip("\r")
+        self.tail[name].append(line)
+        return name, line
+
+    def lines(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.process.stdout, selectors.EVENT_READ, "stdout")
+        selector.register(self.process.stderr, selectors.EVENT_READ, "stderr")
+        partial = {"stdout": b"", "stderr": b""}
+        try:
+            while selector.get_map():
+                for key, _ in selector.select():
+                    name = key.data
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        if partial[name]:
+                            yield self._line(name, partial[name])
+                            partial[name] = b""
+                        continue
+                    *complete, partial[name] = (partial[name] + chunk).split(b"\n")
+                    for raw in complete:
+                        yield self._line(name, raw)
+                    if len(partial[name]) > self.MAX_LINE:
+                        yield self._line(name, partial[name])
+                        partial[name] = b""
+        finally:
+            selector.close()
+        self.wait()
+
+    def wait(self):
+        self.returncode = self.process.wait()
+        return self.returncode
+
+    # Raise like subprocess.run(check=True), with the last stderr lines as the error text
+    def check(self):
+        if self.wait():
+            raise subprocess.CalledProcessError(self.returncode, self.command, stderr="\n".join(self.tail["stderr"]))
+
+ANSI_PATTERN = re.compile(r'\033\[\d+m')
+
 # Write to both console and log file
 def log_message(message, main_log, also_print=True, level="INFO"):
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     # Format based on level
-    if level == "INFO":
-        prefix = Colors.BLUE + "[INFO]" + Colors.END
-    elif level == "WARNING":
-        prefix = Colors.YELLOW + "[WARNING]" + Colors.END
-    elif level == "ERROR":
-        prefix = Colors.RED + "[ERROR]" + Colors.END
-    elif level == "SUCCESS":
-        prefix = Colors.GREEN + "[SUCCESS]" + Colors.END
-    else:
-        prefix = "[" + level + "]"
+    color = {"INFO": Colors.BLUE, "WARNING": Colors.YELLOW, "ERROR": Colors.RED, "SUCCESS": Colors.GREEN}.get(level)
+    prefix = f"{color}[{level}]{Colors.END}" if color else f"[{level}]"
     
     log_line = f"{timestamp} - {prefix} {message}"
     
-    with open(main_log, "a", encoding="utf-8") as f:
-        # Strip colors for log file
-        clean_line = re.sub(r'\033\[\d+m', '', log_line)
-        f.write(f"{clean_line}\n")
-    
-    if also_print:
-        print(log_line)
+    # The log files get the message without colors (only scanned when it has any)
+    clean_message = ANSI_PATTERN.sub('', message) if '\033' in message else message
+    with _log_lock:
+        log_writer.write(main_log, f"{timestamp} - [{level}] {clean_message}\n")
+        log_writer.write_json(jsonl_path(main_log), {"time": timestamp, "level": level, "message": clean_message})
+        
+        if also_print:
+            print(log_line)
 
 # Print safety banner
 def print_safety_banner(main_log):
@@ -147,296 +388,3368 @@ def format_size(size_bytes):
     else:
         return f"{size_bytes/(1024*1024*1024):.2f} GB"
 
+# Parse an rclone bandwidth string ("10M", "512K", "off") into bytes per second
+# rclone treats a bare number as KiB/s and all suffixes as binary units; 0 = unlimited
+def parse_bwlimit(value):
+    value = str(value).strip()
+    if value.lower() in ("", "off", "0"):
+        return 0
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([BKMGTP]?)', value, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Cannot split bandwidth limit '{value}' (timetables and up:down pairs are not supported)")
+    multipliers = {"B": 1, "": 1024, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+    return int(float(match.group(1)) * multipliers[match.group(2).upper()])
+
+# Format bytes per second back into an rclone --bwlimit value
+def format_bwlimit(bytes_per_sec):
+    if bytes_per_sec <= 0:
+        return "off"
+    return f"{max(1, int(bytes_per_sec // 1024))}K"
+
+# Global rate budget shared by every concurrent rclone process
+# Dropbox counts API calls per account, not per process, so N processes each running
+# with --tpslimit=2 would make 2*N calls per second. The budget is split into fixed
+# slots: each running rclone leases one slot and gets 1/slots of --tpslimit and
+# --bwlimit, so the sum across all processes never exceeds the configured limits.
+class RateBudget:
+    def __init__(self, tpslimit, bwlimit, slots):
+        self.slots = max(1, slots)
+        self.tps_share = tpslimit / self.slots if tpslimit > 0 else 0
+        self.bw_share = parse_bwlimit(bwlimit) / self.slots
+        self._free = threading.BoundedSemaphore(self.slots)
+
+    # Flags for one rclone process holding a lease
+    def flags(self):
+        flags = []
+        if self.tps_share > 0:
+            flags.append(f"--tpslimit={self.tps_share:g}")
+        flags.append(f"--bwlimit={format_bwlimit(self.bw_share)}")
+        return flags
+
+    @contextlib.contextmanager
+    def lease(self):
+        self._free.acquire()
+        try:
+            yield self.flags()
+        finally:
+            self._free.release()
+
+# Stage-aware scheduler: caps how many folders may be in each stage at once
+# so one folder can verify while another copies and a third is being listed
+class FolderScheduler:
+    STAGES = ("listing", "copy", "verify")
+
+    def __init__(self, args):
+        caps = {"listing": args.max_listings, "copy": args.max_copies, "verify": args.max_verifies}
+        self.stage_slots = {name: threading.BoundedSemaphore(max(1, cap)) for name, cap in caps.items()}
+        # Each folder runs at most one rclone process at a time
+        slots = min(args.parallel_folders, sum(max(1, cap) for cap in caps.values()))
+        self.budget = RateBudget(args.tpslimit, args.bwlimit, slots)
+        # Set when the run is interrupted; no folder starts another stage after that
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    # Enter a stage: wait for a stage slot, then lease a share of the rate budget
+    # Raises KeyboardInterrupt in the folder's thread once the run is cancelled.
+    @contextlib.contextmanager
+    def stage(self, name):
+        with self.stage_slots[name]:
+            with self.budget.lease() as limits:
+                if self.cancelled.is_set():
+                    raise KeyboardInterrupt
+                yield limits
+
+# Shared state for one batch run, handed to every folder worker
+class RunContext:
+    def __init__(self, args, full_source_base, full_dest_base, log_dir, main_log, timestamp, terminal_width, journal, backend):
+        self.args = args
+        self.backend = backend
+        self.full_source_base = full_source_base
+        self.full_dest_base = full_dest_base
+        self.log_dir = log_dir
+        self.main_log = main_log
+        self.timestamp = timestamp
+        self.terminal_width = terminal_width
+        self.scheduler = FolderScheduler(args)
+        self.bands = shard_bands(args)
+        self.metrics = MetricsRegistry(args.metrics_file, args.metrics_port)
+        self.journal = journal
+        # A resumed run keeps writing to the journal rows of the original run; a new run
+        # gets a random suffix, since two runs can start within the same second
+        self.run_id = args.resume or f"{timestamp}-{secrets.token_hex(3)}"
+        # Only one folder may ask a question on the terminal at a time
+        self.prompt_lock = threading.Lock()
+        # The 4-line ANSI status area only makes sense when a single folder is running
+        self.live_display = args.parallel_folders == 1
+        # AIMD controllers for --adaptive (see adaptive_controller)
+        self.controllers = {}
+        self.controller_lock = threading.Lock()
+        # Content index shared by all folders with --dedup (see build_dedup_index)
+        self.dedup = None
+        # Second hop to S3 (--s3-remote): background uploads, one rclone process each
+        self.full_s3_base = None
+        self.uploads = []
+        self.upload_lock = threading.Lock()
+        if args.s3_remote:
+            self.full_s3_base = f"{args.s3_remote.rstrip('/')}/{args.subpath}" if args.subpath else args.s3_remote.rstrip('/')
+            self.upload_backend = SubprocessBackend()
+            self.upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.max_uploads),
+                                                                     thread_name_prefix="s3-upload")
+
+# Rate limits one folder's rclone work runs under (calls/s, bytes/s): its budget slot,
+# or under rcd an even share of the daemon's limits between the folders running at once
+def folder_limits(ctx):
+    if ctx.backend.daemon:
+        share = max(1, min(ctx.args.parallel_folders, len(ctx.args.folders)))
+        return ctx.args.tpslimit / share, parse_bwlimit(ctx.args.bwlimit) / share
+    budget = ctx.scheduler.budget
+    return budget.tps_share, budget.bw_share
+
+# File-system friendly key for a folder (including any --subpath)
+def folder_key(folder, subpath=""):
+    name = f"{subpath}/{folder}" if subpath else folder
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', name).strip('_')
+
+# Where the manifest for one side ("source" or "dest") of a folder is kept
+def manifest_path(ctx, side, folder):
+    return manifest_file(ctx.log_dir, side, folder, ctx.args.subpath)
+
+def manifest_file(log_dir, side, folder, subpath):
+    manifest_dir = os.path.join(log_dir, "manifests")
+    os.makedirs(manifest_dir, exist_ok=True)
+    return os.path.join(manifest_dir, f"{side}-{folder_key(folder, subpath)}.json")
+
+# One recursive listing of a remote path, with hashes, as {relative_path: entry}
+# Without hashes the listing is names and sizes only, so the remote reads no file content;
+# hashes may also name the hash types wanted (e.g. ["md5"]), so the remote computes no others.
+# files_from limits the listing (and the hashing) to the paths in that file.
+def list_remote(remote_path, limits, hashes=True, files_from=None):
+    list_cmd = [RCLONE, "lsjson", remote_path, "--recursive", "--files-only"] + hash_flags(hashes) + limits
+    if files_from:
+        list_cmd.append(f"--files-from-raw={files_from}")
+    return manifest_files(stream_lsjson(list_cmd))
+
+# lsjson flags for list_remote's hashes argument
+def hash_flags(hashes):
+    if not hashes:
+        return []
+    return ["--hash"] + ([f"--hash-type={name}" for name in hashes] if hashes is not True else [])
+
+# One level of a remote path: ({file: entry}, [subdirectory names])
+def list_remote_level(remote_path, limits):
+    list_cmd = [RCLONE, "lsjson", remote_path, "--max-depth", "1", "--hash"] + limits
+    return split_level(stream_lsjson(list_cmd))
+
+# lsjson items of one directory level as manifest files and subdirectory names
+def split_level(items):
+    items = list(items)
+    dirs = sorted(item["Path"] for item in items if item.get("IsDir"))
+    return manifest_files(item for item in items if not item.get("IsDir")), dirs
+
+# Items of an lsjson command as they arrive; raises CalledProcessError if rclone fails
+def stream_lsjson(list_cmd):
+    run = StreamingRun(list_cmd).start()
+    for stream, line in run.lines():
+        if stream == "stdout":
+            yield from lsjson_items(line)
+    run.check()
+
+# Items on one line of lsjson output
+# rclone prints "[", one item per line (each but the last followed by ","), then "]",
+# so a listing can be parsed as it streams; a compact one-line array also works.
+def lsjson_items(line):
+    line = line.strip().rstrip(",")
+    if line in ("", "[", "]"):
+        return []
+    if line.startswith("["):
+        return json.loads(line)
+    return [json.loads(line)]
+
+# lsjson items as manifest entries {relative_path: {"size", "modtime", "hashes"}}
+def manifest_files(items):
+    files = {}
+    for item in items:
+        files[item["Path"]] = {
+            "size": item.get("Size", -1),
+            "modtime": item.get("ModTime", ""),
+            "hashes": {k: v for k, v in (item.get("Hashes") or {}).items() if v},
+        }
+    return files
+
+# Return the manifest for one side of a folder, listing the remote only when needed
+# A cached manifest is reused while it is younger than --manifest-ttl and was taken
+# of the same remote path, so a second run inside the window makes no listing calls.
+def get_manifest(ctx, side, folder, remote_path, refresh=False, stage="listing"):
+    path = manifest_path(ctx, side, folder)
+    if not refresh and not ctx.args.refresh_manifests:
+        manifest = cached_manifest(path, remote_path, ctx.args.manifest_ttl, folder, side, ctx.main_log)
+        if manifest is not None:
+            return manifest
+
+    log_message(f"[{folder}] Listing {side}: {remote_path}", ctx.main_log)
+    quarantined = []
+    try:
+        with ctx.scheduler.stage(stage) as limits:
+            # The destination is listed without hashes: none of the NAS's hash types can be
+            # compared with Dropbox's content_hash, and computing them reads every file on DS423
+            files = ctx.backend.list_files(remote_path, limits, hashes=side == "source",
+                                           stream=stream_folder(ctx, folder))
+    except subprocess.CalledProcessError as e:
+        if side != "source" or ctx.args.no_isolate:
+            raise
+        log_message(f"[{folder}] Listing {side} failed ({failure_reason(e)}); "
+                    f"isolating the failing subdirectories", ctx.main_log, level="WARNING")
+        files, quarantined = isolate_listing(ctx, folder, remote_path, stage)
+    return save_manifest(path, remote_path, files, quarantined)
+
+# Whether a folder's listings should stream through an rclone process even under rcd,
+# whose rc replies hold the whole listing in memory: the folder held more than
+# --stream-above files in its last recorded run, or it has none (its size is unknown)
+def stream_folder(ctx, folder):
+    count = ctx.journal.last_file_count(folder_key(folder, ctx.args.subpath))
+    return count is None or count > ctx.args.stream_above
+
+# A cached manifest of remote_path younger than ttl_hours, or None
+def cached_manifest(path, remote_path, ttl_hours, folder, side, main_log):
+    ttl = ttl_hours * 3600
+    if ttl <= 0 or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        age = time.time() - manifest["taken_at"]
+        if manifest.get("quarantined"):
+            # Retry the quarantined subtrees instead of carrying them over for the whole TTL
+            log_message(f"[{folder}] Cached {side} manifest has quarantined paths - listing again", main_log)
+            return None
+        if manifest["remote"] == remote_path and 0 <= age < ttl:
+            log_message(f"[{folder}] Using cached {side} manifest ({len(manifest['files'])} files, "
+                        f"{int(age // 60)} min old)", main_log)
+            return manifest
+    except (OSError, ValueError, KeyError) as e:
+        log_message(f"[{folder}] Ignoring unreadable {side} manifest: {str(e)}", main_log, level="WARNING")
+    return None
+
+# Write a freshly listed manifest atomically and return it
+# quarantined lists the subtrees that could not be listed (see isolate_listing)
+def save_manifest(path, remote_path, files, quarantined=None):
+    manifest = {"remote": remote_path, "taken_at": time.time(), "files": files, "quarantined": quarantined or []}
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+    return manifest
+
+# Last line of rclone's error output for a failed command, or the exception text
+def failure_reason(error):
+    lines = [line for line in (error.stderr or "").splitlines() if line.strip()]
+    return lines[-1].strip() if lines else str(error)
+
+# Run operation(limits) inside a scheduler stage, retrying a CalledProcessError with
+# exponential backoff (--isolate-backoff seconds, doubling) up to --isolate-retries times
+def with_retries(ctx, folder, what, stage, operation):
+    delay = ctx.args.isolate_backoff
+    for attempt in range(1, ctx.args.isolate_retries + 1):
+        try:
+            with ctx.scheduler.stage(stage) as limits:
+                return operation(limits)
+        except subprocess.CalledProcessError as e:
+            if attempt == ctx.args.isolate_retries:
+                raise
+            log_message(f"[{folder}] {what} failed ({failure_reason(e)}), attempt {attempt}/"
+                        f"{ctx.args.isolate_retries}; retrying in {delay:g}s", ctx.main_log, level="WARNING")
+            ctx.scheduler.cancelled.wait(delay)
+            delay *= 2
+
+# List a folder whose recursive listing failed, one subtree at a time
+# Each directory level is listed on its own and each subdirectory recursively, with
+# retries; a subdirectory that still fails is split into its own subdirectories, down
+# to the smallest subtrees that cannot be listed. Those are quarantined and everything
+# else ends up in the manifest as usual.
+# Returns ({relative_path: entry}, [quarantine entries]); raises CalledProcessError when
+# the top level of the folder itself cannot be listed
+def isolate_listing(ctx, folder, remote_path, stage):
+    files = {}
+    quarantined = []
+
+    def add(prefix, listed):
+        for path, entry in listed.items():
+            files[f"{prefix}/{path}" if prefix else path] = entry
+
+    def list_subtree(rel):
+        target = f"{remote_path}/{rel}" if rel else remote_path
+        try:
+            level_files, dirs = with_retries(ctx, folder, f"Listing '{rel or '.'}'", stage,
+                                             lambda limits: ctx.backend.list_level(target, limits))
+        except subprocess.CalledProcessError as e:
+            if not rel:
+                # Not even the folder's top level lists: nothing to isolate, the folder fails
+                raise
+            # This directory itself cannot be listed: the smallest failing subtree
+            quarantined.append({"path": rel or ".", "kind": "directory", "stage": "listing",
+                                "error": failure_reason(e)})
+            log_message(f"[{folder}] Quarantined directory '{rel or '.'}': {failure_reason(e)}",
+                        ctx.main_log, level="ERROR")
+            return
+        add(rel, level_files)
+        for name in dirs:
+            sub = f"{rel}/{name}" if rel else name
+            try:
+                add(sub, with_retries(ctx, folder, f"Listing '{sub}'", stage,
+                                      lambda limits: ctx.backend.list_files(f"{remote_path}/{sub}", limits,
+                                                                            stream=stream_folder(ctx, folder))))
+            except subprocess.CalledProcessError:
+                list_subtree(sub)
+
+    list_subtree("")
+    log_message(f"[{folder}] Isolated listing: {len(files)} files listed, {len(quarantined)} "
+                f"subtrees quarantined", ctx.main_log, level="WARNING" if quarantined else "SUCCESS")
+    return files, quarantined
+
+# Number of distinct directories in a manifest (what a recursive listing pays for)
+def manifest_dirs(manifest):
+    return len({path.rsplit("/", 1)[0] if "/" in path else "" for path in manifest["files"]})
+
+# Drop the cached manifest for one side of a folder (e.g. after copying into it)
+def invalidate_manifest(ctx, side, folder):
+    path = manifest_path(ctx, side, folder)
+    if os.path.exists(path):
+        os.remove(path)
+
+# Compare one source entry with its destination entry
+# Returns None when they match, otherwise a short reason
+def compare_entries(source_entry, dest_entry):
+    if dest_entry is None:
+        return "missing"
+    if source_entry["size"] != dest_entry["size"]:
+        return "size differs"
+    common = set(source_entry["hashes"]) & set(dest_entry["hashes"])
+    for hash_type in sorted(common):
+        if source_entry["hashes"][hash_type] != dest_entry["hashes"][hash_type]:
+            return f"{hash_type} hash differs"
+    return None
+
+# Diff two manifests: every source file that is missing or different on the destination
+def diff_manifests(source_manifest, dest_manifest):
+    dest_files = dest_manifest["files"]
+    plan = []
+    for path, entry in sorted(source_manifest["files"].items()):
+        reason = compare_entries(entry, dest_files.get(path))
+        if reason:
+            plan.append({"path": path, "size": entry["size"], "reason": reason})
+    return plan
+
+# Hash types present on both sides of a comparison (empty = size-only)
+def common_hash_types(source_manifest, dest_manifest):
+    def types(manifest):
+        found = set()
+        for entry in manifest["files"].values():
+            found.update(entry["hashes"])
+        return found
+    return sorted(types(source_manifest) & types(dest_manifest))
+
+# Write a --files-from-raw list (one path per line, no comment handling)
+def write_files_from(path, paths):
+    with open(path, "w", encoding="utf-8") as f:
+        for item in paths:
+            f.write(item + "\n")
+    return path
+
+# Best single hash for a manifest entry, as "type:value" ("" when the remote has none)
+def entry_hash(entry):
+    hashes = entry.get("hashes") or {}
+    for hash_type in ("dropbox", "sha256", "sha1", "md5"):
+        if hashes.get(hash_type):
+            return f"{hash_type}:{hashes[hash_type]}"
+    for hash_type, value in sorted(hashes.items()):
+        return f"{hash_type}:{value}"
+    return ""
+
+# Content-addressed view of the planned files of every folder in a run (--dedup)
+# Each distinct Dropbox content_hash is downloaded once, by the first planned path that
+# has it (its primary), unless a destination file already holds that content. The other
+# planned paths with the same hash are copied on the destination from there, so they
+# cost no Dropbox calls. Primaries are assigned in folder order, so a folder only ever
+# waits for folders started before it.
+class DedupIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.present = {}    # content hash -> destination path already holding it
+        self.primaries = {}  # content hash -> {"folder", "path", "dest", "done", "ok"}
+        self.hashes = {}     # (folder, relative path) -> content hash, for planned files
+        self.manifests = {}  # folder -> (source manifest, dest manifest or None) the index was built from
+        self.saved_files = 0
+        self.saved_bytes = 0
+
+    # Record the files of a folder whose destination copy already matches the source
+    # Only copies the journal has verified (by content) with the same source hash are used
+    # as copy sources: a listing match is names and sizes only, and a corrupted copy of
+    # the right size would spread to every duplicate. Returns how many were left out.
+    def add_present(self, dest_path, source_manifest, plan, verified):
+        planned = {item["path"] for item in plan}
+        unverified = 0
+        for path, entry in sorted(source_manifest["files"].items()):
+            content_hash = entry["hashes"].get("dropbox")
+            if not content_hash or entry["size"] <= 0 or path in planned:
+                continue
+            if verified.get(path) != entry_hash(entry):
+                unverified += 1
+                continue
+            self.present.setdefault(content_hash, f"{dest_path}/{path}")
+        return unverified
+
+    # Record a folder's planned files; call for each folder in processing order,
+    # after add_present for all of them
+    def add_plan(self, folder, dest_path, source_manifest, plan):
+        for item in plan:
+            entry = source_manifest["files"][item["path"]]
+            content_hash = entry["hashes"].get("dropbox")
+            if not content_hash or entry["size"] <= 0:
+                continue
+            self.hashes[(folder, item["path"])] = content_hash
+            if content_hash not in self.present and content_hash not in self.primaries:
+                self.primaries[content_hash] = {"folder": folder, "path": item["path"],
+                                                "dest": f"{dest_path}/{item['path']}",
+                                                "done": threading.Event(), "ok": False}
+
+    # True when a planned file's content is downloaded by another path or already on the destination
+    def is_duplicate(self, folder, path):
+        content_hash = self.hashes.get((folder, path))
+        if content_hash is None:
+            return False
+        primary = self.primaries.get(content_hash)
+        return not (primary and (primary["folder"], primary["path"]) == (folder, path))
+
+    # Split a folder's plan into (items to download, [(item, content hash)] to copy on the destination)
+    def split_plan(self, folder, plan):
+        download, local = [], []
+        for item in plan:
+            if self.is_duplicate(folder, item["path"]):
+                local.append((item, self.hashes[(folder, item["path"])]))
+            else:
+                download.append(item)
+        return download, local
+
+    # Mark a folder's primaries as downloaded (paths in copied) or not, and wake the
+    # folders waiting for them; later calls for the same folder change nothing
+    def finish_folder(self, folder, copied=()):
+        with self.lock:
+            for primary in self.primaries.values():
+                if primary["folder"] == folder and not primary["done"].is_set():
+                    primary["ok"] = primary["path"] in copied
+                    primary["done"].set()
+
+    # Destination path holding the content, waiting for its primary's download if needed;
+    # None when the primary was not downloaded
+    def source_for(self, content_hash):
+        if content_hash in self.present:
+            return self.present[content_hash]
+        primary = self.primaries[content_hash]
+        primary["done"].wait()
+        return primary["dest"] if primary["ok"] else None
+
+    def record_saving(self, size):
+        with self.lock:
+            self.saved_files += 1
+            self.saved_bytes += max(size, 0)
+
+# Persistent per-file transfer journal (SQLite under logs/)
+# Every source file of a run is recorded with its size, hash and state:
+#   planned  - needs to be copied
+#   copied   - copied in this run, not yet verified
+#   present  - already on the destination when the run planned the folder (the listings
+#              matched); not checked in this run unless a full check covers it
+#   verified - destination copy checked against the source
+# --resume <run-id> works from these rows alone, without listing the source tree again.
+class TransferJournal:
+    STATES = ("planned", "copied", "present", "verified")
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                started TEXT NOT NULL,
+                hostname TEXT,
+                subpath TEXT NOT NULL,
+                folders TEXT NOT NULL,
+                settings TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                run_id TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                state TEXT NOT NULL,
+                updated TEXT NOT NULL,
+                PRIMARY KEY (run_id, folder, path)
+            );
+            CREATE INDEX IF NOT EXISTS files_state ON files (run_id, folder, state);
+            CREATE TABLE IF NOT EXISTS full_checks (
+                folder TEXT NOT NULL,
+                checked_at REAL NOT NULL,
+                differences INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS folder_stats (
+                run_id TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                recorded_at REAL NOT NULL,
+                files INTEGER NOT NULL,
+                bytes INTEGER NOT NULL,
+                listing_dirs INTEGER NOT NULL,
+                copy_files INTEGER NOT NULL,
+                copy_bytes INTEGER NOT NULL,
+                verify_files INTEGER NOT NULL,
+                api_calls INTEGER NOT NULL,
+                listing_seconds REAL NOT NULL,
+                copy_seconds REAL NOT NULL,
+                verify_seconds REAL NOT NULL,
+                wall_seconds REAL NOT NULL,
+                tpslimit REAL NOT NULL,
+                bwlimit REAL NOT NULL,
+                transfers INTEGER NOT NULL,
+                checkers INTEGER NOT NULL,
+                backend TEXT NOT NULL
+            );
+        """)
+        self.db.commit()
+
+    def start_run(self, run_id, args, hostname):
+        settings = {k: v for k, v in vars(args).items() if k not in ("folders", "subpath", "resume")}
+        with self._lock:
+            self.db.execute(
+                "INSERT INTO runs (run_id, started, hostname, subpath, folders, settings) VALUES (?, ?, ?, ?, ?, ?)",
+                (run_id, datetime.datetime.now().isoformat(timespec="seconds"), hostname,
+                 args.subpath, json.dumps(args.folders), json.dumps(settings, default=str)))
+            self.db.commit()
+
+    # Return {"subpath", "folders", "settings"} for a run, or None if unknown
+    def load_run(self, run_id):
+        with self._lock:
+            row = self.db.execute("SELECT subpath, folders, settings FROM runs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        return {"subpath": row[0], "folders": json.loads(row[1]), "settings": json.loads(row[2])}
+
+    # Record the source manifest of a folder; files in the plan start as planned, the rest as present
+    def record_folder(self, run_id, folder, source_manifest, plan):
+        planned = {item["path"] for item in plan}
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        rows = [(run_id, folder, path, entry["size"], entry_hash(entry),
+                 "planned" if path in planned else "present", now)
+                for path, entry in source_manifest["files"].items()]
+        with self._lock:
+            self.db.executemany(
+                "INSERT INTO files (run_id, folder, path, size, hash, state, updated) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (run_id, folder, path) DO UPDATE SET size = excluded.size, hash = excluded.hash, "
+                "state = CASE WHEN files.state = 'verified' AND excluded.state = 'present' THEN 'verified' ELSE excluded.state END, "
+                "updated = excluded.updated", rows)
+            self.db.commit()
+
+    def mark(self, run_id, folder, paths, state):
+        if state not in self.STATES:
+            raise ValueError(f"Unknown journal state '{state}'")
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            self.db.executemany(
+                "UPDATE files SET state = ?, updated = ? WHERE run_id = ? AND folder = ? AND path = ?",
+                [(state, now, run_id, folder, path) for path in paths])
+            self.db.commit()
+
+    # Files of a folder copied or still to copy in this run and not verified yet, as
+    # {path: {"state", "size"}}; files that were present before the run are not included
+    def pending(self, run_id, folder):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT path, state, size FROM files WHERE run_id = ? AND folder = ? AND state IN ('planned', 'copied') "
+                "ORDER BY path",
+                (run_id, folder)).fetchall()
+        return {path: {"state": state, "size": size} for path, state, size in rows}
+
+    # Paths of a folder verified on the destination
+    def verified(self, run_id, folder):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT path FROM files WHERE run_id = ? AND folder = ? AND state = 'verified' ORDER BY path",
+                (run_id, folder)).fetchall()
+        return [path for path, in rows]
+
+    # {path: (state, hash)} of every file of a folder in a run
+    def states(self, run_id, folder):
+        with self._lock:
+            rows = self.db.execute("SELECT path, state, hash FROM files WHERE run_id = ? AND folder = ?",
+                                   (run_id, folder)).fetchall()
+        return {path: (state, content_hash) for path, state, content_hash in rows}
+
+    # {path: hash} of a folder's files (under subpath) whose destination copy was checked
+    # against the source in some run and not planned or copied again by a later one; the
+    # hash is the source content that was verified (see entry_hash)
+    def verified_anywhere(self, folder, subpath):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT files.path, files.hash, files.state FROM files JOIN runs ON runs.run_id = files.run_id "
+                "WHERE runs.subpath = ? AND files.folder = ? ORDER BY files.updated, runs.started",
+                (subpath, folder)).fetchall()
+        verified = {}
+        for path, content_hash, state in rows:
+            if state == "verified":
+                verified[path] = content_hash
+            elif state != "present":
+                verified.pop(path, None)
+        return verified
+
+    # {state: (files, bytes)} for a folder
+    def summary(self, run_id, folder):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT state, COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE run_id = ? AND folder = ? GROUP BY state",
+                (run_id, folder)).fetchall()
+        return {state: (count, size) for state, count, size in rows}
+
+    # Files the folder held in its last recorded run (folder is a folder_key), or None
+    def last_file_count(self, folder):
+        with self._lock:
+            row = self.db.execute("SELECT files FROM folder_stats WHERE folder = ? ORDER BY recorded_at DESC LIMIT 1",
+                                  (folder,)).fetchone()
+        return row[0] if row else None
+
+    # Remember a full-folder check (folder is a folder_key, so it includes the subpath)
+    def record_full_check(self, folder, differences):
+        with self._lock:
+            self.db.execute("INSERT INTO full_checks (folder, checked_at, differences) VALUES (?, ?, ?)",
+                            (folder, time.time(), differences))
+            self.db.commit()
+
+    # Epoch seconds of the last full check of a folder, or None
+    def last_full_check(self, folder):
+        with self._lock:
+            row = self.db.execute("SELECT MAX(checked_at) FROM full_checks WHERE folder = ?", (folder,)).fetchone()
+        return row[0]
+
+    # Remember one folder's work and timings for the planner (folder is a folder_key)
+    def record_folder_stats(self, run_id, folder, stats):
+        stats = dict(stats, run_id=run_id, folder=folder, recorded_at=time.time())
+        with self._lock:
+            self.db.execute(f"INSERT INTO folder_stats ({', '.join(stats)}) VALUES ({', '.join('?' * len(stats))})",
+                            list(stats.values()))
+            self.db.commit()
+
+    # Every recorded folder run, oldest first, as dicts
+    def folder_history(self):
+        with self._lock:
+            cursor = self.db.execute("SELECT * FROM folder_stats ORDER BY recorded_at")
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+# Parse one rclone --use-json-log line; returns the event dict or None for plain text
+def parse_rclone_event(line):
+    line = line.strip()
+    if not line.startswith("{"):
+        return None
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    return event if isinstance(event, dict) else None
+
+# Relative path of a file rclone reports as copied, or None for any other event
+def copied_object(event):
+    if event and str(event.get("msg", "")).startswith("Copied") and event.get("object"):
+        return event["object"]
+    return None
+
+# Transfer a single folder: mkdir, size, dry run, copy and verification
+def process_folder(folder, ctx):
+    args = ctx.args
+    main_log = ctx.main_log
+    full_source_base = ctx.full_source_base
+    full_dest_base = ctx.full_dest_base
+    scheduler = ctx.scheduler
+
+    folder_start_time = time.time()
+    folder_log = f"{ctx.log_dir}/{folder.replace(' ', '_')}-{ctx.timestamp}.log"
+
+    log_message("\n" + "="*80, main_log)
+    log_message(f"STARTING PROCESS FOR: {folder}", main_log)
+    log_message("="*80, main_log)
+
+    # Create destination directory if it doesn't exist
+    try:
+        with scheduler.stage("listing") as limits:
+            ctx.backend.mkdir(f"{full_dest_base}/{folder}", limits)
+        log_message(f"Destination folder created/verified: {folder}", main_log)
+    except subprocess.CalledProcessError as e:
+        log_message(f"ERROR creating destination folder: {str(e)}", main_log, level="ERROR")
+        log_message("Skipping this folder for safety.", main_log, level="WARNING")
+        return
+
+    source_path = f"{full_source_base}/{folder}"
+    dest_path = f"{full_dest_base}/{folder}"
+
+    # Check source folder contents
+    try:
+        # One listing per side; size, dry run, copy and verification all read from it
+        # With --dedup the index was built from these listings already: take them over, so
+        # the folder is not listed twice and its plan is the one the index was built for
+        source_manifest, dest_manifest = ctx.dedup.manifests.pop(folder, (None, None)) if ctx.dedup else (None, None)
+        if source_manifest is None:
+            source_manifest = get_manifest(ctx, "source", folder, source_path)
+        if dest_manifest is None:
+            dest_manifest = get_manifest(ctx, "dest", folder, dest_path)
+        total_bytes = sum(entry["size"] for entry in source_manifest["files"].values() if entry["size"] > 0)
+        total_count = len(source_manifest["files"])
+
+        # Log the folder size
+        log_message(f"[{folder}] Folder contains {total_count} files totaling {format_size(total_bytes)}", main_log)
+        # Subtrees the source listing could not reach; they stay out of the plan and the checks
+        quarantined = list(source_manifest.get("quarantined") or [])
+
+        # DRY RUN first: the plan is the diff of the two manifests
+        log_message(f"\nStarting DRY RUN for {folder}...", main_log)
+        plan = diff_manifests(source_manifest, dest_manifest)
+        plan_bytes = sum(item["size"] for item in plan if item["size"] > 0)
+        hash_types = common_hash_types(source_manifest, dest_manifest)
+
+        # Log the dry run plan
+        log_message("\n--- DRY RUN OUTPUT ---", main_log, also_print=False)
+        log_writer.write(folder_log, "\n--- DRY RUN PLAN ---\n")
+        for item in plan:
+            log_writer.write(folder_log, f"{item['reason']}: {item['path']} ({format_size(max(item['size'], 0))})\n")
+        log_writer.write(folder_log, "\n--- END DRY RUN PLAN ---\n")
+
+        ctx.journal.record_folder(ctx.run_id, folder, source_manifest, plan)
+        listing_seconds = time.time() - folder_start_time
+
+        # Show a summary
+        new_count = sum(1 for item in plan if item["reason"] == "missing")
+        log_message(f"[{folder}] Dry run summary: {len(plan)} of {total_count} files to copy "
+                    f"({format_size(plan_bytes)}; {new_count} new, {len(plan) - new_count} changed; "
+                    f"compared by size{' + ' + ', '.join(hash_types) if hash_types else ' only'})", main_log)
+        local = ctx.dedup.split_plan(folder, plan)[1] if ctx.dedup else []
+        if local:
+            log_message(f"[{folder}] Dedup: {len(local)} planned files ({format_size(sum(max(item['size'], 0) for item, _ in local))}) "
+                        f"have their content elsewhere and will be copied on the destination", main_log)
+        log_message(f"[{folder}] DRY RUN completed - NO FILES WERE TRANSFERRED", main_log)
+        log_message("Review the logs in the 'logs' folder carefully.", main_log)
+
+        # If dry-run-only flag is set, skip the actual transfer
+        if args.dry_run_only:
+            log_message(f"Skipping actual transfer for {folder} (--dry-run-only specified)", main_log)
+            if quarantined:
+                write_quarantine_report(ctx, folder, quarantined, folder_log)
+            return
+
+        # Ask for confirmation unless --yes was specified
+        if not args.yes:
+            with ctx.prompt_lock:
+                proceed = input(f"\nDo you want to proceed with the actual transfer of '{folder}'? (yes/no): ")
+            log_message(f"User chose to {'proceed' if proceed.lower() == 'yes' else 'cancel'} the transfer.", main_log)
+
+            if proceed.lower() != "yes":
+                log_message(f"Skipping actual transfer for {folder} based on user decision", main_log)
+                return
+
+        log_message(f"\nSTARTING ACTUAL TRANSFER for {folder}...", main_log)
+
+        try:
+            copy_start = time.time()
+            copied = []
+            deduped = set()
+            results = {}
+            sampled = 0
+            if not plan:
+                log_message(f"[{folder}] Nothing to copy - destination already matches the source manifest", main_log)
+            else:
+                download, local = ctx.dedup.split_plan(folder, plan) if ctx.dedup else (plan, [])
+                if download:
+                    _, copied, copy_quarantined = copy_isolating(ctx, folder, source_path, dest_path, download, folder_log)
+                    quarantined += copy_quarantined
+                if ctx.dedup:
+                    ctx.dedup.finish_folder(folder, set(copied))
+                if local:
+                    local_copied, fallback = copy_duplicates(ctx, folder, dest_path, local, folder_log)
+                    copied += local_copied
+                    deduped.update(local_copied)
+                    if fallback:
+                        # No destination copy to start from; download these like any other file
+                        _, fallback_copied, copy_quarantined = copy_isolating(ctx, folder, source_path, dest_path,
+                                                                              fallback, folder_log)
+                        copied += fallback_copied
+                        quarantined += copy_quarantined
+                # The destination changed; its cached listing is stale now
+                invalidate_manifest(ctx, "dest", folder)
+            verify_start = time.time()
+
+            # Skip verification if requested
+            mode = None if args.no_verify else verification_mode(ctx, folder)
+            if args.no_verify:
+                log_message("Skipping verification (--no-verify specified)", main_log)
+            elif mode == "full":
+                results = full_verification(ctx, folder, source_path, dest_path, source_manifest, quarantined, folder_log)
+            elif mode == "sample":
+                # Sample check: names and sizes of every file, checksums of a stratified sample
+                log_message(f"\nStarting sample verification of {folder}...", main_log)
+                results, sample = sample_verification(ctx, folder, source_path, dest_path, source_manifest,
+                                                      quarantined_files(quarantined), folder_log)
+                sampled = sample["sample"]
+                if sample["sample_failures"]:
+                    log_message(f"[{folder}] {sample['sample_failures']} sampled files failed the comparison - "
+                                f"escalating to a full check", main_log, level="WARNING")
+                    mode = "full"
+                    failed = {path: status for path, status in results.items()
+                              if status not in ("match", "size match", "quarantined")}
+                    results = full_verification(ctx, folder, source_path, dest_path, source_manifest, quarantined,
+                                                folder_log, {"escalated_from": sample}, failed)
+                elif sample["achieved_confidence"] is None:
+                    finish_verification(ctx, folder, "sample", results, folder_log,
+                                        f"size listing + sampled {sample['method']}", {"sample": sample})
+                    log_message(f"[{folder}] The sample was only compared by size (no common hash); "
+                                f"no confidence can be stated for this folder", main_log, level="WARNING")
+                else:
+                    finish_verification(ctx, folder, "sample", results, folder_log,
+                                        f"size listing + sampled {sample['method']}", {"sample": sample})
+                    log_message(f"[{folder}] Sample of {sample['sample']} files clean: fewer than "
+                                f"{sample['error_rate']:.2%} of {sample['population']} files differ with "
+                                f"{sample['achieved_confidence']:.2%} confidence", main_log)
+            else:
+                # Incremental check: only the files rclone reported as copied in this run, read back
+                # and compared byte for byte (Dropbox and the NAS share no hash to compare)
+                log_message(f"\nStarting incremental verification of {folder} ({len(copied)} copied files)...", main_log)
+                results, method = check_paths(ctx, folder, source_path, dest_path, copied, folder_log, download=True)
+                skipped = quarantined_files(quarantined)
+                for item in plan:
+                    results.setdefault(item["path"], "quarantined" if item["path"] in skipped else "not copied")
+                finish_verification(ctx, folder, "incremental", results, folder_log, check_method(method))
+
+            # Feed the planner's history: work done per stage and how long each stage took
+            fresh_listing = source_manifest["taken_at"] >= folder_start_time
+            downloaded = [path for path in copied if path not in deduped]
+            tps, bw = folder_limits(ctx)
+            ctx.journal.record_folder_stats(ctx.run_id, folder_key(folder, args.subpath), {
+                "files": total_count,
+                "bytes": total_bytes,
+                "listing_dirs": manifest_dirs(source_manifest) if fresh_listing else 0,
+                "copy_files": len(downloaded),
+                "copy_bytes": sum(max(source_manifest["files"][path]["size"], 0) for path in downloaded
+                                  if path in source_manifest["files"]),
+                "verify_files": len(results),
+                # Dropbox calls, estimated: one per directory listed, per file downloaded and per file checked
+                "api_calls": (manifest_dirs(source_manifest) if fresh_listing else 0) + len(downloaded) +
+                             (len(results) if mode in ("incremental", "full") else sampled),
+                "listing_seconds": listing_seconds,
+                "copy_seconds": verify_start - copy_start,
+                "verify_seconds": time.time() - verify_start,
+                "wall_seconds": listing_seconds + time.time() - copy_start,
+                "tpslimit": tps,
+                "bwlimit": bw,
+                "transfers": args.transfers,
+                "checkers": args.checkers,
+                "backend": ctx.backend.name,
+            })
+            if quarantined:
+                write_quarantine_report(ctx, folder, quarantined, folder_log)
+
+            if args.s3_remote:
+                queue_verified_upload(ctx, folder, None if args.no_verify else results, folder_log)
+
+        except KeyboardInterrupt:
+            log_message("\nTransfer interrupted by user (Ctrl+C)", main_log, level="WARNING")
+            log_message(f"The transfer can be resumed with: --resume {ctx.run_id}", main_log)
+            log_message("Only files not yet verified in the transfer journal will be copied and checked.", main_log)
+            raise
+        except Exception as e:
+            log_message(f"Error during transfer: {str(e)}", main_log, level="ERROR")
+
+        # Calculate and log timing
+        folder_duration = time.time() - folder_start_time
+        minutes, seconds = divmod(folder_duration, 60)
+        hours, minutes = divmod(minutes, 60)
+
+        log_message(f"\n[{folder}] Time taken: {int(hours)}h {int(minutes)}m {int(seconds)}s", main_log)
+        if plan_bytes > 0 and folder_duration > 0:
+            transfer_rate = plan_bytes / folder_duration / (1024 * 1024)  # MB/s
+            log_message(f"[{folder}] Average transfer rate: {transfer_rate:.2f} MB/s", main_log)
+
+    except KeyboardInterrupt:
+        raise
+    except subprocess.CalledProcessError as e:
+        log_message(f"[{folder}] Listing failed: {failure_reason(e)} - folder not transferred", main_log, level="ERROR")
+        log_message("Continuing to next folder for safety.", main_log, level="WARNING")
+    except Exception as e:
+        log_message(f"Unexpected error processing folder {folder}: {str(e)}", main_log, level="ERROR")
+        log_message("Continuing to next folder for safety.", main_log, level="WARNING")
+
+# Resume a journaled folder: copy what is still planned, then verify everything not yet verified
+# Works from the journal rows only; neither side of the folder is listed again.
+def resume_folder(folder, ctx):
+    args = ctx.args
+    main_log = ctx.main_log
+    source_path = f"{ctx.full_source_base}/{folder}"
+    dest_path = f"{ctx.full_dest_base}/{folder}"
+    folder_log = f"{ctx.log_dir}/{folder.replace(' ', '_')}-{ctx.timestamp}.log"
+
+    log_message("\n" + "="*80, main_log)
+    log_message(f"RESUMING PROCESS FOR: {folder}", main_log)
+    log_message("="*80, main_log)
+
+    summary = ctx.journal.summary(ctx.run_id, folder)
+    if not summary:
+        # The original run stopped before this folder was planned
+        log_message(f"[{folder}] Not in the journal yet - processing from scratch", main_log)
+        process_folder(folder, ctx)
+        return
+
+    for state in TransferJournal.STATES:
+        count, size = summary.get(state, (0, 0))
+        log_message(f"[{folder}] {state}: {count} files ({format_size(size)})", main_log)
+
+    pending = ctx.journal.pending(ctx.run_id, folder)
+    if not pending:
+        log_message(f"[{folder}] Every file copied in this run is verified - nothing to do", main_log, level="SUCCESS")
+        if args.s3_remote and not args.dry_run_only:
+            # The run may have stopped before the folder's upload was queued or finished
+            queue_verified_upload(ctx, folder, {}, folder_log)
+        return
+    to_copy = [{"path": path, "size": item["size"]} for path, item in pending.items() if item["state"] == "planned"]
+
+    if args.dry_run_only:
+        log_message(f"Skipping actual transfer for {folder} (--dry-run-only specified)", main_log)
+        return
+
+    if not args.yes:
+        with ctx.prompt_lock:
+            proceed = input(f"\nDo you want to resume the transfer of '{folder}' ({len(to_copy)} files to copy)? (yes/no): ")
+        log_message(f"User chose to {'proceed' if proceed.lower() == 'yes' else 'cancel'} the transfer.", main_log)
+        if proceed.lower() != "yes":
+            log_message(f"Skipping {folder} based on user decision", main_log)
+            return
+
+    try:
+        quarantined = []
+        if to_copy:
+            try:
+                _, _, quarantined = copy_isolating(ctx, folder, source_path, dest_path, to_copy, folder_log)
+            finally:
+                # The destination changed, even if the copy was interrupted; its cached listing is stale now
+                invalidate_manifest(ctx, "dest", folder)
+        if quarantined:
+            write_quarantine_report(ctx, folder, quarantined, folder_log)
+
+        if args.no_verify:
+            log_message("Skipping verification (--no-verify specified)", main_log)
+            if args.s3_remote:
+                queue_verified_upload(ctx, folder, None, folder_log)
+            return
+
+        skipped = quarantined_files(quarantined)
+        log_message(f"\nVerifying {len(pending) - len(skipped)} unverified files of {folder}...", main_log)
+        results, method = check_paths(ctx, folder, source_path, dest_path, sorted(set(pending) - skipped), folder_log,
+                                      download=True)
+        results.update((path, "quarantined") for path in skipped)
+        if not finish_verification(ctx, folder, "resume", results, folder_log, check_method(method)):
+            log_message(f"[{folder}] Resume again to retry the files that did not verify", main_log, level="WARNING")
+        if args.s3_remote:
+            queue_verified_upload(ctx, folder, results, folder_log)
+    except KeyboardInterrupt:
+        log_message("\nTransfer interrupted by user (Ctrl+C)", main_log, level="WARNING")
+        log_message(f"The transfer can be resumed with: --resume {ctx.run_id}", main_log)
+        raise
+    except Exception as e:
+        log_message(f"Error resuming folder {folder}: {str(e)}", main_log, level="ERROR")
+
+# Check a list of files with 'rclone check --combined'; returns ({path: status}, method)
+# Status characters follow rclone: "=" match, "-" missing on destination,
+# "+" missing on source, "*" different, "!" error while checking.
+def check_files(ctx, folder, source_path, dest_path, paths, folder_log, download=False):
+    base = os.path.join(ctx.log_dir, f"{folder_key(folder, ctx.args.subpath)}-{ctx.timestamp}-check")
+    files_from = write_files_from(base + ".files", paths)
+    combined = base + ".combined"
+    log_writer.write(folder_log, "\n--- VERIFICATION RESULTS ---\n")
+    with ctx.scheduler.stage("verify") as limits:
+        results, method = ctx.backend.check(source_path, dest_path, files_from, combined,
+                                            ctx.args.checkers, limits, ctx.main_log, folder_log, download,
+                                            stream=len(paths) > ctx.args.stream_above)
+    log_writer.write(folder_log, "\n--- END VERIFICATION RESULTS ---\n")
+    return results, method
+
+# rclone check --combined status characters
+CHECK_STATUS = {"=": "match", "-": "missing", "+": "extra", "*": "differ", "!": "error"}
+
+# Check the given paths; returns ({path: status word}, method) where paths rclone did not
+# report are "error" and method is how rclone compared them (see check_method). When
+# rclone could only compare sizes, its matches are "size match": never journal-verified.
+def check_paths(ctx, folder, source_path, dest_path, paths, folder_log, download=False):
+    if not paths:
+        return {}, "download" if download else "none"
+    combined, method = check_files(ctx, folder, source_path, dest_path, sorted(paths), folder_log, download)
+    results = {path: CHECK_STATUS.get(combined.get(path), "error") for path in paths}
+    if method == "none":
+        results = {path: "size match" if status == "match" else status for path, status in results.items()}
+    return results, method
+
+# Describe how rclone check compared the files for the reports: "download" (both copies
+# read and compared byte for byte), a hash type both remotes have, or "none": Dropbox and
+# the NAS share no hash, so without --download rclone check only compares sizes
+def check_method(method):
+    if method == "download":
+        return "rclone check --download (content)"
+    if method == "none":
+        return "rclone check (size only, no common hash)"
+    return f"rclone check ({method})"
+
+# Full-folder results from a source manifest and a fresh destination manifest
+def full_check_results(source_manifest, dest_manifest):
+    results = {path: "match" for path in source_manifest["files"]}
+    for item in diff_manifests(source_manifest, dest_manifest):
+        results[item["path"]] = "missing" if item["reason"] == "missing" else "differ"
+    return results
+
+# Full check: a fresh destination listing (names and sizes) against the whole source
+# manifest, then every file that matches by size is compared byte for byte with rclone
+# check --download: Dropbox and the NAS share no hash type, so sizes alone would let a
+# corrupted copy of the right length pass. The destination is always listed again, never
+# taken from the manifest cache, so a full check (and the --full-check-every schedule it
+# satisfies) always reads the NAS.
+# extra goes into the report (e.g. the sample that escalated to this check); failed holds
+# files an earlier content comparison already found different, which are not read again
+def full_verification(ctx, folder, source_path, dest_path, source_manifest, quarantined, folder_log,
+                      extra=None, failed=None):
+    log_message(f"\nStarting full verification of {folder}...", ctx.main_log)
+    dest_manifest = get_manifest(ctx, "dest", folder, dest_path, refresh=True, stage="verify")
+    results = full_check_results(source_manifest, dest_manifest)
+    for path, status in (failed or {}).items():
+        if results.get(path) == "match":
+            results[path] = status
+    skipped = quarantined_files(quarantined)
+    size_matched = [path for path, status in results.items() if status == "match" and path not in skipped]
+    log_message(f"[{folder}] {len(size_matched)} files match by size; comparing their content", ctx.main_log)
+    content, method = check_paths(ctx, folder, source_path, dest_path, size_matched, folder_log, download=True)
+    results.update(content)
+    for path in skipped:
+        results[path] = "quarantined"
+    ctx.journal.record_full_check(folder_key(folder, ctx.args.subpath),
+                                  sum(1 for status in results.values() if status != "match"))
+    finish_verification(ctx, folder, "full", results, folder_log, f"size listing + {check_method(method)}", extra)
+    return results
+
+# Sample check of a whole folder
+# Every file is compared by name and size against a fresh destination listing taken
+# without hashes (the NAS reads no file content), then a reproducible random sample of
+# the size-matching files, stratified by size band and top-level subdirectory, is
+# compared byte for byte with rclone check --download: Dropbox and the NAS share no hash
+# type, so a plain check would compare sizes again. Unsampled files that match by size
+# are "size match". A sample rclone could only compare by size (achieved_confidence
+# None) stays "size match" too, and no confidence is claimed for it.
+# Returns ({path: status}, sample details for the report)
+def sample_verification(ctx, folder, source_path, dest_path, source_manifest, skipped, folder_log):
+    args = ctx.args
+    log_message(f"[{folder}] Listing dest (names and sizes): {dest_path}", ctx.main_log)
+    with ctx.scheduler.stage("verify") as limits:
+        dest_files = ctx.backend.list_files(dest_path, limits, hashes=False, stream=stream_folder(ctx, folder))
+
+    results = {}
+    population = []
+    for path, entry in source_manifest["files"].items():
+        dest_entry = dest_files.get(path)
+        if path in skipped:
+            results[path] = "quarantined"
+        elif dest_entry is None:
+            results[path] = "missing"
+        elif entry["size"] >= 0 and dest_entry["size"] >= 0 and entry["size"] != dest_entry["size"]:
+            results[path] = "differ"
+        else:
+            results[path] = "size match"
+            population.append({"path": path, "size": entry["size"]})
+
+    seed = f"{args.sample_seed}:{folder_key(folder, args.subpath)}" if args.sample_seed else folder_key(folder, args.subpath)
+    target = sample_size(len(population), args.sample_confidence, args.sample_error_rate)
+    sample, strata = stratified_sample(population, target, ctx.bands, seed)
+    log_message(f"[{folder}] Downloading a sample of {len(sample)} of {len(population)} files to compare "
+                f"their content ({strata} strata, seed '{seed}')", ctx.main_log)
+    checked, method = check_paths(ctx, folder, source_path, dest_path, [item["path"] for item in sample],
+                                  folder_log, download=True)
+    results.update(checked)
+
+    failures = sum(1 for status in checked.values() if status not in ("match", "size match"))
+    return results, {
+        "method": check_method(method),
+        "population": len(population),
+        "sample": len(sample),
+        "strata": strata,
+        "seed": seed,
+        "confidence_target": args.sample_confidence,
+        "error_rate": args.sample_error_rate,
+        "sample_failures": failures,
+        "achieved_confidence": None if method == "none" else 0.0 if failures else
+            round(1 - miss_probability(len(population), len(sample), args.sample_error_rate), 6),
+    }
+
+# Probability that a clean random sample of `sample` files misses every bad file when
+# error_rate of the population (at least one file) is bad; sampling without replacement
+def miss_probability(population, sample, error_rate):
+    bad = max(1, math.ceil(error_rate * population))
+    miss = 1.0
+    for drawn in range(min(sample, population)):
+        miss *= max(0, population - bad - drawn) / (population - drawn)
+    return miss
+
+# Smallest sample whose clean result shows, with `confidence`, that fewer than
+# error_rate of the population differ
+def sample_size(population, confidence, error_rate):
+    bad = max(1, math.ceil(error_rate * population))
+    size, miss = 0, 1.0
+    while size < population and 1 - miss < confidence:
+        miss *= max(0, population - bad - size) / (population - size)
+        size += 1
+    return size
+
+# Draw about `target` items, spread over strata of (size band, top-level subdirectory)
+# in proportion to their size, at least one per stratum so every part of the tree is
+# looked at. The same seed and population always give the same sample.
+# Returns (sampled items, number of strata)
+def stratified_sample(population, target, bands, seed):
+    if not population or target <= 0:
+        return [], 0
+    rng = random.Random(seed)
+    strata = {}
+    for band, files in split_into_shards(population, bands):
+        for item in files:
+            top = item["path"].split("/", 1)[0] if "/" in item["path"] else "."
+            strata.setdefault((band["name"], top), []).append(item)
+    sample = []
+    for key in sorted(strata):
+        members = sorted(strata[key], key=lambda item: item["path"])
+        share = max(1, math.ceil(target * len(members) / len(population)))
+        sample += rng.sample(members, min(share, len(members)))
+    return sample, len(strata)
+
+# Pick the verification mode for a folder: --verify-mode, or a scheduled full check
+# when the last full check of the folder is older than --full-check-every days
+def verification_mode(ctx, folder):
+    args = ctx.args
+    if args.verify_mode == "full" or args.full_check_every <= 0:
+        return args.verify_mode
+    last = ctx.journal.last_full_check(folder_key(folder, args.subpath))
+    if last is None or time.time() - last > args.full_check_every * 86400:
+        log_message(f"[{folder}] Scheduled full check (last full check: "
+                    f"{datetime.datetime.fromtimestamp(last).strftime('%Y-%m-%d') if last else 'never'})", ctx.main_log)
+        return "full"
+    return args.verify_mode
+
+# Write the per-file verification report, update the journal and log the outcome
+# Returns True when every checked file matched.
+def finish_verification(ctx, folder, mode, results, folder_log, method, extra=None):
+    summary = {}
+    for status in results.values():
+        summary[status] = summary.get(status, 0) + 1
+    report = {
+        "folder": folder,
+        "subpath": ctx.args.subpath,
+        "run_id": ctx.run_id,
+        "mode": mode,
+        "method": method,
+        "checked_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "summary": summary,
+        "files": [{"path": path, "status": status} for path, status in sorted(results.items())],
+    }
+    report.update(extra or {})
+    report_path = os.path.join(ctx.log_dir, f"{folder_key(folder, ctx.args.subpath)}-{ctx.timestamp}-verify.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    # Quarantined files were left out on purpose: reported, kept planned, not counted as differences.
+    # "size match" files (outside a verification sample) keep their journal state.
+    failed = sorted(path for path, status in results.items() if status not in ("match", "size match", "quarantined"))
+    ctx.journal.mark(ctx.run_id, folder, [path for path, status in results.items() if status == "match"], "verified")
+    ctx.journal.mark(ctx.run_id, folder, [path for path, status in results.items()
+                                          if status not in ("match", "size match")], "planned")
+
+    log_writer.write(folder_log, f"\n--- VERIFICATION SUMMARY ({mode}, {method}) ---\n")
+    for path in failed:
+        log_writer.write(folder_log, f"{results[path]}: {path}\n")
+    log_writer.write(folder_log, f"{len(results)} checked, {len(failed)} differences found\nReport: {report_path}\n")
+
+    counts = ", ".join(f"{count} {status}" for status, count in sorted(summary.items())) or "nothing to check"
+    if not failed:
+        log_message(f"[{folder}] Verification passed ({mode}: {counts})", ctx.main_log, level="SUCCESS")
+    else:
+        log_message(f"[{folder}] Verification found {len(failed)} differences ({mode}: {counts}), see {report_path}",
+                    ctx.main_log, level="ERROR")
+    return not failed
+
+# Find a free local TCP port for an rclone remote-control listener
+def free_local_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# rc listener for one rclone process: 127.0.0.1 on a free port, with a random user and
+# password for this run. The credentials go to rclone through its environment
+# (RCLONE_RC_USER/RCLONE_RC_PASS), so they never show in ps or in the logged commands.
+# Returns (rc address, environment for the rclone process, client)
+def rc_listener():
+    rc_addr = f"127.0.0.1:{free_local_port()}"
+    user, password = f"batch-{secrets.token_hex(4)}", secrets.token_urlsafe(24)
+    env = dict(os.environ, RCLONE_RC_USER=user, RCLONE_RC_PASS=password)
+    return rc_addr, env, RcClient(f"http://{rc_addr}", user, password)
+
+# Minimal client for rclone's remote-control (rc) HTTP API
+class RcClient:
+    def __init__(self, url, user=None, password=None, timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.headers = {"Content-Type": "application/json"}
+        if user:
+            token = base64.b64encode(f"{user}:{password}".encode("utf-8")).decode("ascii")
+            self.headers["Authorization"] = f"Basic {token}"
+
+    def call(self, method, params=None):
+        request = urllib.request.Request(
+            f"{self.url}/{method}",
+            data=json.dumps(params or {}).encode("utf-8"),
+            headers=self.headers,
+            method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode("utf-8") or "{}")
+        except urllib.error.HTTPError as e:
+            # rc reports failures as JSON with an "error" field
+            try:
+                detail = json.loads(e.read().decode("utf-8")).get("error", str(e))
+            except ValueError:
+                detail = str(e)
+            raise RuntimeError(f"rc {method} failed: {detail}")
+
+# rclone execution backends
+# SubprocessBackend runs one rclone process per operation (the original behaviour).
+# RcdBackend starts one 'rclone rcd' daemon per run and issues every operation as an
+# rc job, so the config, Dropbox/DS423 sessions, connection pools and directory cache
+# stay warm across folders. Both expose the same calls; failures surface as
+# subprocess.CalledProcessError either way, so callers handle one exception type.
+class SubprocessBackend:
+    name = "subprocess"
+    daemon = False
+
+    def lsd(self, remote):
+        subprocess.run([RCLONE, "lsd", remote], check=True, capture_output=True)
+
+    def mkdir(self, path, limits):
+        subprocess.run([RCLONE, "mkdir", path] + limits, check=True, capture_output=True)
+
+    # Always streamed, so stream is ignored
+    def list_files(self, remote_path, limits, hashes=True, files_from=None, stream=True):
+        return list_remote(remote_path, limits, hashes, files_from)
+
+    def list_level(self, remote_path, limits):
+        return list_remote_level(remote_path, limits)
+
+    # rclone check of the files in files_from, --combined report written to combined
+    # rclone's output is streamed into the folder log; returns ({path: status char}, method)
+    # with download, rclone reads both copies and compares the bytes (see check_method)
+    def check(self, source_path, dest_path, files_from, combined, checkers, limits, main_log, folder_log,
+              download=False, stream=True):
+        verify_cmd = [
+            RCLONE, "check",
+            source_path,
+            dest_path,
+            "--one-way",
+            f"--files-from-raw={files_from}",
+            f"--combined={combined}",
+            f"--checkers={checkers}",
+            *(["--download"] if download else []),
+            *limits,
+            # -v for the "Using <hash> for hash comparisons" line
+            "-v"
+        ]
+        log_message(f"Verification command: {' '.join(verify_cmd)}", main_log)
+        run = StreamingRun(verify_cmd).start()
+        method = "download" if download else "none"
+        for stream, line in run.lines():
+            log_writer.write(folder_log, f"{'VERIFICATION ERROR: ' if stream == 'stderr' else ''}{line}\n")
+            match = re.search(r"Using (\S+) for hash comparisons", line)
+            if match and not download:
+                method = match.group(1)
+        results = {}
+        if os.path.exists(combined):
+            with open(combined, "r", encoding="utf-8") as f:
+                results = parse_combined(f)
+        return results, method
+
+    # Copy one file to another path; both on the destination remote, so no Dropbox calls
+    def copy_file(self, source, dest):
+        subprocess.run([RCLONE, "copyto", source, dest], check=True, capture_output=True)
+
+    # Ctrl+C reaches the rclone children directly (same process group); nothing to stop
+    def stop_jobs(self):
+        return 0
+
+    # A copy of the files in files_from as its own rclone process
+    def copy(self, source_path, dest_path, files_from, config, limits, stats_interval, group, rc=False):
+        cmd = [
+            RCLONE, "copy",
+            source_path,
+            dest_path,
+            f"--files-from-raw={files_from}",
+            "--no-traverse",
+            "--checksum",
+            *(f"--{key}={value}" for key, value in config.items()),
+            *limits,
+            # JSON stats every interval drive the metrics; per-file lines feed the journal
+            f"--stats={stats_interval:g}s",
+            "-v",
+            "--use-json-log"
+        ]
+        client = env = None
+        if rc:
+            rc_addr, env, client = rc_listener()
+            cmd += ["--rc", f"--rc-addr={rc_addr}"]
+        return SubprocessTransfer(cmd, client, env)
+
+    def close(self):
+        pass
+
+# One running 'rclone copy' process, read through its JSON log
+class SubprocessTransfer:
+    def __init__(self, cmd, rc=None, env=None):
+        self.command = cmd
+        self.rc = rc
+        self.run = StreamingRun(cmd, env=env)
+        # Last few rclone errors, for the failure summary
+        self.errors = collections.deque(maxlen=5)
+
+    def start(self):
+        self.run.start()
+
+    # rclone JSON log events (stdout and stderr); every line also goes to the folder logs
+    def events(self, folder_log):
+        for _, line in self.run.lines():
+            if not line.strip():
+                continue
+            event = parse_rclone_event(line)
+            if event is None:
+                log_writer.write(folder_log, line + "\n")
+                continue
+            log_rclone_event(folder_log, event, self.errors)
+            yield event
+
+    # Ctrl+C reaches the rclone child directly; nothing to cancel here
+    def stop(self):
+        pass
+
+    def wait(self):
+        return self.run.wait()
+
+# Send one rclone event to the folder's JSONL log, with a readable line in the plain log
+# Stats snapshots only go to the JSONL log; they drive the display and metrics instead.
+def log_rclone_event(folder_log, event, errors=None):
+    log_writer.write_json(jsonl_path(folder_log), event)
+    if "stats" in event:
+        return
+    level = str(event.get("level", "info")).upper()
+    subject = f"{event['object']}: " if event.get("object") else ""
+    log_writer.write(folder_log, f"{event.get('time', '')} {level:<7} {subject}{event.get('msg', '')}\n")
+    if errors is not None and level == "ERROR":
+        errors.append(f"{subject}{event.get('msg', '')}")
+
+# rclone check --combined lines ("= path") as {path: status char}
+def parse_combined(lines):
+    results = {}
+    for line in lines:
+        line = line.rstrip("\n")
+        if len(line) > 2 and line[1] == " ":
+            results[line[2:]] = line[0]
+    return results
+
+# rc _config name for a command-line flag: "multi-thread-streams" -> "MultiThreadStreams"
+def rc_option(flag, value):
+    name = "".join(part.capitalize() for part in flag.split("-"))
+    value = str(value)
+    if value.lower() in ("true", "false"):
+        return name, value.lower() == "true"
+    return name, int(value) if value.isdigit() else value
+
+class RcdBackend:
+    name = "rcd"
+    daemon = True
+
+    # Start the daemon with the whole --tpslimit/--bwlimit budget: every job shares its
+    # single token bucket and bandwidth limiter, so no per-process split is needed
+    def __init__(self, args, log_dir, timestamp, startup_timeout=30):
+        self.log_file = os.path.join(log_dir, f"rcd-{timestamp}.log")
+        # Local only, and authenticated: any local user could otherwise drive the daemon's
+        # Dropbox and DS423 sessions (see rc_listener)
+        rc_addr, env, self.rc = rc_listener()
+        # Listings and checks of large folders (see list_files)
+        self.streamed = SubprocessBackend()
+        cmd = [RCLONE, "rcd", f"--rc-addr={rc_addr}", f"--bwlimit={args.bwlimit}", "-v"]
+        if args.tpslimit > 0:
+            cmd.append(f"--tpslimit={args.tpslimit:g}")
+        self.command = cmd
+        # rc job ids still running, so an interrupted run can stop them (see stop_jobs)
+        self.active_jobs = set()
+        self.stopping = False
+        self._jobs_lock = threading.Lock()
+        self._log = open(self.log_file, "ab")
+        # Own session: Ctrl+C must not kill the daemon before running jobs are stopped
+        self.process = subprocess.Popen(cmd, stdout=self._log, stderr=subprocess.STDOUT, start_new_session=True,
+                                        env=env)
+        deadline = time.time() + startup_timeout
+        while True:
+            if self.process.poll() is not None:
+                self._log.close()
+                raise RuntimeError(f"rclone rcd exited with code {self.process.returncode} (see {self.log_file})")
+            try:
+                self.rc.call("rc/noop")
+                return
+            except (OSError, RuntimeError):
+                if time.time() > deadline:
+                    self.close()
+                    raise RuntimeError(f"rclone rcd did not answer on {rc_addr} within {startup_timeout}s")
+                time.sleep(0.2)
+
+    # Run one rc method as an async job and wait for its output
+    def job(self, method, params):
+        jobid = None
+        try:
+            if self.stopping:
+                raise RuntimeError("run interrupted")
+            jobid = self.rc.call(method, dict(params, _async=True))["jobid"]
+            self.track(jobid)
+            delay = 0.05
+            while True:
+                status = self.rc.call("job/status", {"jobid": jobid})
+                if status.get("finished"):
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, 2)
+        except (OSError, RuntimeError, KeyError) as e:
+            raise subprocess.CalledProcessError(1, ["rclone", "rc", method], stderr=str(e))
+        finally:
+            self.untrack(jobid)
+        if not status.get("success"):
+            raise subprocess.CalledProcessError(1, ["rclone", "rc", method], stderr=status.get("error", ""))
+        return status.get("output") or {}
+
+    # Remember a started job; one started after stop_jobs is stopped at once
+    def track(self, jobid):
+        with self._jobs_lock:
+            stopping = self.stopping
+            if not stopping:
+                self.active_jobs.add(jobid)
+        if stopping:
+            self.stop_job(jobid)
+
+    def untrack(self, jobid):
+        with self._jobs_lock:
+            self.active_jobs.discard(jobid)
+
+    def stop_job(self, jobid):
+        with contextlib.suppress(OSError, RuntimeError):
+            self.rc.call("job/stop", {"jobid": jobid})
+
+    # Stop every running job and refuse new ones; returns how many were stopped
+    # The daemon runs in its own session, so Ctrl+C never reaches it or its jobs.
+    def stop_jobs(self):
+        with self._jobs_lock:
+            self.stopping = True
+            jobids = sorted(self.active_jobs)
+        for jobid in jobids:
+            self.stop_job(jobid)
+        return len(jobids)
+
+    def lsd(self, remote):
+        self.job("operations/list", {"fs": remote, "remote": "", "opt": {"dirsOnly": True}})
+
+    def mkdir(self, path, limits):
+        self.job("operations/mkdir", {"fs": path, "remote": ""})
+
+    # rc has no streaming replies: operations/list and operations/check hand back the
+    # whole folder as one JSON response, held in memory until it is parsed. With stream
+    # (a folder above --stream-above files) the work runs as its own rclone process whose
+    # output is read line by line, like --backend subprocess, under the folder's leased
+    # share of --tpslimit/--bwlimit: while it runs, the daemon and that process together
+    # may exceed the configured limits by one share.
+    def list_files(self, remote_path, limits, hashes=True, files_from=None, stream=False):
+        if stream:
+            return list_remote(remote_path, limits, hashes, files_from)
+        params = {"fs": remote_path, "remote": "", "opt": {"recurse": True, "filesOnly": True, "showHash": bool(hashes)}}
+        if hashes and hashes is not True:
+            params["opt"]["hashTypes"] = list(hashes)
+        if files_from:
+            params["_filter"] = {"FilesFromRaw": [os.path.abspath(files_from)]}
+        output = self.job("operations/list", params)
+        return manifest_files(output.get("list") or [])
+
+    def list_level(self, remote_path, limits):
+        output = self.job("operations/list", {"fs": remote_path, "remote": "", "opt": {"showHash": True}})
+        return split_level(output.get("list") or [])
+
+    def check(self, source_path, dest_path, files_from, combined, checkers, limits, main_log, folder_log,
+              download=False, stream=False):
+        if stream:
+            return self.streamed.check(source_path, dest_path, files_from, combined, checkers, limits,
+                                       main_log, folder_log, download)
+        params = {"srcFs": source_path, "dstFs": dest_path, "oneWay": True, "combined": True,
+                  "_config": {"Checkers": checkers}, "_filter": {"FilesFromRaw": [os.path.abspath(files_from)]}}
+        if download:
+            params["download"] = True
+        log_message(f"Verification job: operations/check {json.dumps(params)}", main_log)
+        output = self.job("operations/check", params)
+        lines = output.get("combined") or []
+        with open(combined, "w", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in lines)
+        method = "download" if download else output.get("hashType") or "none"
+        log_writer.write(folder_log, f"{output.get('status', '')} (compared by: {method})\n")
+        return parse_combined(lines), method
+
+    def copy_file(self, source, dest):
+        source_dir, _, source_name = source.rpartition("/")
+        dest_dir, _, dest_name = dest.rpartition("/")
+        self.job("operations/copyfile", {"srcFs": source_dir, "srcRemote": source_name,
+                                         "dstFs": dest_dir, "dstRemote": dest_name})
+
+    def copy(self, source_path, dest_path, files_from, config, limits, stats_interval, group, rc=False):
+        params = {
+            "srcFs": source_path,
+            "dstFs": dest_path,
+            "_group": group,
+            "_config": dict([rc_option(key, value) for key, value in config.items()],
+                            CheckSum=True, NoTraverse=True),
+            "_filter": {"FilesFromRaw": [os.path.abspath(files_from)]},
+        }
+        return RcJobTransfer(self, "sync/copy", params, files_from, stats_interval)
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.rc.call("core/quit")
+                self.process.wait(timeout=10)
+            except (OSError, RuntimeError, subprocess.TimeoutExpired):
+                self.process.terminate()
+                self.process.wait()
+        self._log.close()
+
+# One sync/copy rc job on the daemon, read by polling its stats group
+class RcJobTransfer:
+    def __init__(self, backend, method, params, files_from, interval):
+        self.backend = backend
+        self.rc = backend.rc
+        self.method = method
+        self.params = params
+        self.files_from = files_from
+        self.interval = max(1, interval)
+        self.command = [method, json.dumps(params)]
+        self.jobid = None
+        self.status = None
+        self.errors = collections.deque(maxlen=5)
+
+    def start(self):
+        self.jobid = self.rc.call(self.method, dict(self.params, _async=True))["jobid"]
+        self.backend.track(self.jobid)
+
+    # Events in the same shape as rclone's JSON log: per-file "Copied" / error lines from
+    # core/transferred and a "stats" event from core/stats for the job's group
+    def events(self, folder_log):
+        group = self.params["_group"]
+        seen = set()
+        last_stats = time.time()
+        while True:
+            # job/status is cheap; poll it often so a finished job is noticed at once,
+            # and only collect stats and transfers every stats interval
+            status = self.rc.call("job/status", {"jobid": self.jobid})
+            if not status.get("finished") and time.time() - last_stats < self.interval:
+                time.sleep(0.5)
+                continue
+            last_stats = time.time()
+            stats = self.rc.call("core/stats", {"group": group})
+            events = []
+            for item in self.rc.call("core/transferred", {"group": group}).get("transferred") or []:
+                key = (item.get("name"), item.get("completed_at") or item.get("timestamp"))
+                if key in seen:
+                    continue
+                seen.add(key)
+                if item.get("error"):
+                    events.append({"level": "error", "msg": item["error"], "object": item.get("name")})
+                elif not item.get("checked"):
+                    events.append({"level": "info", "msg": "Copied (new)", "object": item.get("name"),
+                                   "size": item.get("size", 0)})
+            events.append({"level": "info", "msg": "stats", "stats": stats})
+            if status.get("finished") and status.get("success"):
+                # core/transferred only keeps the most recent transfers; a successful job
+                # has copied (or found identical) every listed file
+                reported = {event["object"] for event in events if event.get("object")} | {name for name, _ in seen}
+                with open(self.files_from, "r", encoding="utf-8") as f:
+                    for path in (line.rstrip("\n") for line in f):
+                        if path and path not in reported:
+                            events.append({"level": "info", "msg": "Copied (new)", "object": path})
+            for event in events:
+                log_rclone_event(folder_log, event, self.errors)
+            yield from events
+            if status.get("finished"):
+                self.status = status
+                self.backend.untrack(self.jobid)
+                if status.get("error"):
+                    log_writer.write(folder_log, f"rc job {self.jobid} failed: {status['error']}\n")
+                    self.errors.append(status["error"])
+                return
+
+    def stop(self):
+        if self.jobid is not None and self.status is None:
+            self.backend.stop_job(self.jobid)
+
+    def wait(self):
+        return 0 if self.status and self.status.get("success") else 1
+
+# Start the --backend for a run, falling back to one process per command if rcd will not start
+def start_backend(args, log_dir, timestamp, main_log):
+    if args.backend == "rcd":
+        try:
+            backend = RcdBackend(args, log_dir, timestamp)
+            log_message(f"rclone rcd daemon started ({backend.rc.url}, log: {backend.log_file})", main_log)
+            return backend
+        except (OSError, RuntimeError) as e:
+            log_message(f"Cannot start rclone rcd ({str(e)}); falling back to one rclone process per command",
+                        main_log, level="WARNING")
+    return SubprocessBackend()
+
+# Rate-limit symptoms in rclone log messages and errors
+RATE_LIMIT_PATTERN = re.compile(r'too_many_requests|too many requests|rate.?limit|\b429\b|retry.?after', re.IGNORECASE)
+RETRY_AFTER_PATTERN = re.compile(r'retry.?after\D{0,20}(\d+(?:\.\d+)?)\s*(ms|s)?', re.IGNORECASE)
+
+# AIMD controller for copies, driven by rate-limit feedback
+# Watches the rclone JSON log of each copy for too_many_requests / retry-after hints
+# and polls rc core/stats of the copies it steers for errors and achieved throughput.
+# Every --adapt-interval seconds:
+#   - throttled: halve tpslimit and transfers, cut bwlimit by 30%, and hold
+#     further increases for the retry-after period Dropbox asked for
+#   - clean:     add --adapt-tps-step to tpslimit and one transfer; raise bwlimit
+#     only when the achieved speed is close to it (bandwidth-bound)
+# Limits are clamped to the --adapt-* floors and ceilings, which are global values
+# divided by the rate budget slots like --tpslimit itself.
+# rclone reads tpslimit, transfers and checkers only when a transfer starts, so only
+# bwlimit is changed live (core/bwlimit). Transfers and checkers are applied to the next
+# copy job or shard (see job_settings), and so is tpslimit with one rclone process per
+# command (see flags); the rcd daemon's tpslimit is fixed for its lifetime.
+# Under rcd one controller steers every copy job of the daemon, reading the stats group
+# of each and the rate-limit retries in the daemon's log (they never reach the job's own
+# log or error count); when the last job finishes the daemon's starting bwlimit is restored.
+# With one process per command each folder has its own controller (adaptive_controller).
+class AdaptiveController:
+    def __init__(self, ctx, name, tps, bw, transfers, slots):
+        args = ctx.args
+        self.ctx = ctx
+        self.name = name
+        self.daemon = ctx.backend.daemon
+        self.interval = args.adapt_interval
+        self.tps_floor = args.adapt_tps_min / slots
+        self.tps_ceiling = max(self.tps_floor, args.adapt_tps_max / slots)
+        self.tps_step = args.adapt_tps_step / slots
+        self.bw_ceiling = parse_bwlimit(args.adapt_bw_max or args.bwlimit) / slots
+        self.bw_floor = min(self.bw_ceiling, 256 * 1024) if self.bw_ceiling > 0 else 0
+        self.transfers_floor = args.adapt_transfers_min
+        self.transfers_ceiling = max(self.transfers_floor, args.adapt_transfers_max)
+        self.tps = min(max(tps or self.tps_ceiling, self.tps_floor), self.tps_ceiling)
+        self.bw = bw
+        self.transfers = min(max(transfers, self.transfers_floor), self.transfers_ceiling)
+        self.start_bw = bw
+        self.start_transfers = self.transfers
+        self.applied_bw = bw
+        self.rc = None
+        self.jobs = {}  # stats group -> folder log of each copy being steered
+        self.daemon_log = ctx.backend.log_file if self.daemon else None
+        self._log_offset = os.path.getsize(self.daemon_log) if self.daemon_log and os.path.exists(self.daemon_log) else 0
+        self._lock = threading.Lock()
+        self._throttle_events = 0
+        self._hold_until = 0
+        self._last_errors = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"adapt-{name}", daemon=True)
+
+    # Transfers and checkers for a copy starting now: the configured values scaled by
+    # how far the controller has moved transfers from where it started
+    def job_settings(self, transfers, checkers):
+        with self._lock:
+            scale = self.transfers / self.start_transfers
+        return (min(self.transfers_ceiling, max(self.transfers_floor, round(transfers * scale))),
+                max(1, round(checkers * scale)))
+
+    # Rate-limit flags for a new rclone process (one process per command only)
+    def flags(self):
+        with self._lock:
+            return [f"--tpslimit={self.tps:g}", f"--bwlimit={format_bwlimit(self.bw)}"]
+
+    # Start steering a copy that has just started (rc: the client its stats come from)
+    def attach(self, group, folder_log, rc):
+        errors = 0
+        if self.daemon:
+            # A stats group reused by a retry keeps its old error count
+            with contextlib.suppress(OSError, RuntimeError):
+                errors = rc.call("core/stats", {"group": group}).get("errors", 0)
+        with self._lock:
+            self.jobs[group] = folder_log
+            self._last_errors[group] = errors
+            self.rc = rc
+            if not self._thread.is_alive() and not self._stop.is_set():
+                self._thread.start()
+        if self.daemon:
+            self._apply_bw(self.bw)
+        else:
+            # A new process starts with flags(), so it already runs at the current bwlimit
+            self.applied_bw = self.bw
+
+    # Stop steering a finished copy; the daemon gets its starting bwlimit back when no
+    # copy is left
+    def detach(self, group):
+        with self._lock:
+            self.jobs.pop(group, None)
+            self._last_errors.pop(group, None)
+            idle = not self.jobs
+            if idle and not self.daemon:
+                self.rc = None
+        if idle and self.daemon and self.applied_bw != self.start_bw:
+            try:
+                self._apply_bw(self.start_bw)
+                self._log(f"no copy running, bwlimit restored to {format_bwlimit(self.start_bw)}")
+            except (OSError, RuntimeError) as e:
+                self._log(f"could not restore bwlimit {format_bwlimit(self.start_bw)}: {str(e)}")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+    # Feed one rclone JSON log event
+    def observe(self, event):
+        text = f"{event.get('msg', '')} {event.get('error', '')}"
+        if not RATE_LIMIT_PATTERN.search(text):
+            return
+        with self._lock:
+            self._throttle_events += 1
+            hint = RETRY_AFTER_PATTERN.search(text)
+            if hint:
+                delay = float(hint.group(1)) / (1000 if (hint.group(2) or "").lower() == "ms" else 1)
+                self._hold_until = max(self._hold_until, time.time() + delay)
+
+    # Feed the rate-limit lines the daemon logged since the last call
+    def _scan_daemon_log(self):
+        with open(self.daemon_log, "r", encoding="utf-8", errors="replace") as f:
+            f.seek(self._log_offset)
+            for line in f:
+                if RATE_LIMIT_PATTERN.search(line):
+                    self.observe({"msg": line})
+            self._log_offset = f.tell()
+
+    def _apply_bw(self, bw):
+        if bw > 0 and bw != self.applied_bw and self.rc is not None:
+            self.rc.call("core/bwlimit", {"rate": format_bwlimit(bw)})
+            self.applied_bw = bw
+
+    def _log(self, message):
+        stamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            folder_logs = set(self.jobs.values())
+        for folder_log in folder_logs:
+            log_writer.write(folder_log, f"{stamp} ADAPTIVE: {message}\n")
+        log_message(f"[{self.name}] {message}", self.ctx.main_log, also_print=not self.ctx.live_display)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.tick()
+            except (OSError, RuntimeError, ValueError) as e:
+                # rc not up yet or already gone; try again next interval
+                self._log(f"controller skipped a tick: {str(e)}")
+
+    # Achieved speed of the copies being steered, and whether any of them has a new
+    # rate-limit error; each read from its own stats group (the whole process when it
+    # runs a single copy)
+    def _read_stats(self):
+        with self._lock:
+            groups = list(self.jobs)
+            rc = self.rc
+        speed, rate_limited = 0, False
+        for group in groups:
+            stats = rc.call("core/stats", {"group": group} if self.daemon else {})
+            errors = stats.get("errors", 0)
+            with self._lock:
+                if group not in self._last_errors:
+                    continue
+                fresh = max(0, errors - self._last_errors[group])
+                self._last_errors[group] = errors
+            speed += stats.get("speed", 0) or 0
+            if fresh and RATE_LIMIT_PATTERN.search(str(stats.get("lastError", ""))):
+                rate_limited = True
+        return speed, rate_limited
+
+    def tick(self):
+        if self.daemon_log:
+            self._scan_daemon_log()
+        if not self.jobs or self.rc is None:
+            return
+        speed, rate_limited = self._read_stats()
+        with self._lock:
+            throttled = self._throttle_events
+            self._throttle_events = 0
+            hold = self._hold_until > time.time()
+        if rate_limited:
+            throttled = max(throttled, 1)
+
+        with self._lock:
+            old = (self.tps, self.bw, self.transfers)
+            if throttled:
+                self.tps = max(self.tps_floor, self.tps / 2)
+                self.transfers = max(self.transfers_floor, self.transfers // 2)
+                if self.bw > 0:
+                    self.bw = max(self.bw_floor, self.bw * 0.7)
+                reason = f"{throttled} rate-limit signal(s)"
+            elif hold:
+                return
+            else:
+                self.tps = min(self.tps_ceiling, self.tps + self.tps_step)
+                self.transfers = min(self.transfers_ceiling, self.transfers + 1)
+                if self.bw > 0 and speed >= 0.9 * self.bw:
+                    self.bw = min(self.bw_ceiling, self.bw * 1.25) if self.bw_ceiling > 0 else self.bw * 1.25
+                reason = f"no rate limiting, {format_size(int(speed))}/s achieved"
+            if self.daemon:
+                # Fixed by the daemon; nothing would read a new value
+                self.tps = old[0]
+            if (self.tps, self.bw, self.transfers) == old:
+                return
+
+        self._apply_bw(self.bw)
+        changes = []
+        if self.bw != old[1]:
+            changes.append(f"bwlimit {format_bwlimit(old[1])} -> {format_bwlimit(self.bw)} now")
+        later = [f"{name} {before:g} -> {after:g}" for name, before, after in
+                 (("tpslimit", old[0], self.tps), ("transfers", old[2], self.transfers)) if before != after]
+        if later:
+            changes.append(f"{', '.join(later)} from the next copy job")
+        self._log(f"{reason}: {'; '.join(changes)}")
+
+# The AIMD controller for a folder's copies (--adaptive): one for the rcd daemon, which
+# holds the whole budget, or one per folder when every copy is its own rclone process
+def adaptive_controller(ctx, folder):
+    key = None if ctx.backend.daemon else folder
+    with ctx.controller_lock:
+        if key not in ctx.controllers:
+            if ctx.backend.daemon:
+                ctx.controllers[key] = AdaptiveController(ctx, "adaptive", ctx.args.tpslimit,
+                                                          parse_bwlimit(ctx.args.bwlimit), ctx.args.transfers, 1)
+            else:
+                budget = ctx.scheduler.budget
+                ctx.controllers[key] = AdaptiveController(ctx, folder, budget.tps_share, budget.bw_share,
+                                                          ctx.args.transfers, budget.slots)
+        return ctx.controllers[key]
+
+# Parse a size such as "16M" or "1.5G" into bytes (bare numbers are bytes)
+def parse_size(value):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGTP]?)i?B?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size '{value}'")
+    multipliers = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+    return int(float(match.group(1)) * multipliers[match.group(2).upper()])
+
+# Per-shard rclone settings that may be tuned; anything else is rejected for safety
+SHARD_TUNABLES = ("transfers", "checkers", "multi-thread-streams", "multi-thread-cutoff",
+                  "buffer-size", "use-mmap", "low-level-retries", "retries", "timeout")
+
+# Default size bands when --shard is given without --shard-band:
+# many small files are bound by API calls per second, so they get wide concurrency;
+# a few huge files are bound by bandwidth, so they get few transfers split into streams
+DEFAULT_SHARD_BANDS = (
+    "small:0-16M:transfers=8,checkers=16",
+    "large:16M-:transfers=2,checkers=4,multi-thread-streams=4,multi-thread-cutoff=64M",
+)
+
+# Parse a --shard-band value "NAME:MIN-MAX[:key=value,...]" (empty MAX = no upper bound)
+def parse_shard_band(spec):
+    parts = spec.split(":", 2)
+    if len(parts) < 2 or not parts[0] or "-" not in parts[1]:
+        raise ValueError(f"Invalid shard band '{spec}' (expected NAME:MIN-MAX[:key=value,...])")
+    low, high = parts[1].split("-", 1)
+    band = {
+        "name": parts[0],
+        "min": parse_size(low or "0"),
+        "max": parse_size(high) if high else None,
+        "tuning": {},
+    }
+    if len(parts) == 3 and parts[2]:
+        for setting in parts[2].split(","):
+            key, _, value = setting.partition("=")
+            key = key.strip()
+            if key not in SHARD_TUNABLES or not value:
+                raise ValueError(f"Shard band '{band['name']}': unsupported setting '{setting}' "
+                                 f"(allowed: {', '.join(SHARD_TUNABLES)})")
+            band["tuning"][key] = value.strip()
+    return band
+
+# Build the configured size bands, sorted by lower bound
+def shard_bands(args):
+    return sorted((parse_shard_band(spec) for spec in (args.shard_band or DEFAULT_SHARD_BANDS)),
+                  key=lambda band: band["min"])
+
+# Split planned files into size-band shards: [(band, [items])], empty shards dropped
+# Files that fall in no band go to the closest band below them (or the first band).
+def split_into_shards(items, bands):
+    shards = [(band, []) for band in bands]
+    for item in items:
+        size = max(item["size"], 0)
+        target = shards[0]
+        for band, files in shards:
+            if size >= band["min"]:
+                target = (band, files)
+            if size >= band["min"] and (band["max"] is None or size < band["max"]):
+                break
+        target[1].append(item)
+    return [(band, files) for band, files in shards if files]
+
+# Copy a folder's planned files, as one job or as separately tuned size-band shards
+# Returns (worst exit code, paths rclone reported as copied)
+def copy_planned_files(ctx, folder, source_path, dest_path, items, folder_log, suffix=""):
+    base = os.path.join(ctx.log_dir, f"{folder_key(folder, ctx.args.subpath)}-{ctx.timestamp}{suffix}")
+    if not ctx.args.shard:
+        copy_list = write_files_from(base + ".files", [item["path"] for item in items])
+        return run_copy(ctx, folder, source_path, dest_path, copy_list, folder_log)
+
+    shards = split_into_shards(items, ctx.bands)
+    worst = 0
+    copied = []
+    for index, (band, files) in enumerate(shards, 1):
+        shard_bytes = sum(max(item["size"], 0) for item in files)
+        tuning = ", ".join(f"{key}={value}" for key, value in band["tuning"].items()) or "default settings"
+        log_message(f"[{folder}] Shard {index}/{len(shards)} '{band['name']}': {len(files)} files, "
+                    f"{format_size(shard_bytes)} ({tuning})", ctx.main_log)
+        copy_list = write_files_from(f"{base}-{band['name']}.files", [item["path"] for item in files])
+        returncode, shard_copied = run_copy(ctx, folder, source_path, dest_path, copy_list, folder_log, band["tuning"])
+        worst = worst or returncode
+        copied.extend(shard_copied)
+    return worst, copied
+
+# Copy a folder's planned files, isolating the failures when the copy does not finish
+# The files left uncopied are regrouped by subdirectory and each group is copied again
+# on its own, with retries; a group that keeps failing is split one directory level
+# deeper, down to single files. Files that still fail are quarantined, everything else
+# is copied with the usual --checksum settings.
+# Returns (exit code, paths copied, quarantine entries)
+def copy_isolating(ctx, folder, source_path, dest_path, items, folder_log):
+    returncode, copied = copy_planned_files(ctx, folder, source_path, dest_path, items, folder_log)
+    done = set(copied)
+    left = [item for item in items if item["path"] not in done]
+    if returncode == 0 or not left or ctx.args.no_isolate:
+        return returncode, copied, []
+    if ctx.scheduler.cancelled.is_set():
+        # The copy failed because the run was interrupted, not because of the files
+        raise KeyboardInterrupt
+
+    log_message(f"[{folder}] Copy failed with {len(left)} of {len(items)} files not copied; "
+                f"isolating the failing subtrees", ctx.main_log, level="WARNING")
+    failed = []
+    isolate_copy(ctx, folder, source_path, dest_path, left, folder_log, 0, copied, failed)
+    quarantined = collapse_quarantine(failed, items)
+    log_message(f"[{folder}] Isolated copy: {len(left) - len(failed)} files recovered, {len(failed)} files in "
+                f"{len(quarantined)} subtrees quarantined", ctx.main_log, level="WARNING" if failed else "SUCCESS")
+    return (1 if failed else 0), copied, quarantined
+
+# Copy groups of items one by one, splitting the groups that keep failing
+# Quarantined files are appended to failed as report entries
+def isolate_copy(ctx, folder, source_path, dest_path, items, folder_log, depth, copied, failed):
+    for label, group, split in copy_groups(items, depth):
+        left = retry_copy(ctx, folder, source_path, dest_path, label, group, folder_log, copied)
+        if not left:
+            continue
+        if split is None or len(left) == 1:
+            label = left[0]["path"]
+            failed.append({"path": label, "kind": "file", "stage": "copy",
+                           "error": f"not copied after {ctx.args.isolate_retries} attempts"})
+            log_message(f"[{folder}] Quarantined file '{label}'", ctx.main_log, level="ERROR")
+        else:
+            isolate_copy(ctx, folder, source_path, dest_path, left, folder_log, split, copied, failed)
+
+# Split items that share their first `depth` path components into (label, items, split):
+# one group per subdirectory (split one level deeper), one group for the files directly
+# in the directory (split "files", one file each), and single files (split None).
+# depth "files" puts every item in a group of its own.
+def copy_groups(items, depth):
+    if depth == "files":
+        return [(item["path"], [item], None) for item in items]
+    subdirs = {}
+    loose = []
+    for item in items:
+        parts = item["path"].split("/")
+        if len(parts) > depth + 1:
+            subdirs.setdefault("/".join(parts[:depth + 1]), []).append(item)
+        else:
+            loose.append(item)
+    groups = [(prefix, group, depth + 1) for prefix, group in sorted(subdirs.items())]
+    if len(loose) == 1:
+        groups.append((loose[0]["path"], loose, None))
+    elif loose:
+        parent = loose[0]["path"].rpartition("/")[0]
+        groups.append((f"{parent}/*" if parent else "*", loose, "files"))
+    return groups
+
+# Copy one group with retries and backoff; returns the items still not copied
+def retry_copy(ctx, folder, source_path, dest_path, label, items, folder_log, copied):
+    delay = ctx.args.isolate_backoff
+    left = items
+    for attempt in range(1, ctx.args.isolate_retries + 1):
+        log_message(f"[{folder}] Copying '{label}' ({len(left)} files), attempt {attempt}/"
+                    f"{ctx.args.isolate_retries}", ctx.main_log)
+        # Each attempt keeps its own file list in the logs, for the forensic trail
+        suffix = f"-isolate-{re.sub(r'[^A-Za-z0-9._-]+', '_', label)}-{attempt}"
+        returncode, group_copied = copy_planned_files(ctx, folder, source_path, dest_path, left, folder_log, suffix)
+        copied.extend(group_copied)
+        done = set(group_copied)
+        left = [item for item in left if item["path"] not in done]
+        if returncode == 0 or not left:
+            return []
+        if attempt < ctx.args.isolate_retries:
+            ctx.scheduler.cancelled.wait(delay)
+            delay *= 2
+    return left
+
+# Report quarantined files compactly: a directory in which every planned file failed
+# is reported once (with its files) instead of file by file
+def collapse_quarantine(failed, items):
+    failed_paths = {entry["path"] for entry in failed}
+    planned = collections.Counter()
+    failing = collections.Counter()
+    for item in items:
+        parts = item["path"].split("/")
+        for depth in range(1, len(parts)):
+            prefix = "/".join(parts[:depth])
+            planned[prefix] += 1
+            failing[prefix] += item["path"] in failed_paths
+    covered = []
+    for prefix in sorted(planned, key=lambda prefix: prefix.count("/")):
+        if planned[prefix] > 1 and failing[prefix] == planned[prefix] and \
+                not any(prefix.startswith(parent + "/") for parent in covered):
+            covered.append(prefix)
+    entries = []
+    for prefix in covered:
+        files = sorted(path for path in failed_paths if path.startswith(prefix + "/"))
+        entries.append({"path": prefix, "kind": "directory", "stage": "copy",
+                        "error": failed[0]["error"], "files": files})
+    entries += [entry for entry in failed if not any(entry["path"].startswith(prefix + "/") for prefix in covered)]
+    return sorted(entries, key=lambda entry: entry["path"])
+
+# Files covered by quarantine entries (directory entries of a copy list their files)
+def quarantined_files(entries):
+    paths = set()
+    for entry in entries:
+        if entry["stage"] == "copy":
+            paths.update(entry.get("files") or [entry["path"]])
+    return paths
+
+# Write the folder's quarantine report and log where it is
+def write_quarantine_report(ctx, folder, entries, folder_log):
+    report_path = os.path.join(ctx.log_dir, f"{folder_key(folder, ctx.args.subpath)}-{ctx.timestamp}-quarantine.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({"folder": folder, "subpath": ctx.args.subpath, "run_id": ctx.run_id,
+                   "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "entries": entries}, f, indent=2)
+    log_writer.write(folder_log, "\n--- QUARANTINED PATHS ---\n")
+    for entry in entries:
+        log_writer.write(folder_log, f"{entry['stage']} {entry['kind']}: {entry['path']} ({entry['error']})\n")
+    log_message(f"[{folder}] {len(entries)} paths quarantined and left out of this run, see {report_path}",
+                ctx.main_log, level="ERROR")
+    log_message(f"[{folder}] Everything else was transferred and verified normally; run the folder again "
+                f"to retry the quarantined paths", ctx.main_log, level="WARNING")
+
+# Copy planned files whose content is already on the destination (or is being downloaded
+# there by an earlier folder) from that copy, without touching Dropbox
+# Returns (paths copied, items that still need a download)
+def copy_duplicates(ctx, folder, dest_path, duplicates, folder_log):
+    total = sum(max(item["size"], 0) for item, _ in duplicates)
+    log_message(f"[{folder}] Copying {len(duplicates)} duplicate files ({format_size(total)}) on the destination",
+                ctx.main_log)
+
+    def copy_one(duplicate):
+        item, content_hash = duplicate
+        source = ctx.dedup.source_for(content_hash)
+        if source is None:
+            return item, source, "its content was not downloaded"
+        try:
+            ctx.backend.copy_file(source, f"{dest_path}/{item['path']}")
+        except subprocess.CalledProcessError as e:
+            return item, source, failure_reason(e)
+        return item, source, None
+
+    copied, fallback = [], []
+    log_writer.write(folder_log, "\n--- DEDUP COPIES ---\n")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, ctx.args.transfers)) as executor:
+        for item, source, error in executor.map(copy_one, duplicates):
+            if error:
+                log_writer.write(folder_log, f"download instead: {item['path']} ({error})\n")
+                fallback.append(item)
+            else:
+                log_writer.write(folder_log, f"{source} -> {item['path']}\n")
+                copied.append(item["path"])
+                ctx.dedup.record_saving(item["size"])
+    ctx.journal.mark(ctx.run_id, folder, copied, "copied")
+    log_message(f"[{folder}] Dedup: {len(copied)} files copied on the destination, "
+                f"{len(fallback)} left to download", ctx.main_log,
+                level="SUCCESS" if not fallback else "WARNING")
+    return copied, fallback
+
+# Group the source files of every folder of the run by content hash (--dedup)
+# Takes (or reuses) both manifests of each folder up front; the folders then find them
+# in the manifest cache. A destination folder that cannot be listed yet counts as empty.
+def build_dedup_index(ctx):
+    index = DedupIndex()
+    plans = []
+    unverified = 0
+    for folder in ctx.args.folders:
+        source_path = f"{ctx.full_source_base}/{folder}"
+        dest_path = f"{ctx.full_dest_base}/{folder}"
+        try:
+            source_manifest = get_manifest(ctx, "source", folder, source_path)
+        except subprocess.CalledProcessError as e:
+            log_message(f"[{folder}] Left out of dedup, source listing failed: {failure_reason(e)}",
+                        ctx.main_log, level="WARNING")
+            continue
+        try:
+            dest_manifest = get_manifest(ctx, "dest", folder, dest_path)
+            index.manifests[folder] = (source_manifest, dest_manifest)
+        except subprocess.CalledProcessError:
+            dest_manifest = {"files": {}}
+            index.manifests[folder] = (source_manifest, None)
+        plan = diff_manifests(source_manifest, dest_manifest)
+        unverified += index.add_present(dest_path, source_manifest, plan,
+                                        ctx.journal.verified_anywhere(folder, ctx.args.subpath))
+        plans.append((folder, dest_path, source_manifest, plan))
+    for folder, dest_path, source_manifest, plan in plans:
+        index.add_plan(folder, dest_path, source_manifest, plan)
+
+    duplicates = [(folder, item) for folder, _, _, plan in plans for item in plan
+                  if index.is_duplicate(folder, item["path"])]
+    log_message(f"Dedup: {len(index.hashes)} planned files with a content hash, {len(duplicates)} of them "
+                f"({format_size(sum(max(item['size'], 0) for _, item in duplicates))}) duplicate content "
+                f"downloaded once or already on the destination", ctx.main_log)
+    if unverified:
+        log_message(f"Dedup: {unverified} destination files match the source by size only (no content check in the journal) "
+                    f"and are not used as copy sources; their duplicates are downloaded from Dropbox", ctx.main_log)
+    return index
+
+# process_folder for --dedup runs: however the folder ends, release the folders waiting
+# for the content it was to download
+def process_folder_dedup(folder, ctx):
+    try:
+        process_folder(folder, ctx)
+    finally:
+        ctx.dedup.finish_folder(folder)
+
+# Copy the files listed in copy_list (relative to source_path) with live progress
+# tuning overrides --transfers/--checkers and adds other SHARD_TUNABLES for this job
+# Returns (exit code, paths rclone reported as copied)
+def run_copy(ctx, folder, source_path, dest_path, copy_list, folder_log, tuning=None):
+    args = ctx.args
+    main_log = ctx.main_log
+    tuning = dict(tuning or {})
+    transfers = int(tuning.pop("transfers", args.transfers))
+    checkers = int(tuning.pop("checkers", args.checkers))
+    controller = adaptive_controller(ctx, folder) if args.adaptive else None
+    with ctx.scheduler.stage("copy") as limits:
+        if controller:
+            # Settings rclone reads only when a copy starts follow the controller per job
+            transfers, checkers = controller.job_settings(transfers, checkers)
+            if not ctx.backend.daemon:
+                limits = controller.flags()
+        # Only the planned files are sent; --no-traverse skips re-listing the destination
+        config = dict(transfers=transfers, checkers=checkers, **tuning)
+        group = os.path.basename(copy_list)
+        transfer = ctx.backend.copy(source_path, dest_path, copy_list, config, limits, args.stats_interval,
+                                    group=group, rc=args.adaptive)
+
+        log_message(f"Command: {' '.join(transfer.command)}", main_log)
+
+        # Better progress monitoring with cleaner display
+        log_message("Starting transfer process...", main_log)
+        if ctx.live_display:
+            log_message("Progress updates will appear below (press Ctrl+C to stop):", main_log)
+            print()  # Extra line before progress begins
+
+        transfer.start()
+
+        # Record each completed file as soon as rclone reports it
+        copied = []
+        def on_event(event):
+            path = copied_object(event)
+            if path:
+                copied.append(path)
+                ctx.journal.mark(ctx.run_id, folder, [path], "copied")
+            elif controller:
+                controller.observe(event)
+
+        if controller:
+            controller.attach(group, folder_log, transfer.rc)
+
+        metrics = ctx.metrics.folder(folder, stall_after=args.stall_after)
+        metrics.begin_job()
+        if ctx.live_display:
+            # Create a 4-line status display area, redrawn from the metrics state
+            print("\n\n\n\n")  # 4 blank lines
+        try:
+            follow_transfer(transfer, folder, folder_log, ctx, metrics, on_event)
+        except KeyboardInterrupt:
+            transfer.stop()
+            raise
+        finally:
+            # Wait for the process (or rc job) to complete
+            returncode = transfer.wait()
+            metrics.finished = True
+            ctx.metrics.publish(force=True)
+            if controller:
+                controller.detach(group)
+
+    if ctx.live_display:
+        # Move past the status display
+        print("\n\n\n")
+
+    if returncode == 0:
+        log_message(f"[{folder}] Transfer completed successfully", main_log, level="SUCCESS")
+    else:
+        log_message(f"[{folder}] Transfer process exited with code: {returncode}", main_log, level="WARNING")
+        for error in transfer.errors:
+            log_message(f"[{folder}]   {error}", main_log, level="WARNING")
+    return returncode, copied
+
+# Format seconds as "1h02m03s" for ETAs ("-" when unknown)
+def format_duration(seconds):
+    if seconds is None or seconds < 0:
+        return "-"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+# Rolling transfer metrics for one folder, fed from rclone's JSON stats and log events
+# rclone logs a "stats" object every --stats interval; rates are computed over the
+# last `window` seconds of those snapshots rather than taken from human-formatted text.
+# A folder runs several rclone jobs (shards, isolation retries, dedup and S3 copies), each
+# with its own counters starting from zero, so every job starts a fresh set (begin_job).
+class TransferMetrics:
+    def __init__(self, folder, window=60, stall_after=300):
+        self.folder = folder
+        self.window = window
+        self.stall_after = stall_after
+        self.begin_job()
+
+    # Forget the previous job's samples and counters; call before feeding a new job
+    def begin_job(self):
+        self.started = time.time()
+        self.samples = collections.deque()
+        self.stats = {}
+        self.retries = 0
+        self.rate_limited = 0
+        self.log_errors = 0
+        self.last_progress = self.started
+        self.finished = False
+
+    # Feed one rclone JSON log event
+    def observe(self, event):
+        stats = event.get("stats")
+        if isinstance(stats, dict):
+            now = time.time()
+            if stats.get("bytes", 0) > self.stats.get("bytes", 0) or stats.get("transfers", 0) > self.stats.get("transfers", 0):
+                self.last_progress = now
+            self.stats = stats
+            self.samples.append((now, stats.get("bytes", 0), stats.get("transfers", 0)))
+            while len(self.samples) > 2 and now - self.samples[0][0] > self.window:
+                self.samples.popleft()
+            return
+        text = f"{event.get('msg', '')} {event.get('error', '')}"
+        if re.search(r'\bretry', text, re.IGNORECASE):
+            self.retries += 1
+        if RATE_LIMIT_PATTERN.search(text):
+            self.rate_limited += 1
+        if str(event.get("level", "")).lower() in ("error", "critical"):
+            self.log_errors += 1
+
+    def _rate(self, index):
+        if len(self.samples) < 2:
+            return 0.0
+        first, last = self.samples[0], self.samples[-1]
+        elapsed = last[0] - first[0]
+        return (last[index] - first[index]) / elapsed if elapsed > 0 else 0.0
+
+    # Plain-dict view of the current state (used by the display, /status and the textfile)
+    def snapshot(self):
+        stats = self.stats
+        bytes_per_sec = self._rate(1)
+        total_bytes = stats.get("totalBytes", 0)
+        done_bytes = stats.get("bytes", 0)
+        eta = stats.get("eta")
+        if eta is None and bytes_per_sec > 0 and total_bytes > done_bytes:
+            eta = (total_bytes - done_bytes) / bytes_per_sec
+        return {
+            "folder": self.folder,
+            "elapsed": time.time() - self.started,
+            "bytes": done_bytes,
+            "total_bytes": total_bytes,
+            "files": stats.get("transfers", 0),
+            "total_files": stats.get("totalTransfers", 0),
+            "checks": stats.get("checks", 0),
+            "bytes_per_sec": bytes_per_sec,
+            "files_per_sec": self._rate(2),
+            "errors": max(stats.get("errors", 0), self.log_errors),
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "eta": eta,
+            "stalled": not self.finished and time.time() - self.last_progress > self.stall_after,
+            "finished": self.finished,
+            "transferring": [
+                {"name": item.get("name", ""), "percentage": item.get("percentage", 0),
+                 "speed": item.get("speedAvg", item.get("speed", 0)), "eta": item.get("eta")}
+                for item in stats.get("transferring") or []
+            ],
+        }
+
+# Metrics for every folder of the run, exposed as a Prometheus textfile and/or local HTTP
+#   --metrics-file PATH  rewritten atomically (node_exporter textfile collector format)
+#   --metrics-port N     http://127.0.0.1:N/metrics (Prometheus) and /status (JSON)
+class MetricsRegistry:
+    def __init__(self, metrics_file=None, metrics_port=None, write_every=5):
+        self.metrics_file = metrics_file
+        self.write_every = write_every
+        self._folders = {}
+        self._lock = threading.Lock()
+        self._last_write = 0
+        self.server = None
+        if metrics_port:
+            self.server = self._serve(metrics_port)
+
+    def folder(self, name, stall_after=300):
+        with self._lock:
+            if name not in self._folders:
+                self._folders[name] = TransferMetrics(name, stall_after=stall_after)
+            return self._folders[name]
+
+    def status(self):
+        with self._lock:
+            return {"updated": time.time(), "folders": [m.snapshot() for m in self._folders.values()]}
+
+    def prometheus(self):
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+        gauges = (
+            ("bytes_transferred", "bytes", "Bytes transferred so far"),
+            ("bytes_total", "total_bytes", "Bytes expected in this transfer"),
+            ("files_transferred", "files", "Files transferred so far"),
+            ("files_total", "total_files", "Files expected in this transfer"),
+            ("bytes_per_second", "bytes_per_sec", "Rolling transfer rate in bytes per second"),
+            ("files_per_second", "files_per_sec", "Rolling transfer rate in files per second"),
+            ("errors", "errors", "Errors reported by rclone"),
+            ("retries", "retries", "Retry messages logged by rclone"),
+            ("rate_limited", "rate_limited", "Rate-limit (too_many_requests) messages"),
+            ("eta_seconds", "eta", "Estimated seconds to completion"),
+            ("stalled", "stalled", "1 when no progress was made for the stall period"),
+        )
+        snapshots = self.status()["folders"]
+        lines = []
+        for metric, key, help_text in gauges:
+            lines.append(f"# HELP wasabi_transfer_{metric} {help_text}")
+            lines.append(f"# TYPE wasabi_transfer_{metric} gauge")
+            for snap in snapshots:
+                value = snap[key]
+                if value is None:
+                    continue
+                lines.append(f'wasabi_transfer_{metric}{{folder="{label(snap["folder"])}"}} {float(value):g}')
+        lines.append("# HELP wasabi_transfer_file_eta_seconds Estimated seconds left for each file in flight")
+        lines.append("# TYPE wasabi_transfer_file_eta_seconds gauge")
+        for snap in snapshots:
+            for item in snap["transferring"]:
+                if item["eta"] is not None:
+                    lines.append(f'wasabi_transfer_file_eta_seconds{{folder="{label(snap["folder"])}",'
+                                 f'file="{label(item["name"])}"}} {float(item["eta"]):g}')
+        return "\n".join(lines) + "\n"
+
+    # Rewrite the textfile, at most every write_every seconds unless forced
+    def publish(self, force=False):
+        if not self.metrics_file or (not force and time.time() - self._last_write < self.write_every):
+            return
+        self._last_write = time.time()
+        with open(self.metrics_file + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(self.metrics_file + ".tmp", self.metrics_file)
+
+    def _serve(self, port):
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith("/metrics"):
+                    body, content_type = registry.prometheus(), "text/plain; version=0.0.4"
+                elif self.path.startswith("/status"):
+                    body, content_type = json.dumps(registry.status(), indent=2), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        return server
+
+# 4-line status block rendered from a metrics snapshot
+def render_status_block(snap, terminal_width):
+    percent = 100 * snap["bytes"] / snap["total_bytes"] if snap["total_bytes"] else 0
+    lines = [
+        f"Status: {format_size(snap['bytes'])} / {format_size(snap['total_bytes'])} ({percent:.0f}%), "
+        f"{format_size(int(snap['bytes_per_sec']))}/s, ETA {format_duration(snap['eta'])}"
+        f"{'  [STALLED]' if snap['stalled'] else ''}",
+        f"Files: {snap['files']} / {snap['total_files']}, {snap['files_per_sec']:.2f} files/s",
+        f"Time: {format_duration(snap['elapsed'])}  errors {snap['errors']}, retries {snap['retries']}, "
+        f"rate-limited {snap['rate_limited']}",
+    ]
+    if snap["transferring"]:
+        item = max(snap["transferring"], key=lambda entry: entry["eta"] or 0)
+        lines.append(f"  * {item['name']}: {item['percentage']}%, ETA {format_duration(item['eta'])}")
+    else:
+        lines.append("")
+    return [line if len(line) <= terminal_width - 3 else line[:terminal_width - 6] + "..." for line in lines]
+
+# Consume a running copy's events (rclone JSON log or rc job polling): journal/controller
+# events, metrics and progress display
+# With the live display a 4-line block is redrawn from the metrics state; concurrent
+# folders get a periodic one-line summary in the main log instead.
+def follow_transfer(transfer, folder, folder_log, ctx, metrics, on_event=None, interval=60, live=None):
+    live = ctx.live_display if live is None else live
+    last_report = 0
+    for event in transfer.events(folder_log):
+        metrics.observe(event)
+        if on_event:
+            on_event(event)
+        if "stats" not in event:
+            continue
+
+        ctx.metrics.publish()
+        snap = metrics.snapshot()
+        if live:
+            # Move up 4 lines, clear, and print the block
+            sys.stdout.write('\033[4A')
+            sys.stdout.write('\033[J')
+            for status_line in render_status_block(snap, ctx.terminal_width):
+                print(status_line)
+            sys.stdout.flush()
+        elif time.time() - last_report >= interval:
+            log_message(f"[{folder}] {render_status_block(snap, 200)[0]}", ctx.main_log)
+            last_report = time.time()
+
+# Second hop: upload a folder verified on DS423 to the S3-compatible bucket (--s3-remote)
+# Queued as soon as the folder's first-hop verification passes and run on a background
+# pool (--max-uploads), so the next folders' Dropbox transfers go on meanwhile. Always a
+# separate 'rclone copy' process (copy only, never sync): the rcd daemon's --tpslimit is
+# global to the process and sized for Dropbox, not for S3.
+def queue_upload(ctx, folder, paths, folder_log):
+    log_message(f"[{folder}] Queued S3 upload of {len(paths)} verified files", ctx.main_log)
+    with ctx.upload_lock:
+        ctx.uploads.append(ctx.upload_pool.submit(upload_folder, ctx, folder, sorted(paths), folder_log))
+
+# Queue the second hop of a folder once its DS423 verification is done (results: its
+# {path: status}, None with --no-verify). Only files the journal holds as verified go to
+# S3: verified in this run, or present on DS423 and verified by an earlier run with the
+# same source hash. Present files never checked by content, and files not verified
+# (size match, quarantined), stay out until a verification of them passes.
+def queue_verified_upload(ctx, folder, results, folder_log):
+    if results is None:
+        log_message(f"[{folder}] S3 upload skipped: it waits for a verified first hop (--no-verify)",
+                    ctx.main_log, level="WARNING")
+        return
+    if any(status not in ("match", "size match", "quarantined") for status in results.values()):
+        log_message(f"[{folder}] S3 upload skipped: verification on DS423 did not pass", ctx.main_log,
+                    level="WARNING")
+        return
+    states = ctx.journal.states(ctx.run_id, folder)
+    earlier = ctx.journal.verified_anywhere(folder, ctx.args.subpath)
+    paths = [path for path, (state, content_hash) in states.items()
+             if state == "verified" or (state == "present" and earlier.get(path) == content_hash)]
+    present = sum(1 for state, _ in states.values() if state == "present")
+    present_verified = sum(1 for path in paths if states[path][0] == "present")
+    if present_verified:
+        log_message(f"[{folder}] {present_verified} files present on DS423 and verified in an earlier run "
+                    f"are included in the S3 upload", ctx.main_log)
+    if present > present_verified:
+        log_message(f"[{folder}] {present - present_verified} files present on DS423 but never verified by content "
+                    f"stay out of the S3 upload (--verify-mode full verifies the whole folder)",
+                    ctx.main_log, level="WARNING")
+    left = len(states) - len(paths) - (present - present_verified)
+    if left:
+        log_message(f"[{folder}] {left} files not verified in this run stay out of the S3 upload",
+                    ctx.main_log, level="WARNING")
+    if paths:
+        queue_upload(ctx, folder, paths, folder_log)
+
+# Upload the given files of a folder from DS423 to S3, then check them by size and ETag
+# Returns True when every file is in the bucket with a matching size and MD5/ETag
+def upload_folder(ctx, folder, paths, folder_log):
+    args = ctx.args
+    nas_path = f"{ctx.full_dest_base}/{folder}"
+    s3_path = f"{ctx.full_s3_base}/{folder}"
+    try:
+        log_message(f"[{folder}] Starting S3 upload: {len(paths)} files to {s3_path}", ctx.main_log)
+        files_from = write_files_from(
+            os.path.join(ctx.log_dir, f"{folder_key(folder, args.subpath)}-{ctx.timestamp}-s3.files"), paths)
+        # Multipart tuning: parts of --s3-chunk-size, --s3-upload-concurrency parts in flight per file
+        config = {"transfers": args.s3_transfers, "checkers": args.checkers,
+                  "s3-chunk-size": args.s3_chunk_size, "s3-upload-cutoff": args.s3_upload_cutoff,
+                  "s3-upload-concurrency": args.s3_upload_concurrency}
+        limits = [f"--bwlimit={args.s3_bwlimit}"] if args.s3_bwlimit else []
+        transfer = ctx.upload_backend.copy(nas_path, s3_path, files_from, config, limits, args.stats_interval,
+                                           group=os.path.basename(files_from))
+        log_message(f"Upload command: {' '.join(transfer.command)}", ctx.main_log)
+
+        uploaded = []
+        def on_event(event):
+            path = copied_object(event)
+            if path:
+                uploaded.append(path)
+
+        metrics = ctx.metrics.folder(f"{folder} (S3)", stall_after=args.stall_after)
+        metrics.begin_job()
+        transfer.start()
+        try:
+            follow_transfer(transfer, folder, folder_log, ctx, metrics, on_event, live=False)
+        finally:
+            returncode = transfer.wait()
+            metrics.finished = True
+            ctx.metrics.publish(force=True)
+        if returncode != 0:
+            log_message(f"[{folder}] S3 upload exited with code {returncode}", ctx.main_log, level="WARNING")
+            for error in transfer.errors:
+                log_message(f"[{folder}]   {error}", ctx.main_log, level="WARNING")
+        if ctx.scheduler.cancelled.is_set():
+            log_message(f"[{folder}] S3 upload interrupted after {len(uploaded)} files", ctx.main_log, level="WARNING")
+            return False
+        log_message(f"[{folder}] S3 upload sent {len(uploaded)} files; checking sizes and ETags", ctx.main_log)
+        return verify_upload(ctx, folder, nas_path, s3_path, paths, files_from, folder_log)
+    except subprocess.CalledProcessError as e:
+        log_message(f"[{folder}] S3 upload failed: {failure_reason(e)}", ctx.main_log, level="ERROR")
+    except Exception as e:
+        log_message(f"[{folder}] Unexpected error uploading to S3: {str(e)}", ctx.main_log, level="ERROR")
+    return False
+
+# Compare DS423 and S3 listings of the uploaded files: size always, MD5 when both sides
+# have one (the ETag of a single-part object; rclone keeps it in the object metadata for
+# multipart uploads). Objects without a comparable MD5 are "size match".
+# Both listings are limited to the uploaded paths (files_from), so the NAS hashes only
+# those files, not everything else in the folder.
+# Writes logs/<folder>-<ts>-s3-verify.json; returns True when nothing is missing or different
+def verify_upload(ctx, folder, nas_path, s3_path, paths, files_from, folder_log):
+    # MD5 only: the one hash S3 reports, so the NAS computes no SHA-1 it cannot compare
+    nas_files = ctx.upload_backend.list_files(nas_path, [], hashes=["md5"], files_from=files_from)
+    s3_files = ctx.upload_backend.list_files(s3_path, [], files_from=files_from)
+    results = {}
+    for path in paths:
+        local, remote = nas_files.get(path), s3_files.get(path)
+        if remote is None:
+            results[path] = "missing"
+        elif local is None:
+            results[path] = "missing on DS423"
+        elif local["size"] != remote["size"]:
+            results[path] = "differ"
+        elif local["hashes"].get("md5") and remote["hashes"].get("md5"):
+            results[path] = "match" if local["hashes"]["md5"] == remote["hashes"]["md5"] else "differ"
+        else:
+            results[path] = "size match"
+
+    summary = dict(collections.Counter(results.values()))
+    report_path = os.path.join(ctx.log_dir, f"{folder_key(folder, ctx.args.subpath)}-{ctx.timestamp}-s3-verify.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump({"folder": folder, "subpath": ctx.args.subpath, "run_id": ctx.run_id, "source": nas_path,
+                   "destination": s3_path, "checked_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                   "summary": summary,
+                   "files": [{"path": path, "status": status} for path, status in sorted(results.items())]},
+                  f, indent=2)
+
+    failed = sorted(path for path, status in results.items() if status not in ("match", "size match"))
+    log_writer.write(folder_log, "\n--- S3 VERIFICATION SUMMARY ---\n")
+    for path in failed:
+        log_writer.write(folder_log, f"{results[path]}: {path}\n")
+    log_writer.write(folder_log, f"{len(results)} checked, {len(failed)} differences found\nReport: {report_path}\n")
+    counts = ", ".join(f"{count} {status}" for status, count in sorted(summary.items())) or "nothing to check"
+    if failed:
+        log_message(f"[{folder}] S3 verification found {len(failed)} differences ({counts}), see {report_path}",
+                    ctx.main_log, level="ERROR")
+    else:
+        log_message(f"[{folder}] S3 upload verified ({counts})", ctx.main_log, level="SUCCESS")
+    return not failed
+
+# Remote holding both the original Dropbox tree and its staged WASABI-MIGRATION copy
+SIZE_CHECK_REMOTE = SOURCE_BASE.split(":")[0] + ":"
+
+# File-name slugs used by the hand-made *_size.json files in WORK/media_files_verification
+SIZE_FILE_SLUGS = {
+    "15_04 Furyu Schroeder Portraits": "schroeder",
+    "2020 Letterhead and Envelopes": "letterhead",
+    "Cut 9.0": "cut9",
+    "Digital Voice Editor": "digital_voice",
+    "Experts_Mind_2010": "experts_mind",
+    "Linda Oryoki Cut 3.0": "linda_oryoki",
+    "Mountain Seat Ceremonies": "mountain_seat",
+    "MYL2006 Digital Files": "myl2006",
+    "Program Dept. Projects": "program_dept",
+    "Skit Night 2017": "skit_night",
+    "Taryn's Backup": "taryn",
+    "Test Folder - Don't touch": "test_folder",
+    "Path of Urban Practice": "urban_practice",
+    "Videos, Tass Rez": "videos_tass",
+    "Volunteer Appreciation Nov 07 photos": "volunteer",
+    "Website Redesign - Barbara": "barbara",
+    "Website Redesign - Earthlyn": "earthlyn",
+    "Wendy Johnson interview": "wendy",
+    "YEAR END LETTERS": "year_end",
+    "ZMC Dharma Talks Fall 2016": "zmc",
+}
+
+# Setup argument parser for the verify-sizes subcommand
+def parse_verify_sizes_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog='batch-transfer-script.py verify-sizes',
+        description='Compare count/bytes of every subfolder of an original Dropbox folder with its WASABI-MIGRATION staged copy')
+    parser.add_argument('--parent', default='Media Files Online Backup 8-31-2020',
+                        help='Parent folder, relative to the Dropbox root (default: "Media Files Online Backup 8-31-2020")')
+    parser.add_argument('--out-dir', default=None,
+                        help='Where to write original_*/staged_*_size.json files (default: logs/size-verification-<timestamp>)')
+    parser.add_argument('--tpslimit', type=float, default=1, help='Transactions per second, shared by both listings (default: 1)')
+    return parser.parse_args(argv)
+
+# File-name slug for a subfolder's *_size.json files
+def size_file_slug(subfolder):
+    return SIZE_FILE_SLUGS.get(subfolder) or re.sub(r'[^a-z0-9]+', '_', subfolder.lower()).strip('_')
+
+# Key for the files directly in the parent; they are compared but, like the documented
+# per-subfolder 'rclone size' commands, get no *_size.json file of their own
+TOP_LEVEL = "(top level files)"
+
+# Count/bytes per first-level subfolder from one recursive listing, in 'rclone size --json' shape
+# Directories are listed too, so an empty subfolder gets its zero totals like 'rclone size'.
+def subfolder_sizes(remote_path, limits):
+    list_cmd = [RCLONE, "lsjson", remote_path, "--recursive"] + limits
+    sizes = {}
+    for item in stream_lsjson(list_cmd):
+        if item.get("IsDir"):
+            if "/" not in item["Path"]:
+                sizes.setdefault(item["Path"], {"count": 0, "bytes": 0, "sizeless": 0})
+            continue
+        subfolder = item["Path"].split("/", 1)[0] if "/" in item["Path"] else TOP_LEVEL
+        totals = sizes.setdefault(subfolder, {"count": 0, "bytes": 0, "sizeless": 0})
+        totals["count"] += 1
+        if item.get("Size", -1) < 0:
+            totals["sizeless"] += 1
+        else:
+            totals["bytes"] += item["Size"]
+    return sizes
+
+# verify-sizes: one listing per parent instead of two 'rclone size' runs per subfolder
+def verify_sizes_main(argv):
+    args = parse_verify_sizes_arguments(argv)
+    log_dir, main_log, timestamp, hostname = setup_logging()
+
+    # SAFETY: read-only listings, but keep the parent inside the Dropbox root
+    if not args.parent or args.parent.startswith("/") or ".." in args.parent:
+        log_message(f"FATAL: Parent '{args.parent}' contains disallowed path characters", main_log, level="ERROR")
+        return 1
+    sides = {
+        "original": f"{SIZE_CHECK_REMOTE}/{args.parent}",
+        "staged": f"{SOURCE_BASE}/{args.parent}",
+    }
+    out_dir = args.out_dir or os.path.join(log_dir, f"size-verification-{timestamp}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    log_message(f"Starting size verification on {hostname}", main_log)
+    log_message(f"Command: {' '.join(sys.argv)}", main_log)
+
+    # Both parents are listed at the same time, splitting --tpslimit between them
+    budget = RateBudget(args.tpslimit, "off", len(sides))
+    def list_side(side):
+        with budget.lease() as limits:
+            log_message(f"Listing {side}: {sides[side]}", main_log)
+            return subfolder_sizes(sides[side], limits)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(sides)) as executor:
+            futures = {side: executor.submit(list_side, side) for side in sides}
+            sizes = {side: future.result() for side, future in futures.items()}
+    except subprocess.CalledProcessError as e:
+        log_message(f"LISTING ERROR: {str(e)}", main_log, level="ERROR")
+        if e.stderr:
+            log_message(e.stderr.strip(), main_log, level="ERROR")
+        return 1
+
+    # Same files and format as the hand-made ones: {"count":N,"bytes":N,"sizeless":N}
+    for side, folders in sizes.items():
+        for subfolder, totals in folders.items():
+            if subfolder == TOP_LEVEL:
+                continue
+            with open(os.path.join(out_dir, f"{side}_{size_file_slug(subfolder)}_size.json"), "w", encoding="utf-8") as f:
+                f.write(json.dumps(totals, separators=(",", ":")) + "\n")
+
+    header = f"{'Subfolder':<45} {'Original':>22} {'Staged':>22}  Size   Count"
+    rows = [header, "-" * len(header)]
+    mismatches = 0
+    for subfolder in sorted(set(sizes["original"]) | set(sizes["staged"]), key=str.lower):
+        original = sizes["original"].get(subfolder)
+        staged = sizes["staged"].get(subfolder)
+        def cell(totals):
+            return f"{totals['count']} / {format_size(totals['bytes'])}" if totals else "(missing)"
+        size_ok = bool(original and staged and original["bytes"] == staged["bytes"])
+        count_ok = bool(original and staged and original["count"] == staged["count"])
+        mismatches += not (size_ok and count_ok)
+        rows.append(f"{subfolder[:45]:<45} {cell(original):>22} {cell(staged):>22}  "
+                    f"{'match' if size_ok else 'DIFF ':<6} {'match' if count_ok else 'DIFF'}")
+
+    table = "\n".join(rows)
+    with open(os.path.join(out_dir, "size_comparison.txt"), "w", encoding="utf-8") as f:
+        f.write(table + "\n")
+    log_message("\n" + table, main_log)
+    log_message(f"Size files and comparison table written to {out_dir}", main_log)
+
+    if mismatches:
+        log_message(f"{mismatches} subfolder(s) differ between original and staged", main_log, level="ERROR")
+        return 1
+    log_message("All subfolders match in size and file count", main_log, level="SUCCESS")
+    return 0
+
+# Dropbox content_hash: SHA-256 of the concatenated SHA-256 digests of each 4 MiB block
+DROPBOX_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Dropbox content_hash of one local file (runs in a worker process)
+# Files are mapped with mmap so blocks are hashed straight from the page cache; mounts
+# that refuse mmap (some SMB/NFS setups) fall back to 4 MiB buffered reads.
+def dropbox_content_hash(path):
+    block_digests = []
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        try:
+            if size == 0:
+                raise ValueError("empty file")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, size, DROPBOX_BLOCK_SIZE):
+                    block_digests.append(hashlib.sha256(mapped[offset:offset + DROPBOX_BLOCK_SIZE]).digest())
+        except (ValueError, OSError):
+            block_digests = []
+            f.seek(0)
+            buffer = bytearray(DROPBOX_BLOCK_SIZE)
+            view = memoryview(buffer)
+            while True:
+                filled = 0
+                while filled < DROPBOX_BLOCK_SIZE:
+                    count = f.readinto(view[filled:])
+                    if not count:
+                        break
+                    filled += count
+                if not filled:
+                    break
+                block_digests.append(hashlib.sha256(view[:filled]).digest())
+                if filled < DROPBOX_BLOCK_SIZE:
+                    break
+    return hashlib.sha256(b"".join(block_digests)).hexdigest()
+
+# Worker entry point: (relative path, absolute path) -> (relative path, hash or None, error)
+def hash_local_file(item):
+    relative, absolute = item
+    try:
+        return relative, dropbox_content_hash(absolute), None
+    except OSError as e:
+        return relative, None, str(e)
+
+# Cache of local content hashes keyed by (path, size, mtime), so unchanged files are never rehashed
+class HashCache:
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                dropbox TEXT NOT NULL,
+                hashed_at REAL NOT NULL
+            )
+        """)
+        self.db.commit()
+
+    # Cached hash for a file, or None when the file is new or changed since it was hashed
+    def get(self, path, size, mtime_ns):
+        row = self.db.execute("SELECT dropbox FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                              (path, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    # rows: [(path, size, mtime_ns, hash)]
+    def put_many(self, rows):
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO hashes (path, size, mtime_ns, dropbox, hashed_at) VALUES (?, ?, ?, ?, ?)",
+                            [(path, size, mtime_ns, digest, now) for path, size, mtime_ns, digest in rows])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+# Setup argument parser for the verify-local subcommand
+def parse_verify_local_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog='batch-transfer-script.py verify-local',
+        description='Verify NAS copies by hashing them locally (Dropbox content_hash) against one Dropbox listing')
+    parser.add_argument('folders', nargs='+', help='Folder(s) to verify (must be in WASABI-MIGRATION)')
+    parser.add_argument('--subpath', default='', help='Subpath within WASABI-MIGRATION (e.g., "Media Files Online Backup 8-31-2020")')
+    parser.add_argument('--local-root', default='/volume1/Backups/WASABI-MIGRATION',
+                        help='Local path or mount of the DS423 WASABI-MIGRATION folder (default: /volume1/Backups/WASABI-MIGRATION)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='Hashing processes (default: number of CPUs)')
+    parser.add_argument('--hash-cache', default=None, help='SQLite hash cache (default: logs/hash_cache.sqlite)')
+    parser.add_argument('--tpslimit', type=float, default=2, help='Transactions per second for the Dropbox listing (default: 2)')
+    parser.add_argument('--manifest-ttl', type=float, default=12, help='Hours a cached source listing stays valid, 0 disables the cache (default: 12)')
+    parser.add_argument('--refresh-manifests', action='store_true', help='Ignore cached source listings and list Dropbox again')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
+# Hash every local file that has a source entry; returns ({path: status}, hashed, cached)
+# Only new or changed files (by size and mtime) are read; the rest come from the cache.
+def local_hash_results(source_files, local_dir, cache, workers, main_log):
+    results = {}
+    todo = []
+    stats = {}
+    cached = 0
+    for relative, entry in sorted(source_files.items()):
+        absolute = os.path.join(local_dir, *relative.split("/"))
+        try:
+            st = os.stat(absolute)
+        except FileNotFoundError:
+            results[relative] = "missing"
+            continue
+        if st.st_size != entry["size"]:
+            results[relative] = "differ"
+            continue
+        if not entry["hashes"].get("dropbox"):
+            # Without a source hash only the size can be compared: not a content match
+            results[relative] = "size match"
+            continue
+        digest = cache.get(absolute, st.st_size, st.st_mtime_ns)
+        if digest is not None:
+            cached += 1
+            results[relative] = "match" if digest == entry["hashes"]["dropbox"] else "differ"
+        else:
+            stats[relative] = (absolute, st.st_size, st.st_mtime_ns)
+            todo.append((relative, absolute))
+
+    # Big files first, so one huge video does not start last and hold up the pool
+    todo.sort(key=lambda item: -stats[item[0]][1])
+    total_bytes = sum(stats[relative][1] for relative, _ in todo)
+    log_message(f"Hashing {len(todo)} file(s), {format_size(total_bytes)} with {workers} process(es); "
+                f"{cached} unchanged file(s) taken from the hash cache", main_log)
+    pending_rows = []
+    done_bytes = 0
+    last_report = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for relative, digest, error in pool.map(hash_local_file, todo, chunksize=8):
+            absolute, size, mtime_ns = stats[relative]
+            done_bytes += size
+            if error:
+                results[relative] = "error"
+                log_message(f"Cannot hash {absolute}: {error}", main_log, level="WARNING")
+                continue
+            pending_rows.append((absolute, size, mtime_ns, digest))
+            results[relative] = "match" if digest == source_files[relative]["hashes"]["dropbox"] else "differ"
+            # Flush the cache now and then so an interrupted run keeps most of its work
+            if len(pending_rows) >= 500 or time.time() - last_report >= 60:
+                cache.put_many(pending_rows)
+                pending_rows = []
+                log_message(f"Hashed {format_size(done_bytes)} of {format_size(total_bytes)}", main_log)
+                last_report = time.time()
+    cache.put_many(pending_rows)
+    return results, len(todo), cached
+
+# verify-local: hash the NAS copies locally instead of having rclone read them back
+def verify_local_main(argv):
+    args = parse_verify_local_arguments(argv)
+    log_dir, main_log, timestamp, hostname = setup_logging()
+
+    result = validate_paths(args.folders, args.subpath, main_log)
+    if not result:
+        return 1
+    _, full_source_base, _ = result
+    local_base = os.path.join(args.local_root, *args.subpath.split("/")) if args.subpath else args.local_root
+    if not os.path.isdir(local_base):
+        log_message(f"FATAL: Local destination {local_base} is not a directory (is the NAS mounted?)", main_log, level="ERROR")
+        return 1
+
+    log_message(f"Starting local hash verification on {hostname}", main_log)
+    log_message(f"Command: {' '.join(sys.argv)}", main_log)
+
+    cache = HashCache(args.hash_cache or os.path.join(log_dir, "hash_cache.sqlite"))
+    journal = TransferJournal(os.path.join(log_dir, "transfer_journal.sqlite"))
+    budget = RateBudget(args.tpslimit, "off", 1)
+    failures = 0
+    try:
+        for folder in args.folders:
+            source_path = f"{full_source_base}/{folder}"
+            local_dir = os.path.join(local_base, folder)
+            # Same manifest file the transfer run writes, so a verify right after a transfer lists nothing
+            path = manifest_file(log_dir, "source", folder, args.subpath)
+            manifest = None if args.refresh_manifests else cached_manifest(path, source_path, args.manifest_ttl,
+                                                                            folder, "source", main_log)
+            if manifest is None:
+                log_message(f"[{folder}] Listing source: {source_path}", main_log)
+                try:
+                    with budget.lease() as limits:
+                        manifest = save_manifest(path, source_path, list_remote(source_path, limits))
+                except subprocess.CalledProcessError as e:
+                    log_message(f"[{folder}] LISTING ERROR: {str(e)}", main_log, level="ERROR")
+                    failures += 1
+                    continue
+
+            folder_start_time = time.time()
+            results, hashed, cached = local_hash_results(manifest["files"], local_dir, cache, args.workers, main_log)
+            unhashed = sum(1 for entry in manifest["files"].values() if not entry["hashes"].get("dropbox"))
+
+            summary = {}
+            for status in results.values():
+                summary[status] = summary.get(status, 0) + 1
+            failed = sorted(path for path, status in results.items() if status not in ("match", "size match"))
+            report = {
+                "folder": folder,
+                "subpath": args.subpath,
+                "local_dir": local_dir,
+                "mode": "full",
+                "method": "local dropbox content_hash",
+                "checked_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                "hashed": hashed,
+                "from_cache": cached,
+                "size_only": unhashed,
+                "verified": summary.get("match", 0),
+                "summary": summary,
+                "files": [{"path": path, "status": status} for path, status in sorted(results.items())],
+            }
+            report_path = os.path.join(log_dir, f"{folder_key(folder, args.subpath)}-{timestamp}-verify-local.json")
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            # A local check covers the whole folder, so it counts for --full-check-every, unless
+            # some of its files could only be compared by size
+            if unhashed:
+                log_message(f"[{folder}] {unhashed} files have no Dropbox hash and were compared by size only; "
+                            f"not recorded as a full check", main_log, level="WARNING")
+            else:
+                journal.record_full_check(folder_key(folder, args.subpath), len(failed))
+
+            counts = ", ".join(f"{count} {status}" for status, count in sorted(summary.items())) or "nothing to check"
+            log_message(f"[{folder}] Checked in {format_duration(time.time() - folder_start_time)}: {hashed} hashed, "
+                        f"{cached} from cache, {unhashed} size only", main_log)
+            if failed:
+                failures += 1
+                log_message(f"[{folder}] Local verification found {len(failed)} differences ({counts}), see {report_path}",
+                            main_log, level="ERROR")
+            else:
+                log_message(f"[{folder}] Local verification passed ({counts})", main_log, level="SUCCESS")
+    except KeyboardInterrupt:
+        log_message("Local verification interrupted by user (Ctrl+C) - hashes computed so far are cached", main_log, level="WARNING")
+        return 130
+    finally:
+        cache.close()
+        journal.close()
+
+    return 1 if failures else 0
+
+# Per-stage time model fitted from the folder_stats history
+#   seconds = overhead + max(a * units / tpslimit, b * bytes / bwlimit)
+# units is the API-bound work of the stage (directories listed, files copied or checked)
+# and bytes its bandwidth-bound work. Each recorded run is attributed to whichever term
+# was larger; a and b are the medians of observed / ideal time over those runs, so a is
+# "API calls actually paid per unit" and b "how far below --bwlimit copies ran".
+class StageModel:
+    def __init__(self, name, a=1.0, b=1.0, overhead=2.0, samples=0):
+        self.name = name
+        self.a = a
+        self.b = b
+        self.overhead = overhead
+        self.samples = samples
+
+    # (API-bound seconds, bandwidth-bound seconds) for some work under the given limits
+    def terms(self, units, nbytes, tps, bw):
+        api = self.a * units / tps if tps > 0 else 0
+        band = self.b * nbytes / bw if bw > 0 else 0
+        return api, band
+
+    def predict(self, units, nbytes, tps, bw):
+        if not units and not nbytes:
+            return 0
+        return self.overhead + max(self.terms(units, nbytes, tps, bw))
+
+    @classmethod
+    def fit(cls, name, rows):
+        model = cls(name)
+        a_samples, b_samples, residuals = [], [], []
+        for units, nbytes, tps, bw, seconds in rows:
+            api, band = model.terms(units, nbytes, tps, bw)
+            if api >= band and api > 0:
+                a_samples.append(seconds / api)
+            elif band > 0:
+                b_samples.append(seconds / band)
+        if a_samples:
+            model.a = statistics.median(a_samples)
+        if b_samples:
+            model.b = statistics.median(b_samples)
+        for units, nbytes, tps, bw, seconds in rows:
+            residuals.append(seconds - max(model.terms(units, nbytes, tps, bw)))
+        if residuals:
+            model.overhead = max(0.0, statistics.median(residuals))
+        model.samples = len(rows)
+        return model
+
+# Fit listing, copy and verify models from the journal's folder history
+def fit_stage_models(history):
+    def rows(units, nbytes, seconds):
+        return [(row[units], row[nbytes] if nbytes else 0, row["tpslimit"], row["bwlimit"], row[seconds])
+                for row in history if row[units] > 0]
+    return {
+        "listing": StageModel.fit("listing", rows("listing_dirs", None, "listing_seconds")),
+        "copy": StageModel.fit("copy", rows("copy_files", "copy_bytes", "copy_seconds")),
+        "verify": StageModel.fit("verify", rows("verify_files", None, "verify_seconds")),
+    }
+
+# Predicted run of one pending folder under the full limits: solo seconds plus the API
+# and bandwidth work, in seconds-at-full-limits, that concurrent folders compete for
+def predict_folder(models, work, tps, bw):
+    stages = {
+        "listing": (work["dirs"], 0),
+        "copy": (work["copy_files"], work["copy_bytes"]),
+        "verify": (work["copy_files"], 0),
+    }
+    seconds = api = band = 0
+    for name, (units, nbytes) in stages.items():
+        seconds += models[name].predict(units, nbytes, tps, bw)
+        stage_api, stage_band = models[name].terms(units, nbytes, tps, bw)
+        api += stage_api
+        band += stage_band
+    return {"seconds": seconds, "api": api, "band": band, "bound": "API" if api >= band else "bandwidth"}
+
+# Simulate running folders in the given order on `lanes` worker slots
+# shared=True (rcd backend): all running folders draw on one token bucket and one bandwidth
+# limit, so an API-bound folder and a bandwidth-bound one overlap almost for free; every
+# running folder slows by the same factor when the summed demand exceeds either limit.
+# shared=False (subprocess backend): each folder gets a fixed 1/lanes share of both limits,
+# so predictions must already be made for that share; folders just queue for a free lane.
+# Returns {folder: (start, end)} in seconds from the start of the batch.
+def simulate_schedule(order, predictions, lanes, shared):
+    schedule = {}
+    if not shared:
+        free_at = [0.0] * lanes
+        for folder in order:
+            lane = min(range(lanes), key=lambda index: free_at[index])
+            schedule[folder] = (free_at[lane], free_at[lane] + predictions[folder]["seconds"])
+            free_at[lane] += predictions[folder]["seconds"]
+        return schedule
+
+    now = 0.0
+    pending = list(order)
+    running = {}
+    while pending or running:
+        while pending and len(running) < lanes:
+            folder = pending.pop(0)
+            running[folder] = 1.0
+            schedule[folder] = (now, None)
+        # Demand at full speed, as fractions of the API and bandwidth limits
+        api_demand = sum(predictions[f]["api"] / predictions[f]["seconds"] for f in running if predictions[f]["seconds"])
+        band_demand = sum(predictions[f]["band"] / predictions[f]["seconds"] for f in running if predictions[f]["seconds"])
+        speed = min(1.0, 1 / api_demand if api_demand > 1 else 1.0, 1 / band_demand if band_demand > 1 else 1.0)
+        step = min(remaining * max(predictions[f]["seconds"], 1e-9) / speed for f, remaining in running.items())
+        now += step
+        for folder in list(running):
+            seconds = max(predictions[folder]["seconds"], 1e-9)
+            running[folder] -= step * speed / seconds
+            if running[folder] <= 1e-9:
+                del running[folder]
+                schedule[folder] = (schedule[folder][0], now)
+    return schedule
+
+# Setup argument parser for the plan subcommand
+def parse_plan_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog='batch-transfer-script.py plan',
+        description='Predict transfer times from the run history and pick a folder order and concurrency')
+    parser.add_argument('folders', nargs='+', help='Pending folder(s) (must be in WASABI-MIGRATION)')
+    parser.add_argument('--subpath', default='', help='Subpath within WASABI-MIGRATION (e.g., "Media Files Online Backup 8-31-2020")')
+    parser.add_argument('--tpslimit', type=float, default=2, help='Transactions per second the batch will run with (default: 2)')
+    parser.add_argument('--bwlimit', default='10M', help='Bandwidth limit the batch will run with (default: 10M)')
+    parser.add_argument('--link-speed', default='50M', help='Assumed bandwidth when --bwlimit is off (default: 50M)')
+    parser.add_argument('--backend', choices=['rcd', 'subprocess'], default='rcd', help='Backend the batch will use (default: rcd)')
+    parser.add_argument('--max-parallel', type=int, default=4, help='Largest --parallel-folders to consider (default: 4)')
+    parser.add_argument('--manifest-ttl', type=float, default=168, help='Hours a cached listing is good enough for planning (default: 168)')
+    parser.add_argument('--refresh-manifests', action='store_true', help='List every folder again instead of using cached listings')
+    args = parser.parse_args(argv)
+    if args.max_parallel < 1:
+        parser.error("--max-parallel must be at least 1")
+    return args
+
+# plan: predict each pending folder, then choose order and --parallel-folders
+def plan_main(argv):
+    args = parse_plan_arguments(argv)
+    log_dir, main_log, timestamp, hostname = setup_logging()
+    result = validate_paths(args.folders, args.subpath, main_log)
+    if not result:
+        return 1
+    _, full_source_base, full_dest_base = result
+    log_message(f"Planning {len(args.folders)} folder(s) on {hostname}", main_log)
+
+    journal = TransferJournal(os.path.join(log_dir, "transfer_journal.sqlite"))
+    history = journal.folder_history()
+    journal.close()
+    models = fit_stage_models(history)
+    log_message(f"Time model from {len(history)} recorded folder run(s):", main_log)
+    for model in models.values():
+        log_message(f"  {model.name:<8} {model.overhead:.0f}s + max({model.a:.2f} x units / tps, "
+                    f"{model.b:.2f} x bytes / bwlimit)  ({model.samples} sample(s){'' if model.samples else ', defaults'})", main_log)
+
+    # Work per folder from one listing per side; cached listings are reused and new ones
+    # are saved where the transfer run will find them
+    budget = RateBudget(args.tpslimit, "off", 1)
+    work = {}
+    for folder in args.folders:
+        sides = {}
+        for side, base in (("source", full_source_base), ("dest", full_dest_base)):
+            remote_path = f"{base}/{folder}"
+            path = manifest_file(log_dir, side, folder, args.subpath)
+            manifest = None if args.refresh_manifests else cached_manifest(path, remote_path, args.manifest_ttl,
+                                                                            folder, side, main_log)
+            if manifest is None:
+                log_message(f"[{folder}] Listing {side}: {remote_path}", main_log)
+                try:
+                    with budget.lease() as limits:
+                        manifest = save_manifest(path, remote_path,
+                                                 list_remote(remote_path, limits, hashes=side == "source"))
+                except subprocess.CalledProcessError:
+                    # A destination that does not exist yet simply has nothing in it
+                    if side == "source":
+                        log_message(f"[{folder}] Cannot list the source; leaving it out of the plan", main_log, level="ERROR")
+                        break
+                    manifest = {"files": {}}
+            sides[side] = manifest
+        if "dest" not in sides:
+            continue
+        pending = diff_manifests(sides["source"], sides["dest"])
+        work[folder] = {"files": len(sides["source"]["files"]), "dirs": manifest_dirs(sides["source"]),
+                        "copy_files": len(pending), "copy_bytes": sum(max(item["size"], 0) for item in pending)}
+    if not work:
+        return 1
+
+    tps = args.tpslimit
+    bw = parse_bwlimit(args.bwlimit) or parse_bwlimit(args.link_speed)
+    predictions = {folder: predict_folder(models, item, tps, bw) for folder, item in work.items()}
+    # Longest predicted folder first (LPT), so the last folder to start is a short one
+    order = sorted(work, key=lambda folder: -predictions[folder]["seconds"])
+
+    shared = args.backend == "rcd"
+    options = {}
+    for lanes in range(1, min(args.max_parallel, len(order)) + 1):
+        lane_predictions = predictions if shared else {
+            folder: predict_folder(models, item, tps / lanes, bw / lanes) for folder, item in work.items()}
+        schedule = simulate_schedule(order, lane_predictions, lanes, shared)
+        options[lanes] = (max(end for _, end in schedule.values()), schedule)
+    best = min(options, key=lambda lanes: (round(options[lanes][0]), lanes))
+    makespan, schedule = options[best]
+
+    started = datetime.datetime.now()
+    header = f"{'Folder':<40} {'Files':>8} {'To copy':>18} {'Bound':>9} {'Alone':>10} {'Start':>10} {'Done':>10}"
+    rows = [header, "-" * len(header)]
+    for folder in order:
+        item, p = work[folder], predictions[folder]
+        start, end = schedule[folder]
+        rows.append(f"{folder[:40]:<40} {item['files']:>8} {item['copy_files']:>7} / {format_size(item['copy_bytes']):>8} "
+                    f"{p['bound']:>9} {format_duration(p['seconds']):>10} {format_duration(start):>10} {format_duration(end):>10}")
+    log_message("\n" + "\n".join(rows), main_log)
+    for lanes, (total, _) in sorted(options.items()):
+        log_message(f"  --parallel-folders {lanes}: {format_duration(total)}{'  <- best' if lanes == best else ''}", main_log)
+
+    completion = started + datetime.timedelta(seconds=makespan)
+    quoted = " ".join(f'"{folder}"' for folder in order)
+    subpath = f' --subpath "{args.subpath}"' if args.subpath else ""
+    command = (f"python3 batch-transfer-script.py {quoted}{subpath} --tpslimit {args.tpslimit:g} --bwlimit {args.bwlimit} "
+               f"--backend {args.backend} --parallel-folders {best} --max-listings {best} --max-copies {best} --max-verifies {best}")
+    log_message(f"Expected completion: {completion.strftime('%b %d, %Y %H:%M')} ({format_duration(makespan)})", main_log, level="SUCCESS")
+    log_message(f"Suggested command:\n{command}", main_log)
+
+    plan_path = os.path.join(log_dir, f"plan-{timestamp}.json")
+    with open(plan_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "created": started.isoformat(timespec="seconds"),
+            "settings": vars(args),
+            "history_runs": len(history),
+            "models": {name: {"a": m.a, "b": m.b, "overhead": m.overhead, "samples": m.samples} for name, m in models.items()},
+            "parallel_folders": best,
+            "makespan_seconds": makespan,
+            "expected_completion": completion.isoformat(timespec="minutes"),
+            "order": [dict(folder=folder, **work[folder], **predictions[folder],
+                           start_seconds=schedule[folder][0], end_seconds=schedule[folder][1]) for folder in order],
+            "command": command,
+        }, f, indent=2)
+    log_message(f"Plan written to {plan_path}", main_log)
+    return 0
+
 # Main function
+# Stop an interrupted run: no folder starts another stage, the rcd daemon's jobs are stopped
+# (it runs in its own session, so Ctrl+C never reaches it), and the folder threads get a
+# moment to record in the journal what they finished before the process exits
+def interrupt_run(ctx, executor, futures, grace=30):
+    ctx.scheduler.cancel()
+    stopped = ctx.backend.stop_jobs()
+    if stopped:
+        log_message(f"Stopped {stopped} running rclone rc job(s)", ctx.main_log, level="WARNING")
+    for controller in ctx.controllers.values():
+        controller.stop()
+    if executor:
+        executor.shutdown(wait=False, cancel_futures=True)
+    if ctx.full_s3_base:
+        ctx.upload_pool.shutdown(wait=False, cancel_futures=True)
+        futures = list(futures) + ctx.uploads
+    try:
+        _, running = concurrent.futures.wait(futures, timeout=grace)
+    except KeyboardInterrupt:
+        return
+    if running:
+        log_message(f"{len(running)} folder(s) still busy after {grace}s; exiting anyway", ctx.main_log, level="WARNING")
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "verify-sizes":
+        return verify_sizes_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "verify-local":
+        return verify_local_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "plan":
+        return plan_main(sys.argv[2:])
+
     args = parse_arguments()
     log_dir, main_log, timestamp, hostname = setup_logging()
-    
+
     # Print banner
     print_safety_banner(main_log)
-    
+
+    journal = TransferJournal(os.path.join(log_dir, "transfer_journal.sqlite"))
+    if args.resume:
+        # The folder list and subpath come from the journal; transfer settings from this command line
+        run = journal.load_run(args.resume)
+        if run is None:
+            log_message(f"FATAL: Run '{args.resume}' is not in the transfer journal ({journal.path})", main_log, level="ERROR")
+            sys.exit(1)
+        args.folders = run["folders"]
+        args.subpath = run["subpath"]
+        log_message(f"Resuming run {args.resume}: {len(args.folders)} folder(s)", main_log)
+
     # SAFETY: Validate paths
     result = validate_paths(args.folders, args.subpath, main_log)
     if not result:
         sys.exit(1)
     else:
         valid, full_source_base, full_dest_base = result
-    
+
     # Log script execution
-    log_message(f"Starting batch transfer script v4.0 on {hostname}", main_log)
+    log_message(f"Starting batch transfer script v5.0 on {hostname}", main_log)
     log_message(f"Command: {' '.join(sys.argv)}", main_log)
-    
+
+    backend = start_backend(args, log_dir, timestamp, main_log)
+    # Every exit path below must also stop the rcd daemon
+    atexit.register(backend.close)
+
     # Verify basic access before proceeding
     try:
         log_message("Checking source access...", main_log)
-        subprocess.run(["rclone", "lsd", SOURCE_BASE.split(":")[0] + ":"], check=True, capture_output=True)
+        backend.lsd(SOURCE_BASE.split(":")[0] + ":")
         log_message("Source remote accessible", main_log)
-        
+
         log_message("Checking destination access...", main_log)
-        subprocess.run(["rclone", "lsd", DEST_BASE.split(":")[0] + ":"], check=True, capture_output=True)
+        backend.lsd(DEST_BASE.split(":")[0] + ":")
         log_message("Destination remote accessible", main_log)
     except subprocess.CalledProcessError as e:
         log_message(f"ACCESS ERROR: {str(e)}", main_log, level="ERROR")
         log_message("Cannot access remotes, aborting for safety.", main_log, level="ERROR")
         sys.exit(1)
-    
+
     # Get terminal dimensions for progress display
     try:
         terminal_width = shutil.get_terminal_size().columns
     except:
         terminal_width = 80  # Default width if unable to determine
-    
+
+    try:
+        ctx = RunContext(args, full_source_base, full_dest_base, log_dir, main_log, timestamp, terminal_width, journal, backend)
+    except ValueError as e:
+        log_message(f"FATAL: {str(e)}", main_log, level="ERROR")
+        sys.exit(1)
+
+    if not args.resume:
+        journal.start_run(ctx.run_id, args, hostname)
+    log_message(f"Run ID: {ctx.run_id} (transfer journal: {journal.path})", main_log)
+    worker = resume_folder if args.resume else process_folder
+    if args.dedup and args.resume:
+        log_message("--dedup is ignored with --resume (the journal rows are copied as they are)", main_log, level="WARNING")
+    elif args.dedup:
+        ctx.dedup = build_dedup_index(ctx)
+        worker = process_folder_dedup
+
+    budget = ctx.scheduler.budget
+    log_message(f"Scheduling {len(args.folders)} folder(s), up to {args.parallel_folders} at a time "
+                f"(listing={args.max_listings}, copy={args.max_copies}, verify={args.max_verifies})", main_log)
+    if backend.daemon:
+        log_message(f"Shared rate budget: --tpslimit={args.tpslimit:g} --bwlimit={args.bwlimit} held by the "
+                    f"rclone rcd daemon for all of its jobs", main_log)
+    else:
+        log_message(f"Shared rate budget: --tpslimit={args.tpslimit:g} --bwlimit={args.bwlimit} split across "
+                    f"{budget.slots} rclone process slot(s): {' '.join(budget.flags())} each", main_log)
+
     # Process each folder in the list
-    for folder in args.folders:
-        folder_start_time = time.time()
-        folder_log = f"{log_dir}/{folder.replace(' ', '_')}-{timestamp}.log"
-        
-        log_message("\n" + "="*80, main_log)
-        log_message(f"STARTING PROCESS FOR: {folder}", main_log)
-        log_message("="*80, main_log)
-        
-        # Create destination directory if it doesn't exist
-        try:
-            mkdir_cmd = ["rclone", "mkdir", f"{full_dest_base}/{folder}"]
-            subprocess.run(mkdir_cmd, check=True, capture_output=True)
-            log_message(f"Destination folder created/verified: {folder}", main_log)
-        except subprocess.CalledProcessError as e:
-            log_message(f"ERROR creating destination folder: {str(e)}", main_log, level="ERROR")
-            log_message("Skipping this folder for safety.", main_log, level="WARNING")
-            continue
-        
-        # Check source folder contents
-        try:
-            # Get folder size first
-            size_cmd = ["rclone", "size", f"{full_source_base}/{folder}", "--json"]
-            size_result = subprocess.run(size_cmd, check=True, capture_output=True, text=True)
-            
-            # Parse JSON response
-            try:
-                size_data = json.loads(size_result.stdout)
-                total_bytes = size_data.get("bytes", 0)
-                total_count = size_data.get("count", 0)
-            except json.JSONDecodeError as e:
-                log_message(f"WARNING: Could not parse folder size information: {str(e)}", main_log, level="WARNING")
-                log_message("Proceeding with transfer anyway.", main_log, level="WARNING")
-                total_bytes = 0
-                total_count = 0
-            
-            # Log the folder size
-            log_message(f"Folder contains {total_count} files totaling {format_size(total_bytes)}", main_log)
-            
-            # DRY RUN first
-            log_message(f"\nStarting DRY RUN for {folder}...", main_log)
-            dry_run_cmd = [
-                "rclone", "copy",
-                f"{full_source_base}/{folder}",
-                f"{full_dest_base}/{folder}",
-                "--dry-run",
-                "--progress",
-                "--checksum",
-                f"--transfers={args.transfers}",
-                f"--checkers={args.checkers}",
-                f"--tpslimit={args.tpslimit}", 
-                f"--bwlimit={args.bwlimit}",
-                "--stats=15s"
-            ]
-            
-            log_message(f"Command: {' '.join(dry_run_cmd)}", main_log)
-            dry_run = subprocess.run(dry_run_cmd, capture_output=True, text=True)
-            
-            # Log the dry run output
-            log_message("\n--- DRY RUN OUTPUT ---", main_log, also_print=False)
-            with open(folder_log, "a", encoding="utf-8") as f:
-                f.write("\n--- DRY RUN OUTPUT ---\n")
-                f.write(dry_run.stdout)
-                if dry_run.stderr:
-                    f.write("\nERRORS:\n")
-                    f.write(dry_run.stderr)
-                f.write("\n--- END DRY RUN OUTPUT ---\n")
-            
-            # Show a summary
-            if "Transferred:" in dry_run.stdout:
-                transfer_lines = [line for line in dry_run.stdout.split("\n") if "Transferred:" in line and "ETA" in line]
-                if transfer_lines:
-                    log_message(f"Dry run summary: {transfer_lines[-1]}", main_log)
-            
-            log_message("DRY RUN completed - NO FILES WERE TRANSFERRED", main_log)
-            log_message("Review the logs in the 'logs' folder carefully.", main_log)
-            
-            # If dry-run-only flag is set, skip the actual transfer
-            if args.dry_run_only:
-                log_message(f"Skipping actual transfer for {folder} (--dry-run-only specified)", main_log)
-                continue
-            
-            # Ask for confirmation unless --yes was specified
-            if not args.yes:
-                proceed = input(f"\nDo you want to proceed with the actual transfer of '{folder}'? (yes/no): ")
-                log_message(f"User chose to {'proceed' if proceed.lower() == 'yes' else 'cancel'} the transfer.", main_log)
-                
-                if proceed.lower() != "yes":
-                    log_message(f"Skipping actual transfer for {folder} based on user decision", main_log)
-                    continue
-            
-            log_message(f"\nSTARTING ACTUAL TRANSFER for {folder}...", main_log)
-            
-            # Build the actual transfer command (remove --dry-run)
-            actual_cmd = [
-                "rclone", "copy",
-                f"{full_source_base}/{folder}",
-                f"{full_dest_base}/{folder}",
-                "--progress",
-                "--checksum",
-                f"--transfers={args.transfers}",
-                f"--checkers={args.checkers}",
-                f"--tpslimit={args.tpslimit}",
-                f"--bwlimit={args.bwlimit}",
-                "--stats=15s",
-                f"--log-file={folder_log}"
-            ]
-            
-            log_message(f"Command: {' '.join(actual_cmd)}", main_log)
-            
-            try:
-                # Better progress monitoring with cleaner display
-                log_message("Starting transfer process...", main_log)
-                log_message("Progress updates will appear below (press Ctrl+C to stop):", main_log)
-                print()  # Extra line before progress begins
-                
-                # Use subprocess.Popen to capture output in real-time
-                process = subprocess.Popen(
-                    actual_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    bufsize=1,
-                    universal_newlines=True
-                )
-                
-                # Print only the most recent status, overwriting previous output
-                # Create a 4-line status display area
-                print("\n\n\n\n")  # 4 blank lines
-                
-                try:
-                    for line in iter(process.stdout.readline, ''):
-                        line = line.rstrip()
-                        if line:
-                            # Log all lines to file
-                            with open(folder_log, "a", encoding="utf-8") as f:
-                                f.write(line + "\n")
-                            
-                            # Only display status lines with progress info
-                            if ("Transferred:" in line or "Transferring:" in line or 
-                                "Elapsed time:" in line or line.strip().startswith("*")):
-                                
-                                # Move up 4 lines
-                                sys.stdout.write('\033[4A')
-                                # Clear lines
-                                sys.stdout.write('\033[J')
-                                
-                                # Create a 4-line status block
-                                lines = []
-                                if "Transferred:" in line and "ETA" in line:
-                                    lines.append(f"Status: {line}")
-                                elif "Transferred:" in line:
-                                    lines.append(f"Files: {line}")
-                                elif "Elapsed time:" in line:
-                                    lines.append(f"Time: {line}")
-                                elif "Transferring:" in line:
-                                    lines.append("Current files:")
-                                elif line.strip().startswith("*"):
-                                    # Format current file info
-                                    file_info = line.strip()
-                                    # Truncate if too long for display
-                                    if len(file_info) > terminal_width - 3:
-                                        file_info = file_info[:terminal_width - 6] + "..."
-                                    lines.append(f"  {file_info}")
-                                
-                                # Print status block
-                                for status_line in lines[:4]:  # Limit to 4 lines
-                                    print(status_line)
-                                
-                                # Fill any remaining lines with blanks
-                                for _ in range(4 - len(lines)):
-                                    print()
-                                
-                                # Flush output
-                                sys.stdout.flush()
-                except:
-                    # If any errors with display, fall back to basic logging
-                    log_message("Advanced display error. Check log file for progress.", main_log, level="WARNING")
-                    # Continue reading output to capture in log
-                    for line in iter(process.stdout.readline, ''):
-                        with open(folder_log, "a", encoding="utf-8") as f:
-                            f.write(line)
-                
-                # Wait for the process to complete
-                process.wait()
-                
-                # Move past the status display
-                print("\n\n\n")
-                
-                if process.returncode == 0:
-                    log_message("Transfer completed successfully", main_log, level="SUCCESS")
-                else:
-                    log_message(f"Transfer process exited with code: {process.returncode}", main_log, level="WARNING")
-                
-                # Skip verification if requested
-                if args.no_verify:
-                    log_message("Skipping verification (--no-verify specified)", main_log)
-                else:
-                    # Verification step
-                    log_message("\nStarting verification...", main_log)
-                    verify_cmd = [
-                        "rclone", "check",
-                        f"{full_source_base}/{folder}",
-                        f"{full_dest_base}/{folder}",
-                        "--one-way"
-                    ]
-                    
-                    log_message(f"Verification command: {' '.join(verify_cmd)}", main_log)
-                    verify_result = subprocess.run(verify_cmd, capture_output=True, text=True)
-                    
-                    # Log verification results
-                    with open(folder_log, "a", encoding="utf-8") as f:
-                        f.write("\n--- VERIFICATION RESULTS ---\n")
-                        f.write(verify_result.stdout)
-                        if verify_result.stderr:
-                            f.write("\nVERIFICATION ERRORS:\n")
-                            f.write(verify_result.stderr)
-                        f.write("\n--- END VERIFICATION RESULTS ---\n")
-                    
-                    if "0 differences found" in verify_result.stdout or verify_result.returncode == 0:
-                        log_message("Verification passed - All files match", main_log, level="SUCCESS")
-                    else:
-                        log_message("Verification found differences, check the log file", main_log, level="ERROR")
-                
-            except KeyboardInterrupt:
-                log_message("\nTransfer interrupted by user (Ctrl+C)", main_log, level="WARNING")
-                log_message("The transfer can be resumed by running the same command again.", main_log)
-                log_message("Rclone will skip files that have already been transferred.", main_log)
-            except Exception as e:
-                log_message(f"Error during transfer: {str(e)}", main_log, level="ERROR")
-            
-            # Calculate and log timing
-            folder_duration = time.time() - folder_start_time
-            minutes, seconds = divmod(folder_duration, 60)
-            hours, minutes = divmod(minutes, 60)
-            
-            log_message(f"\nTime taken: {int(hours)}h {int(minutes)}m {int(seconds)}s", main_log)
-            if total_bytes > 0 and folder_duration > 0:
-                transfer_rate = total_bytes / folder_duration / (1024 * 1024)  # MB/s
-                log_message(f"Average transfer rate: {transfer_rate:.2f} MB/s", main_log)
-        
-        except Exception as e:
-            log_message(f"Unexpected error processing folder {folder}: {str(e)}", main_log, level="ERROR")
-            log_message("Continuing to next folder for safety.", main_log, level="WARNING")
+    executor = None
+    futures = []
+    try:
+        if args.parallel_folders == 1:
+            for folder in args.folders:
+                worker(folder, ctx)
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel_folders)
+            futures = [executor.submit(worker, folder, ctx) for folder in args.folders]
+            concurrent.futures.wait(futures)
+        if ctx.full_s3_base and ctx.uploads:
+            log_message(f"Waiting for {sum(1 for upload in ctx.uploads if not upload.done())} S3 upload(s) to finish...", main_log)
+            concurrent.futures.wait(ctx.uploads)
+    except KeyboardInterrupt:
+        log_message("Batch interrupted by user (Ctrl+C) - stopping running rclone work", main_log, level="WARNING")
+        interrupt_run(ctx, executor, futures)
+        log_message(f"Remaining folders were not started; continue with --resume {ctx.run_id}", main_log, level="WARNING")
+        return 130
+
+    for controller in ctx.controllers.values():
+        controller.stop()
 
     log_message("\n" + "="*80, main_log)
     log_message("ALL FOLDERS PROCESSED", main_log)
     log_message("=" * 80, main_log)
+    if ctx.dedup:
+        # One Dropbox download call per file that was copied on the destination instead
+        log_message(f"Dedup saved {ctx.dedup.saved_files} downloads: {format_size(ctx.dedup.saved_bytes)} and about "
+                    f"{ctx.dedup.saved_files} Dropbox API calls", main_log, level="SUCCESS")
+    if ctx.full_s3_base:
+        uploaded = sum(1 for upload in ctx.uploads if upload.result())
+        log_message(f"S3 second hop: {uploaded} of {len(ctx.uploads)} queued folder(s) uploaded and verified "
+                    f"in {ctx.full_s3_base}", main_log, level="SUCCESS" if uploaded == len(ctx.uploads) else "WARNING")
     log_message(f"Log files are available in the '{log_dir}' directory", main_log)
     log_message("Please document these transfers in your migration dashboard", main_log)
-    
+
     # Return success
     return 0
 
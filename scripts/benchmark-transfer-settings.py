@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Storage Migration: Transfer Settings Benchmark
+
+Version: 1.0
+Date: October 18, 2026
+
+Measures batch-transfer-script.py against local stand-in remotes instead of picking
+--transfers/--checkers/--tpslimit by folklore:
+- Generates synthetic folders shaped like the real ones (many small photos, a few
+  huge videos, lots of tiny font files)
+- Runs the full batch pipeline (listing, copy, verification) once per settings
+  combination, against scripts/fake-rclone.py with injected API latency and a
+  per-second API quota, or against a real rclone binary using local alias remotes
+- Reports wall time, throughput, API calls and throttled calls per stage
+- --s3 adds the second hop (DS423 -> S3): against a local directory with the fake, or
+  against a local S3 server (moto_server, MinIO) given by --s3-endpoint with real rclone
+- --autotune recommends the fastest unthrottled settings for each folder profile
+
+Nothing here touches Dropbox or the NAS: all remotes live under --workdir.
+
+Example:
+    python3 scripts/benchmark-transfer-settings.py --transfers 2,4,8 --tpslimit 1,2,4 --autotune
+    python3 scripts/benchmark-transfer-settings.py --extra-args=--shard
+    python3 scripts/benchmark-transfer-settings.py --extra-args="--backend subprocess"
+    python3 scripts/benchmark-transfer-settings.py --s3 --extra-args="--s3-chunk-size 8M"
+    python3 scripts/benchmark-transfer-settings.py --rclone rclone --s3 --s3-endpoint http://127.0.0.1:5000
+"""
+
+import argparse
+import subprocess
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import itertools
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+BATCH_SCRIPT = os.path.join(SCRIPT_DIR, "batch-transfer-script.py")
+FAKE_RCLONE = os.path.join(SCRIPT_DIR, "fake-rclone.py")
+
+# Remote names and layout used by batch-transfer-script.py (SOURCE_BASE / DEST_BASE)
+SOURCE_REMOTE = "dropbox-wasabi-migration"
+DEST_REMOTE = "DS423"
+BENCH_SUBPATH = "BENCHMARK"
+# S3 stand-in for the second hop; every run uploads under its own prefix
+S3_REMOTE = "s3-bench"
+S3_BUCKET = "wasabi-migration-bench"
+
+# Synthetic folder profiles, shaped like the real "Media Files Online Backup" folders
+#   count     number of files (multiplied by --scale)
+#   size      (min, max) file size in bytes (multiplied by --size-scale)
+#   fanout    files per subdirectory
+PROFILES = {
+    "photos": {"like": "PHOTO ARCHIVES, Volunteer Appreciation", "count": 300, "size": (20_000, 400_000), "fanout": 40},
+    "videos": {"like": "Mountain Seat Ceremonies, development media", "count": 4, "size": (6_000_000, 16_000_000), "fanout": 4},
+    "fonts": {"like": "Fonts, Logos, 2020 Letterhead and Envelopes", "count": 400, "size": (2_000, 60_000), "fanout": 25},
+}
+
+# Setup argument parser
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark batch-transfer-script.py settings against local stand-in remotes')
+    parser.add_argument('--workdir', default='bench', help='Scratch directory for remotes, logs and results (default: bench)')
+    parser.add_argument('--profiles', default=','.join(PROFILES), help=f'Profiles to run (default: {",".join(PROFILES)})')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply file counts (default: 1.0)')
+    parser.add_argument('--size-scale', type=float, default=1.0, help='Multiply file sizes (default: 1.0)')
+    parser.add_argument('--transfers', default='2,4,8', help='Comma-separated --transfers values (default: 2,4,8)')
+    parser.add_argument('--checkers', default='', help='Comma-separated --checkers values (default: 2x transfers)')
+    parser.add_argument('--tpslimit', default='1,2,4', help='Comma-separated --tpslimit values (default: 1,2,4)')
+    parser.add_argument('--bwlimit', default='40M', help='--bwlimit for every run (default: 40M)')
+    parser.add_argument('--extra-args', default='', help='Extra arguments passed to batch-transfer-script.py; use the = form, '
+                             'e.g. --extra-args=--shard or --extra-args="--backend subprocess"')
+    parser.add_argument('--latency', type=float, default=0.03, help='Fake rclone: seconds per API call (default: 0.03)')
+    parser.add_argument('--quota', type=float, default=10, help='Fake rclone: source API calls per second before too_many_requests (default: 10)')
+    parser.add_argument('--stream-bw', default='4M', help='Fake rclone: bytes per second of one download stream (default: 4M)')
+    parser.add_argument('--rclone', help='Use this real rclone binary with local alias remotes instead of the fake')
+    parser.add_argument('--s3', action='store_true', help='Also run the second hop to an S3 stand-in (--s3-remote)')
+    parser.add_argument('--s3-endpoint', help='Real rclone: endpoint of a local S3 server for --s3, e.g. moto_server or MinIO '
+                                              '(credentials from AWS_ACCESS_KEY_ID/AWS_SECRET_ACCESS_KEY, default: test/test)')
+    parser.add_argument('--autotune', action='store_true', help='Recommend the fastest unthrottled settings per profile')
+    parser.add_argument('--seed', type=int, default=423, help='Random seed for the synthetic trees (default: 423)')
+    return parser.parse_args()
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+def float_list(value):
+    return [float(item) for item in value.split(",") if item.strip()]
+
+# Format file size for human readability
+def format_size(size_bytes):
+    if size_bytes < 1024 * 1024:
+        return f"{size_bytes/1024:.1f} KB"
+    elif size_bytes < 1024 * 1024 * 1024:
+        return f"{size_bytes/(1024*1024):.1f} MB"
+    return f"{size_bytes/(1024*1024*1024):.2f} GB"
+
+# Generate a synthetic source folder for one profile; returns (files, bytes)
+# The marker describing a generated folder is kept next to the remotes, outside every
+# remote, so it is never listed or copied with the folder.
+def generate_profile(root, name, profile, scale, size_scale, seed):
+    folder = os.path.join(root, SOURCE_REMOTE, "WASABI-MIGRATION", BENCH_SUBPATH, name)
+    marker = os.path.join(root, f".generated-{name}.json")
+    spec = {"profile": profile, "scale": scale, "size_scale": size_scale, "seed": seed}
+    if os.path.exists(marker):
+        with open(marker, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached["spec"] == spec:
+            return cached["files"], cached["bytes"]
+    shutil.rmtree(folder, ignore_errors=True)
+
+    rng = random.Random(f"{seed}-{name}")
+    count = max(1, int(profile["count"] * scale))
+    low, high = (int(size * size_scale) for size in profile["size"])
+    total = 0
+    for index in range(count):
+        subdir = os.path.join(folder, f"set_{index // profile['fanout']:03d}")
+        os.makedirs(subdir, exist_ok=True)
+        size = rng.randint(low, max(low, high))
+        with open(os.path.join(subdir, f"{name}_{index:05d}.bin"), "wb") as f:
+            f.write(rng.randbytes(size))
+        total += size
+    with open(marker, "w", encoding="utf-8") as f:
+        json.dump({"spec": spec, "files": count, "bytes": total}, f)
+    return count, total
+
+# rclone config with local alias remotes named like the real ones (real rclone mode),
+# plus an S3 remote for the second hop when an endpoint is given
+def write_alias_config(root, path, s3_endpoint=None):
+    with open(path, "w", encoding="utf-8") as f:
+        for remote in (SOURCE_REMOTE, DEST_REMOTE):
+            os.makedirs(os.path.join(root, remote), exist_ok=True)
+            f.write(f"[{remote}]\ntype = alias\nremote = {os.path.join(root, remote)}\n\n")
+        if s3_endpoint:
+            f.write(f"[{S3_REMOTE}]\ntype = s3\nprovider = Other\nendpoint = {s3_endpoint}\n"
+                    f"access_key_id = {os.environ.get('AWS_ACCESS_KEY_ID', 'test')}\n"
+                    f"secret_access_key = {os.environ.get('AWS_SECRET_ACCESS_KEY', 'test')}\n"
+                    f"region = us-east-1\nforce_path_style = true\n\n")
+    return path
+
+# Map rclone commands to pipeline stages
+def stage_of(command):
+    if command in ("lsjson", "size"):
+        return "listing"
+    if command in ("copy", "copyto"):
+        return "copy"
+    if command in ("check", "hashsum"):
+        return "verify"
+    if command == "upload":
+        return "upload"
+    return "setup"
+
+# Run the batch pipeline once for one profile and one settings combination
+def run_once(args, root, profile, settings, run_dir):
+    os.makedirs(run_dir, exist_ok=True)
+    shutil.rmtree(os.path.join(root, DEST_REMOTE), ignore_errors=True)
+    os.makedirs(os.path.join(root, DEST_REMOTE, "Backups"), exist_ok=True)
+    trace = os.path.join(run_dir, "trace.jsonl")
+
+    env = dict(os.environ)
+    if args.rclone:
+        env["RCLONE_BIN"] = args.rclone
+        env["RCLONE_CONFIG"] = write_alias_config(root, os.path.join(run_dir, "rclone.conf"), args.s3_endpoint)
+    else:
+        env.update({
+            "RCLONE_BIN": FAKE_RCLONE,
+            "FAKE_RCLONE_ROOT": root,
+            "FAKE_RCLONE_LATENCY": str(args.latency),
+            "FAKE_RCLONE_QUOTA": str(args.quota),
+            "FAKE_RCLONE_STREAM_BW": args.stream_bw,
+            "FAKE_RCLONE_TRACE": trace,
+        })
+        if os.path.exists(os.path.join(root, ".quota")):
+            os.remove(os.path.join(root, ".quota"))
+
+    cmd = [sys.executable, BATCH_SCRIPT, profile, "--subpath", BENCH_SUBPATH, "--yes", "--refresh-manifests",
+           f"--transfers={settings['transfers']}", f"--checkers={settings['checkers']}",
+           f"--tpslimit={settings['tpslimit']:g}", f"--bwlimit={args.bwlimit}"] + args.extra_args.split()
+    if args.s3:
+        # A fresh prefix per run, so nothing is ever deleted from the stand-in bucket
+        run_name = os.path.relpath(run_dir, os.path.join(args.workdir, "runs")).replace(os.sep, "-")
+        cmd.append(f"--s3-remote={S3_REMOTE}:{S3_BUCKET}/{run_name}/WASABI-MIGRATION")
+    start = time.time()
+    result = subprocess.run(cmd, cwd=run_dir, env=env, capture_output=True, text=True)
+    wall = time.time() - start
+    with open(os.path.join(run_dir, "batch-output.txt"), "w", encoding="utf-8") as f:
+        f.write(result.stdout + result.stderr)
+
+    stages = {}
+    copied_bytes = 0
+    if os.path.exists(trace):
+        with open(trace, "r", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                stage = stages.setdefault(stage_of(record["cmd"]), {"seconds": 0.0, "api_calls": 0, "throttled": 0})
+                stage["seconds"] += record["end"] - record["start"]
+                stage["api_calls"] += record["api_calls"]
+                stage["throttled"] += record["throttled"]
+                copied_bytes += record["bytes"]
+    verified = "Verification passed" in result.stdout and (not args.s3 or "S3 upload verified" in result.stdout)
+    return {"profile": profile, **settings, "wall": wall, "returncode": result.returncode, "verified": verified,
+            "copied_bytes": copied_bytes, "stages": stages,
+            "throttled": sum(stage["throttled"] for stage in stages.values()),
+            "api_calls": sum(stage["api_calls"] for stage in stages.values()) if stages else None}
+
+def print_results(results, sizes, upload=False):
+    upload_head = f" {'upload s/calls':>15}" if upload else ""
+    print(f"\n{'Profile':<8} {'xfers':>5} {'chk':>4} {'tps':>5} {'wall s':>8} {'MB/s':>7} "
+          f"{'list s/calls':>13} {'copy s/calls':>13} {'verify s/calls':>15}{upload_head} {'throttled':>9}  ok")
+    for r in results:
+        rate = sizes[r["profile"]][1] / r["wall"] / (1024 * 1024) if r["wall"] else 0
+        def stage(name):
+            data = r["stages"].get(name)
+            return f"{data['seconds']:.1f}/{data['api_calls']}" if data else "-"
+        upload_cell = f" {stage('upload'):>15}" if upload else ""
+        print(f"{r['profile']:<8} {r['transfers']:>5} {r['checkers']:>4} {r['tpslimit']:>5g} {r['wall']:>8.1f} {rate:>7.2f} "
+              f"{stage('listing'):>13} {stage('copy'):>13} {stage('verify'):>15}{upload_cell} {r['throttled']:>9}  "
+              f"{'yes' if r['verified'] and r['returncode'] == 0 else 'NO'}")
+
+# Fastest successful run per profile, preferring runs that were never throttled
+def autotune(results, sizes):
+    recommendations = {}
+    for profile in sizes:
+        runs = [r for r in results if r["profile"] == profile and r["returncode"] == 0 and r["verified"]]
+        clean = [r for r in runs if not r["throttled"]]
+        pool = clean or runs
+        if not pool:
+            continue
+        best = min(pool, key=lambda r: r["wall"])
+        recommendations[profile] = {
+            "like": PROFILES[profile]["like"],
+            "transfers": best["transfers"], "checkers": best["checkers"], "tpslimit": best["tpslimit"],
+            "wall": round(best["wall"], 2), "throttled": best["throttled"],
+            "arguments": f"--transfers {best['transfers']} --checkers {best['checkers']} --tpslimit {best['tpslimit']:g}",
+        }
+    return recommendations
+
+# Main function
+def main():
+    args = parse_arguments()
+    if args.rclone and args.s3 and not args.s3_endpoint:
+        print("--s3 with --rclone needs --s3-endpoint (a local moto_server or MinIO)", file=sys.stderr)
+        return 2
+    profiles = [name.strip() for name in args.profiles.split(",") if name.strip()]
+    unknown = [name for name in profiles if name not in PROFILES]
+    if unknown:
+        print(f"Unknown profile(s): {', '.join(unknown)} (choose from {', '.join(PROFILES)})", file=sys.stderr)
+        return 2
+
+    workdir = os.path.abspath(args.workdir)
+    root = os.path.join(workdir, "remotes")
+    os.makedirs(root, exist_ok=True)
+
+    sizes = {}
+    for name in profiles:
+        sizes[name] = generate_profile(root, name, PROFILES[name], args.scale, args.size_scale, args.seed)
+        print(f"Profile {name}: {sizes[name][0]} files, {format_size(sizes[name][1])} (like {PROFILES[name]['like']})")
+
+    combos = []
+    for transfers, tpslimit in itertools.product(int_list(args.transfers), float_list(args.tpslimit)):
+        for checkers in (int_list(args.checkers) or [transfers * 2]):
+            combos.append({"transfers": transfers, "checkers": checkers, "tpslimit": tpslimit})
+
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    results = []
+    for name in profiles:
+        for index, settings in enumerate(combos, 1):
+            run_dir = os.path.join(workdir, "runs", stamp, f"{name}-{index:02d}")
+            print(f"Running {name} {index}/{len(combos)}: transfers={settings['transfers']} "
+                  f"checkers={settings['checkers']} tpslimit={settings['tpslimit']:g} ...", flush=True)
+            results.append(run_once(args, root, name, settings, run_dir))
+
+    print_results(results, sizes, upload=args.s3)
+    output = {"settings": vars(args), "profiles": {name: {"files": f, "bytes": b} for name, (f, b) in sizes.items()},
+              "results": results}
+    if args.autotune:
+        recommendations = autotune(results, sizes)
+        output["recommendations"] = recommendations
+        print("\nRecommended settings per folder profile:")
+        for name, rec in recommendations.items():
+            print(f"  {name:<8} {rec['arguments']:<40} ({rec['wall']}s, throttled {rec['throttled']}x) - like {rec['like']}")
+
+    results_path = os.path.join(workdir, f"bench_results_{stamp}.json")
+    with open(results_path, "w", encoding="utf-8") as f:
+        json.dump(output, f, indent=2)
+    print(f"\nResults written to {results_path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
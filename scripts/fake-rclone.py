@@ -0,0 +1,821 @@
+#!/usr/bin/env python3
+"""
+Storage Migration: Fake rclone Stand-in
+
+Version: 1.0
+Date: October 18, 2026
+
+A small local stand-in for the rclone subset used by batch-transfer-script.py, so
+the batch pipeline can be benchmarked and exercised without Dropbox or the NAS.
+Point the batch script at it with RCLONE_BIN=scripts/fake-rclone.py.
+
+Remotes map to directories: "name:path" is FAKE_RCLONE_ROOT/name/path. Listings report
+the hash types of the real backends: "dropbox*" remotes only the Dropbox content hash,
+"s3*" remotes only MD5 (S3 ETags), any other remote (the NAS) MD5 and SHA-1. As with
+rclone, check and copy --checksum compare by size alone when the two remotes have no
+hash in common (Dropbox and the NAS), unless check is given --download.
+
+Supported commands: lsd, mkdir, size, lsjson, copy, copyto, check, hashsum, and rcd with
+the rc methods operations/list, operations/mkdir, operations/check, operations/copyfile,
+sync/copy, job/status, job/stop, core/stats, core/transferred, core/bwlimit, options/set,
+options/get, rc/noop and core/quit (async jobs share one --tpslimit pacer and --bwlimit;
+options/set changes the transfers/checkers of jobs started later, not the pacer).
+rc listeners require Basic auth from --rc-user/--rc-pass or RCLONE_RC_USER/RCLONE_RC_PASS
+unless --rc-no-auth is given.
+
+Simulated costs (environment variables):
+- FAKE_RCLONE_LATENCY        seconds per API call (default: 0.02)
+- FAKE_RCLONE_QUOTA          API calls per second allowed across ALL processes on the
+                             quota remotes; excess calls get "too_many_requests" and
+                             back off like rclone does (default: 0 = unlimited)
+- FAKE_RCLONE_QUOTA_REMOTES  comma-separated remotes the quota applies to
+                             (default: dropbox-wasabi-migration)
+- FAKE_RCLONE_STREAM_BW      bytes per second of a single download stream (default: 8M)
+- FAKE_RCLONE_TRACE          JSONL file receiving one record per invocation with wall
+                             time, API calls, throttled calls and bytes copied
+- FAKE_RCLONE_FAIL           comma-separated "remote:glob" patterns of paths that always
+                             fail: matching directories cannot be listed and files under
+                             a match cannot be copied (default: none)
+
+The rclone flags --tpslimit, --bwlimit, --transfers, --checkers, --dry-run,
+--files-from(-raw), --checksum, --multi-thread-streams, --multi-thread-cutoff,
+--use-json-log, -v, --stats, --combined, --one-way, --download, --size-only,
+--recursive, --files-only, --dirs-only, --max-depth, --hash, --hash-type and, for uploads to "s3*"
+remotes, --s3-chunk-size, --s3-upload-cutoff and --s3-upload-concurrency are honoured;
+other flags are accepted and ignored.
+"""
+
+import sys
+import os
+import time
+import json
+import hashlib
+import shutil
+import threading
+import fcntl
+import fnmatch
+import concurrent.futures
+import http.server
+import base64
+
+ROOT = os.environ.get("FAKE_RCLONE_ROOT", os.path.join(os.getcwd(), "fake-remotes"))
+LATENCY = float(os.environ.get("FAKE_RCLONE_LATENCY", "0.02"))
+QUOTA = float(os.environ.get("FAKE_RCLONE_QUOTA", "0"))
+QUOTA_REMOTES = set(filter(None, os.environ.get("FAKE_RCLONE_QUOTA_REMOTES", "dropbox-wasabi-migration").split(",")))
+TRACE = os.environ.get("FAKE_RCLONE_TRACE")
+FAIL = [pattern.partition(":")[::2] for pattern in os.environ.get("FAKE_RCLONE_FAIL", "").split(",") if ":" in pattern]
+
+DROPBOX_BLOCK = 4 * 1024 * 1024
+
+# Parse a size such as "16M" (bare numbers are bytes)
+def parse_size(value, bare=1):
+    value = str(value).strip()
+    if value.lower() in ("", "off", "0"):
+        return 0
+    units = {"B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(float(value) * bare)
+
+# Parse an rclone duration such as "10s", "1m" or "500ms" into seconds
+def parse_duration(value):
+    value = str(value).strip()
+    for suffix, scale in (("ms", 0.001), ("s", 1), ("m", 60), ("h", 3600)):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * scale
+    return float(value)
+
+STREAM_BW = parse_size(os.environ.get("FAKE_RCLONE_STREAM_BW", "8M"))
+
+# Command line: positional arguments and --flag[=value] options
+class Options:
+    BOOLEAN = {"--dry-run", "--checksum", "--use-json-log", "--one-way", "--recursive", "-R",
+               "--files-only", "--dirs-only", "--hash", "--no-traverse", "-v", "-vv", "--json",
+               "--progress", "-P", "--rc", "--rc-no-auth", "--size-only", "--download", "--no-check-dest"}
+
+    def __init__(self, argv):
+        self.positional = []
+        self.flags = {}
+        i = 0
+        while i < len(argv):
+            arg = argv[i]
+            if arg.startswith("-"):
+                if "=" in arg:
+                    key, value = arg.split("=", 1)
+                    self.flags[key] = value
+                elif arg in self.BOOLEAN or i + 1 >= len(argv):
+                    self.flags[arg] = True
+                else:
+                    self.flags[arg] = argv[i + 1]
+                    i += 1
+            else:
+                self.positional.append(arg)
+            i += 1
+
+    def get(self, name, default=None):
+        return self.flags.get(name, default)
+
+    def has(self, *names):
+        return any(name in self.flags for name in names)
+
+# Per-invocation accounting, written to the trace file on exit
+class Accounting:
+    def __init__(self, command):
+        self.command = command
+        self.start = time.time()
+        self.api_calls = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.files = 0
+        self.lock = threading.Lock()
+
+    def write(self, returncode):
+        if not TRACE:
+            return
+        record = {"cmd": self.command, "start": self.start, "end": time.time(), "api_calls": self.api_calls,
+                  "throttled": self.throttled, "bytes": self.bytes, "files": self.files, "returncode": returncode}
+        with open(TRACE, "a", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + "\n")
+
+# --tpslimit: spaces API calls evenly (one pacer per process, shared by all rcd jobs)
+class Pacer:
+    def __init__(self, tps):
+        self.interval = 1 / tps if tps > 0 else 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+# Simulated remote API: latency, this process's --tpslimit and a cross-process quota
+class Api:
+    def __init__(self, opts, accounting, log, pacer=None):
+        self.accounting = accounting
+        self.log = log
+        self.pacer = pacer or Pacer(float(opts.get("--tpslimit", 0) or 0))
+        self.quota_file = os.path.join(ROOT, ".quota")
+
+    # Cross-process fixed-window quota; True when this call fits in the current second
+    def _quota_ok(self):
+        os.makedirs(ROOT, exist_ok=True)
+        with open(self.quota_file, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            parts = f.read().split()
+            now = time.time()
+            window, count = (float(parts[0]), int(parts[1])) if len(parts) == 2 else (now, 0)
+            if now - window >= 1:
+                window, count = now, 0
+            count += 1
+            f.seek(0)
+            f.truncate()
+            f.write(f"{window} {count}")
+            return count <= QUOTA
+
+    def call(self, remote):
+        self.pacer.wait()
+        with self.accounting.lock:
+            self.accounting.api_calls += 1
+        if QUOTA > 0 and remote in QUOTA_REMOTES:
+            backoff = 1.0
+            while not self._quota_ok():
+                with self.accounting.lock:
+                    self.accounting.throttled += 1
+                self.log("error", f"too_many_requests/: retry after {backoff:g}s (low level retry)")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 8)
+        if LATENCY:
+            time.sleep(LATENCY)
+
+# Shared --bwlimit for all transfers of this process
+class Bandwidth:
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.next_free = 0
+
+    def consume(self, size, streams=1):
+        stream_time = size / (STREAM_BW * max(1, streams)) if STREAM_BW else 0
+        limit_time = 0
+        if self.limit:
+            with self.lock:
+                now = time.time()
+                start = max(now, self.next_free)
+                self.next_free = start + size / self.limit
+                limit_time = self.next_free - now
+        time.sleep(max(stream_time, limit_time))
+
+def local_path(remote_path):
+    name, sep, path = remote_path.partition(":")
+    if not sep:
+        return os.path.abspath(remote_path), ""
+    return os.path.join(ROOT, name, path.lstrip("/")), name
+
+# Raised for paths matching FAKE_RCLONE_FAIL
+class InjectedFailure(Exception):
+    pass
+
+# True when a local path (or one of its parents) matches a FAKE_RCLONE_FAIL pattern of remote
+def injected_failure(remote, path):
+    rel = os.path.relpath(path, os.path.join(ROOT, remote)).replace(os.sep, "/")
+    parts = rel.split("/")
+    return any(name == remote and fnmatch.fnmatch("/".join(parts[:depth]), pattern)
+               for name, pattern in FAIL for depth in range(1, len(parts) + 1))
+
+# Plain digest of a file's content ("md5", "sha1")
+def file_hash(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(DROPBOX_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def dropbox_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(DROPBOX_BLOCK)
+            if not block:
+                break
+            digest.update(hashlib.sha256(block).digest())
+    return digest.hexdigest()
+
+# Walk a directory like a remote listing: one API call per directory
+def walk(api, remote, base, max_depth=None):
+    files, dirs = [], []
+    stack = [("", 1)]
+    while stack:
+        rel, depth = stack.pop()
+        api.call(remote)
+        if injected_failure(remote, os.path.join(base, rel)):
+            raise InjectedFailure(f"error reading source directory {rel or '.'!r}: path/restricted_content/")
+        try:
+            entries = sorted(os.scandir(os.path.join(base, rel)), key=lambda entry: entry.name)
+        except FileNotFoundError:
+            if rel:
+                continue
+            raise
+        for entry in entries:
+            if entry.name.startswith(".quota"):
+                continue
+            path = f"{rel}/{entry.name}" if rel else entry.name
+            if entry.is_dir():
+                dirs.append(path)
+                if max_depth is None or depth < max_depth:
+                    stack.append((path, depth + 1))
+            else:
+                files.append(path)
+    return sorted(files), sorted(dirs)
+
+def read_files_from(opts):
+    source = opts.get("--files-from-raw") or opts.get("--files-from")
+    if not source:
+        return None
+    with open(source, "r", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f if line.rstrip("\n")]
+
+def main(argv):
+    opts = Options(argv)
+    if not opts.positional:
+        print("Usage: fake-rclone.py <command> ...", file=sys.stderr)
+        return 2
+    command = opts.positional[0]
+    accounting = Accounting(command)
+    json_log = opts.has("--use-json-log")
+    verbose = opts.has("-v", "-vv")
+    out_lock = threading.Lock()
+
+    def log(level, msg, **fields):
+        if level == "info" and not verbose:
+            return
+        with out_lock:
+            if json_log:
+                fields.update({"level": level, "msg": msg, "time": time.strftime("%Y-%m-%dT%H:%M:%S")})
+                print(json.dumps(fields), file=sys.stderr, flush=True)
+            else:
+                print(f"{level.upper():<6}: {fields.get('object', '')}{': ' if 'object' in fields else ''}{msg}",
+                      file=sys.stderr, flush=True)
+
+    api = Api(opts, accounting, log)
+    returncode = 0
+    try:
+        returncode = run(command, opts, api, accounting, log)
+    except FileNotFoundError as e:
+        log("error", f"directory not found: {e.filename}")
+        print(f"ERROR : directory not found: {e.filename}", file=sys.stderr)
+        returncode = 3
+    except InjectedFailure as e:
+        log("error", str(e))
+        returncode = 1
+    accounting.write(returncode)
+    return returncode
+
+def run(command, opts, api, accounting, log):
+    pos = opts.positional
+    if command == "lsd":
+        base, remote = local_path(pos[1])
+        api.call(remote)
+        for name in sorted(os.listdir(base)):
+            if os.path.isdir(os.path.join(base, name)):
+                print(f"          -1 1999-12-31 16:00:00        -1 {name}")
+        return 0
+
+    if command == "mkdir":
+        base, remote = local_path(pos[1])
+        api.call(remote)
+        os.makedirs(base, exist_ok=True)
+        return 0
+
+    if command in ("size", "lsjson", "hashsum"):
+        target = pos[2] if command == "hashsum" else pos[1]
+        base, _ = local_path(target)
+        if command == "lsjson":
+            # Same layout as rclone: one item per line between "[" and "]"
+            items = list_items(opts, api, target)
+            print("[")
+            print(",\n".join(json.dumps(item) for item in items))
+            print("]")
+            return 0
+        files, _ = listed_files(opts, api, target, recursive=True)
+        if command == "size":
+            total = sum(os.path.getsize(os.path.join(base, path)) for path in files)
+            print(json.dumps({"count": len(files), "bytes": total, "sizeless": 0}))
+        else:
+            for path in files:
+                print(f"{dropbox_hash(os.path.join(base, path))}  {path}")
+        return 0
+
+    if command in ("copy", "copyto"):
+        return copy(command, opts, api, accounting, log)
+
+    if command == "check":
+        results, hash_type = check_results(opts, api, pos[1], pos[2])
+        if hash_type == "none":
+            print(f"NOTICE: {pos[2]}: No common hash found - not using a hash for checks", file=sys.stderr)
+        elif hash_type and opts.has("-v", "-vv"):
+            print(f"INFO  : {pos[2]}: Using {hash_type} for hash comparisons", file=sys.stderr)
+        if opts.get("--combined"):
+            with open(opts.get("--combined"), "w", encoding="utf-8") as f:
+                for status, path in results:
+                    f.write(f"{status} {path}\n")
+        differences = sum(1 for status, _ in results if status != "=")
+        print(f"NOTICE: {differences} differences found", file=sys.stderr)
+        return 1 if differences else 0
+
+    if command == "rcd":
+        return rcd(opts, accounting, log)
+
+    print(f"fake-rclone: unsupported command '{command}'", file=sys.stderr)
+    return 2
+
+# Files and directories of a listing, honouring --max-depth and --files-from(-raw)
+def listed_files(opts, api, target, recursive):
+    base, remote = local_path(target)
+    max_depth = int(opts.get("--max-depth")) if opts.get("--max-depth") else (None if recursive else 1)
+    files, dirs = walk(api, remote, base, max_depth)
+    subset = read_files_from(opts)
+    if subset is not None:
+        wanted = set(subset)
+        files = [path for path in files if path in wanted]
+    return files, dirs
+
+# Hash types a remote supports, like the real backends: Dropbox only its content hash,
+# S3 only MD5 (the ETag), the NAS (SFTP) MD5 and SHA-1. Dropbox and the NAS have no hash
+# in common, so comparisons between them are by size unless the content is downloaded.
+def hash_types(remote):
+    if remote.startswith("dropbox"):
+        return ("dropbox",)
+    if remote.startswith("s3"):
+        return ("md5",)
+    return ("md5", "sha1")
+
+def remote_hashes(remote, path):
+    return {name: dropbox_hash(path) if name == "dropbox" else file_hash(path, name) for name in hash_types(remote)}
+
+# First hash type two remotes both support, or None (rclone then compares sizes only)
+def common_hash(source_remote, dest_remote):
+    return next((name for name in hash_types(source_remote) if name in hash_types(dest_remote)), None)
+
+# True when two files have the same content as far as rclone can tell: same size, and the
+# same common hash when there is one (always compared with download=True)
+def same_content(src, dst, hash_type, download=False):
+    if os.path.getsize(src) != os.path.getsize(dst):
+        return False
+    if download:
+        return dropbox_hash(src) == dropbox_hash(dst)
+    if hash_type is None:
+        return True
+    return remote_hash(src, hash_type) == remote_hash(dst, hash_type)
+
+def remote_hash(path, hash_type):
+    return dropbox_hash(path) if hash_type == "dropbox" else file_hash(path, hash_type)
+
+# lsjson items for a target
+def list_items(opts, api, target):
+    base, remote = local_path(target)
+    files, dirs = listed_files(opts, api, target, opts.has("--recursive", "-R"))
+    items = []
+    if not opts.has("--files-only"):
+        items += [{"Path": path, "Name": os.path.basename(path), "Size": -1, "ModTime": "2000-01-01T00:00:00Z",
+                   "IsDir": True} for path in dirs]
+    if not opts.has("--dirs-only"):
+        for path in files:
+            full = os.path.join(base, path)
+            item = {"Path": path, "Name": os.path.basename(path), "Size": os.path.getsize(full),
+                    "ModTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(os.path.getmtime(full))),
+                    "IsDir": False}
+            if opts.has("--hash"):
+                item["Hashes"] = remote_hashes(remote, full)
+                if opts.get("--hash-type"):
+                    wanted = opts.get("--hash-type").split(",")
+                    item["Hashes"] = {name: value for name, value in item["Hashes"].items() if name in wanted}
+            items.append(item)
+    return sorted(items, key=lambda item: item["Path"])
+
+# ([(status, path)] with rclone check --combined status characters, hash type used)
+# The hash type is "none" when the remotes share none (sizes only); --download compares
+# the content itself, reading every file from both sides, and reports no hash type.
+def check_results(opts, api, source_target, dest_target):
+    source, source_remote = local_path(source_target)
+    dest, dest_remote = local_path(dest_target)
+    download = opts.has("--download")
+    hash_type = None if opts.has("--size-only") else common_hash(source_remote, dest_remote)
+    paths = read_files_from(opts)
+    if paths is None:
+        paths, _ = walk(api, source_remote, source)
+    else:
+        api.call(source_remote)
+    results = []
+    for path in paths:
+        src, dst = os.path.join(source, path), os.path.join(dest, path)
+        if not os.path.exists(src):
+            results.append(("+", path))
+        elif not os.path.exists(dst):
+            results.append(("-", path))
+        else:
+            if download:
+                api.call(source_remote)
+            results.append(("=" if same_content(src, dst, hash_type, download) else "*", path))
+    return results, ("" if download else hash_type or "none")
+
+def copy(command, opts, api, accounting, log, bandwidth=None, stop=None):
+    pos = opts.positional
+    source, source_remote = local_path(pos[1])
+    dest, dest_remote = local_path(pos[2])
+    if command == "copyto":
+        pairs = [(source, dest, os.path.basename(dest))]
+    else:
+        paths = read_files_from(opts)
+        if paths is None:
+            paths, _ = walk(api, source_remote, source)
+        pairs = [(os.path.join(source, path), os.path.join(dest, path), path) for path in paths]
+
+    dry_run = opts.has("--dry-run")
+    bandwidth = bandwidth or Bandwidth(parse_size(opts.get("--bwlimit", "0"), bare=1024))
+    streams = int(opts.get("--multi-thread-streams", 4))
+    cutoff = parse_size(opts.get("--multi-thread-cutoff", "256M"))
+    # Uploads to an S3 stand-in: files from --s3-upload-cutoff go up in --s3-chunk-size
+    # parts, --s3-upload-concurrency at a time, each part one API call
+    s3_upload = dest_remote.startswith("s3")
+    if s3_upload:
+        accounting.command = "upload"
+        streams = int(opts.get("--s3-upload-concurrency", 4))
+        cutoff = parse_size(opts.get("--s3-upload-cutoff", "200M"))
+        chunk = max(1, parse_size(opts.get("--s3-chunk-size", "5M")))
+    stats_every = parse_duration(opts.get("--stats", "1m"))
+    total_bytes = sum(os.path.getsize(src) for src, _, _ in pairs if os.path.exists(src))
+    state = {"bytes": 0, "transfers": 0, "errors": 0, "checks": 0, "last_stats": time.time(),
+             "transferring": {}}
+    lock = threading.Lock()
+
+    def current_stats():
+        elapsed = time.time() - accounting.start
+        speed = state["bytes"] / elapsed if elapsed > 0 else 0
+        return {"bytes": state["bytes"], "totalBytes": total_bytes, "transfers": state["transfers"],
+                "totalTransfers": len(pairs), "checks": state["checks"], "errors": state["errors"],
+                "speed": speed, "elapsedTime": elapsed, "lastError": state.get("lastError", ""),
+                "eta": (total_bytes - state["bytes"]) / speed if speed > 0 else None,
+                "transferring": [{"name": name, "size": size, "bytes": 0, "percentage": 0,
+                                  "speedAvg": STREAM_BW, "eta": size / STREAM_BW if STREAM_BW else None}
+                                 for name, size in state["transferring"].items()]}
+
+    def emit_stats(force=False):
+        with lock:
+            if not force and time.time() - state["last_stats"] < stats_every:
+                return
+            state["last_stats"] = time.time()
+            stats = current_stats()
+        if opts.has("--use-json-log"):
+            log("info", "stats", stats=stats)
+
+    def set_bwlimit(params):
+        if "rate" in params:
+            bandwidth.limit = parse_size(params["rate"], bare=1024)
+            log("info", f"core/bwlimit: {params['rate']}")
+        return {"rate": params.get("rate", "off"), "bytesPerSecond": bandwidth.limit or -1}
+
+    def transfer(pair):
+        src, dst, name = pair
+        if stop is not None and stop.is_set():
+            # Stopped rc job (job/stop): the files not yet started fail like in rclone
+            with lock:
+                state["errors"] += 1
+            log("error", "Failed to copy: context canceled", object=name)
+            return
+        if not os.path.exists(src):
+            with lock:
+                state["errors"] += 1
+            log("error", "Failed to copy: object not found", object=name)
+            return
+        if injected_failure(source_remote, src):
+            with lock:
+                state["errors"] += 1
+            log("error", "Failed to copy: path/restricted_content/", object=name)
+            return
+        size = os.path.getsize(src)
+        with lock:
+            state["checks"] += 1
+        if os.path.exists(dst) and same_content(src, dst, common_hash(source_remote, dest_remote)
+                                                if opts.has("--checksum") else None):
+            log("info", "Unchanged skipping", object=name)
+            return
+        if dry_run:
+            log("notice", "Skipped copy as --dry-run is set", object=name, size=size)
+            return
+        with lock:
+            state["transferring"][name] = size
+        if s3_upload:
+            for _ in range(-(-size // chunk) if size >= cutoff else 1):
+                api.call(dest_remote)
+        else:
+            api.call(source_remote)
+        bandwidth.consume(size, streams if size >= cutoff else 1)
+        os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+        shutil.copyfile(src, dst)
+        with lock:
+            state["transferring"].pop(name, None)
+            state["bytes"] += size
+            state["transfers"] += 1
+        with accounting.lock:
+            accounting.bytes += size
+            accounting.files += 1
+        log("info", "Copied (new)", object=name, size=size)
+        emit_stats()
+
+    # A copy started with --rc answers a few rc methods while it runs; like rclone, only
+    # core/bwlimit changes the running copy
+    rc_server = None
+    if command == "copy" and opts.has("--rc"):
+        def stats_now(params):
+            with lock:
+                return current_stats()
+        rc_server = serve_rc(opts, {"rc/noop": lambda params: params, "core/stats": stats_now,
+                                    "core/bwlimit": set_bwlimit, "options/set": lambda params: {}})
+    workers = max(1, int(opts.get("--transfers", 4)))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(transfer, pairs))
+        emit_stats(force=True)
+    finally:
+        if rc_server:
+            rc_server.shutdown()
+    return 1 if state["errors"] else 0
+
+# The Authorization header rc requests must carry: Basic auth from --rc-user/--rc-pass
+# (or RCLONE_RC_USER/RCLONE_RC_PASS), or None with --rc-no-auth or no user set
+def rc_authorization(opts):
+    user = opts.get("--rc-user") or os.environ.get("RCLONE_RC_USER")
+    if opts.has("--rc-no-auth") or not user:
+        return None
+    password = opts.get("--rc-pass") or os.environ.get("RCLONE_RC_PASS", "")
+    return "Basic " + base64.b64encode(f"{user}:{password}".encode("utf-8")).decode("ascii")
+
+# Serve {method: function(params) -> reply} on --rc-addr in a background thread
+def serve_rc(opts, methods):
+    host, _, port = opts.get("--rc-addr", "127.0.0.1:5572").rpartition(":")
+    authorization = rc_authorization(opts)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            method = self.path.strip("/")
+            length = int(self.headers.get("Content-Length") or 0)
+            params = json.loads(self.rfile.read(length) or b"{}")
+            if authorization and self.headers.get("Authorization") != authorization:
+                code, body = 401, {"error": "Unauthorized", "path": method}
+            elif method in methods:
+                code, body = 200, methods[method](params)
+            else:
+                code, body = 404, {"error": f"couldn't find method {method!r}", "path": method}
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# rc job parameters -> command-line flags for the functions above
+def job_flags(params):
+    flags = []
+    config = params.get("_config") or {}
+    names = {"Transfers": "--transfers", "Checkers": "--checkers", "MultiThreadStreams": "--multi-thread-streams",
+             "MultiThreadCutoff": "--multi-thread-cutoff"}
+    for key, flag in names.items():
+        if key in config:
+            flags.append(f"{flag}={config[key]}")
+    if config.get("CheckSum"):
+        flags.append("--checksum")
+    if params.get("download"):
+        flags.append("--download")
+    for name in (params.get("_filter") or {}).get("FilesFromRaw") or []:
+        flags.append(f"--files-from-raw={name}")
+    opt = params.get("opt") or {}
+    flags += [flag for key, flag in (("recurse", "--recursive"), ("filesOnly", "--files-only"),
+                                    ("dirsOnly", "--dirs-only"), ("showHash", "--hash")) if opt.get(key)]
+    if opt.get("hashTypes"):
+        flags.append(f"--hash-type={','.join(opt['hashTypes'])}")
+    return flags
+
+# Trace names for rc methods, matching the command-line equivalents
+RC_TRACE_NAMES = {"operations/list": "lsjson", "operations/mkdir": "mkdir", "operations/check": "check",
+                  "sync/copy": "copy", "operations/copyfile": "copyto"}
+
+# rclone rcd: one long-lived process serving rc methods, optionally as async jobs
+# All jobs share the daemon's --tpslimit pacer and --bwlimit, like real rclone.
+def rcd(opts, accounting, log):
+    host, _, port = opts.get("--rc-addr", "127.0.0.1:5572").rpartition(":")
+    pacer = Pacer(float(opts.get("--tpslimit", 0) or 0))
+    bandwidth = Bandwidth(parse_size(opts.get("--bwlimit", "0"), bare=1024))
+    # Global options (options/set): defaults for the jobs started afterwards. As in rclone,
+    # a new TPSLimit does not change the pacer created at startup
+    options = {"main": {"Transfers": int(opts.get("--transfers", 4)), "Checkers": int(opts.get("--checkers", 8)),
+                        "TPSLimit": float(opts.get("--tpslimit", 0) or 0)}}
+    jobs = {}
+    jobs_lock = threading.Lock()
+    authorization = rc_authorization(opts)
+
+    def execute(method, params, job):
+        job_accounting = Accounting(RC_TRACE_NAMES.get(method, method))
+        def job_log(level, msg, **fields):
+            log(level, msg, **fields)
+            if job is None:
+                return
+            with jobs_lock:
+                if msg == "stats":
+                    job["stats"] = fields["stats"]
+                elif str(msg).startswith("Copied") and "object" in fields:
+                    job["transferred"].append({"name": fields["object"], "size": fields.get("size", 0),
+                                               "error": "", "checked": False, "group": job["group"]})
+                elif level == "error":
+                    job["lastError"] = msg
+        api = Api(opts, job_accounting, job_log, pacer=pacer)
+        returncode = 0
+        try:
+            if method == "rc/noop":
+                return params
+            if method == "options/set":
+                for section, values in params.items():
+                    options.setdefault(section, {}).update(values)
+                log("info", f"options/set: {json.dumps(params)}")
+                return {}
+            if method == "options/get":
+                return options
+            if method == "core/bwlimit":
+                if "rate" in params:
+                    bandwidth.limit = parse_size(params["rate"], bare=1024)
+                    log("info", f"core/bwlimit: {params['rate']}")
+                return {"rate": params.get("rate", "off"), "bytesPerSecond": bandwidth.limit or -1}
+            if method == "operations/mkdir":
+                base, remote = local_path(params["fs"])
+                api.call(remote)
+                os.makedirs(os.path.join(base, params.get("remote", "")), exist_ok=True)
+                return {}
+            if method == "operations/list":
+                target = params["fs"].rstrip("/") + ("/" + params["remote"] if params.get("remote") else "")
+                return {"list": list_items(Options(job_flags(params)), api, target)}
+            if method == "operations/check":
+                results, hash_type = check_results(Options(job_flags(params)), api, params["srcFs"], params["dstFs"])
+                differences = sum(1 for status, _ in results if status != "=")
+                returncode = 1 if differences else 0
+                output = {"success": not differences, "status": f"{differences} differences found",
+                          "combined": [f"{status} {path}" for status, path in results]}
+                if hash_type:
+                    output["hashType"] = hash_type
+                return output
+            if method == "operations/copyfile":
+                argv = ["copyto", f"{params['srcFs']}/{params['srcRemote']}", f"{params['dstFs']}/{params['dstRemote']}"]
+                if copy("copyto", Options(argv), api, job_accounting, job_log, bandwidth, job and job["stop"]):
+                    raise RuntimeError("file not copied")
+                return {}
+            if method == "sync/copy":
+                config = {key: value for key, value in options["main"].items() if key in ("Transfers", "Checkers")}
+                params["_config"] = dict(config, **(params.get("_config") or {}))
+                log("info", f"sync/copy {params['srcFs']} -> {params['dstFs']}: transfers={params['_config']['Transfers']}, "
+                            f"checkers={params['_config']['Checkers']}")
+                argv = ["copy", params["srcFs"], params["dstFs"], "--use-json-log", "-v", "--stats=1s"] + job_flags(params)
+                returncode = copy("copy", Options(argv), api, job_accounting, job_log, bandwidth, job and job["stop"])
+                if returncode:
+                    raise RuntimeError("not all files were copied")
+                return {}
+            raise KeyError(f"couldn't find method {method!r}")
+        except Exception:
+            returncode = returncode or 1
+            raise
+        finally:
+            if method in RC_TRACE_NAMES:
+                job_accounting.write(returncode)
+
+    def run_job(job, method, params):
+        try:
+            output = execute(method, params, job)
+            with jobs_lock:
+                job.update(finished=True, success=True, output=output)
+        except Exception as e:
+            with jobs_lock:
+                job.update(finished=True, success=False, error=str(e))
+        job["endTime"] = time.time()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, code, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            method = self.path.strip("/")
+            length = int(self.headers.get("Content-Length") or 0)
+            params = json.loads(self.rfile.read(length) or b"{}")
+            if authorization and self.headers.get("Authorization") != authorization:
+                return self.reply(401, {"error": "Unauthorized", "path": method})
+            with jobs_lock:
+                if method == "job/status":
+                    job = jobs.get(params.get("jobid"))
+                    if job is None:
+                        return self.reply(500, {"error": "job not found"})
+                    return self.reply(200, {key: value for key, value in job.items()
+                                            if key in ("id", "group", "finished", "success", "error", "output")})
+                if method in ("core/stats", "core/transferred"):
+                    # A group only sees its own jobs; without one the stats add up over all jobs
+                    group = params.get("group")
+                    group_jobs = [job for job in jobs.values() if job["group"] == group] if group else list(jobs.values())
+                    if method == "core/transferred":
+                        return self.reply(200, {"transferred": [item for job in group_jobs for item in job["transferred"]]})
+                    if group:
+                        stats = dict(group_jobs[-1]["stats"]) if group_jobs else {}
+                    else:
+                        stats = {key: sum(job["stats"].get(key, 0) or 0 for job in group_jobs)
+                                 for key in ("bytes", "totalBytes", "transfers", "totalTransfers", "checks",
+                                             "errors", "speed")}
+                    stats["lastError"] = group_jobs[-1].get("lastError", "") if group_jobs else ""
+                    return self.reply(200, stats)
+                if method == "job/stop":
+                    job = jobs.get(params.get("jobid"))
+                    if job is None:
+                        return self.reply(500, {"error": "job not found"})
+                    job["stop"].set()
+                    log("info", f"job/stop: stopping job {job['id']}")
+                    return self.reply(200, {})
+            if method == "core/quit":
+                self.reply(200, {})
+                threading.Thread(target=server.shutdown, daemon=True).start()
+                return
+            if params.pop("_async", False):
+                with jobs_lock:
+                    jobid = len(jobs) + 1
+                    job = {"id": jobid, "group": params.get("_group") or f"job/{jobid}", "finished": False,
+                           "success": False, "error": "", "output": {}, "stats": {}, "transferred": [],
+                           "stop": threading.Event()}
+                    jobs[jobid] = job
+                threading.Thread(target=run_job, args=(job, method, params), daemon=True).start()
+                return self.reply(200, {"jobid": jobid})
+            try:
+                self.reply(200, execute(method, params, None))
+            except Exception as e:
+                self.reply(500, {"error": str(e), "path": method})
+
+    server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+    server.serve_forever()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))